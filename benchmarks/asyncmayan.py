@@ -0,0 +1,169 @@
+"""Check the retry rules, the concurrency limit and the streaming downloads of AsyncMayan against a local stub server.
+
+Run from the repository root: python -m benchmarks.asyncmayan
+"""
+
+import asyncio
+import io
+import time
+from collections import Counter
+
+from aiohttp import web
+
+from metadatamagic.api.asyncmayan import AsyncMayan
+
+DOWNLOAD_SIZE = 1024 * 1024
+# Seconds every request to the slow endpoint takes
+SLOW_DELAY = 0.05
+
+
+class StubMayan(object):
+    def __init__(self):
+        self.calls = Counter()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.uploads = []
+        self.download = bytes(range(256)) * (DOWNLOAD_SIZE // 256)
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/api/v4/auth/token/obtain/', self.token)
+        app.router.add_route('*', '/api/v4/unavailable/', self.unavailable)
+        app.router.add_get('/api/v4/flaky/', self.flaky)
+        app.router.add_post('/api/v4/upload/', self.upload)
+        app.router.add_get('/api/v4/slow/', self.slow)
+        app.router.add_get('/api/v4/download/', self.download_file)
+        app.router.add_get('/api/v4/missing/', self.missing)
+        return app
+
+    async def token(self, request):
+        return web.json_response({'token': 'benchmark'})
+
+    async def unavailable(self, request):
+        self.calls[request.method, 'unavailable'] += 1
+        return web.json_response({}, status=503)
+
+    async def flaky(self, request):
+        # Fails twice, then succeeds
+        self.calls['GET', 'flaky'] += 1
+        if self.calls['GET', 'flaky'] <= 2:
+            return web.json_response({}, status=503)
+        return web.json_response({'ok': True})
+
+    async def upload(self, request):
+        # The first attempt is received completely but fails, a retry has to send the whole form again
+        self.calls['POST', 'upload'] += 1
+        fields = {}
+        async for field in await request.multipart():
+            fields[field.name] = await field.read()
+        self.uploads.append(fields)
+        if self.calls['POST', 'upload'] == 1:
+            return web.json_response({}, status=503)
+        return web.json_response({'id': 1}, status=202)
+
+    async def slow(self, request):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(SLOW_DELAY)
+        finally:
+            self.in_flight -= 1
+        return web.json_response({'ok': True})
+
+    async def download_file(self, request):
+        response = web.StreamResponse()
+        response.content_type = 'application/pdf'
+        await response.prepare(request)
+        for start in range(0, len(self.download), 64 * 1024):
+            await response.write(self.download[start:start + 64 * 1024])
+        await response.write_eof()
+        return response
+
+    async def missing(self, request):
+        return web.Response(status=404, text='not found')
+
+
+async def check_retries(mayan: AsyncMayan, stub: StubMayan):
+    # Idempotent requests are retried, POST and PUT are sent once since Mayan may have processed them already
+    result, status = await mayan.get('flaky')
+    assert status == 200 and result == {'ok': True}
+    assert stub.calls['GET', 'flaky'] == 3
+    _, status = await mayan.get('unavailable')
+    assert status == 503
+    assert stub.calls['GET', 'unavailable'] == mayan.retries + 1
+    await mayan.post('unavailable', {'label': 'benchmark'})
+    assert stub.calls['POST', 'unavailable'] == 1
+    await mayan.put('unavailable', {'label': 'benchmark'})
+    assert stub.calls['PUT', 'unavailable'] == 1
+
+
+async def check_upload(mayan: AsyncMayan, stub: StubMayan):
+    # A retried upload sends the document type and the complete file again
+    file = io.BytesIO(b'ignored' + stub.download[:4096])
+    file.seek(len(b'ignored'))
+    result = await mayan.uploadfile('upload', {'document_type_id': 1}, {'file': file}, retry=True)
+    assert result == {'id': 1}
+    assert stub.calls['POST', 'upload'] == 2
+    for fields in stub.uploads:
+        assert fields == {'document_type_id': b'1', 'file': stub.download[:4096]}
+
+
+async def check_downloads(mayan: AsyncMayan, stub: StubMayan):
+    # Downloads are streamed into the file after its current position, error pages never end up in the file
+    file = io.BytesIO(b'head')
+    file.seek(4)
+    assert await mayan.downloadfile('download', file) is file
+    assert file.getvalue() == b'head' + stub.download
+    assert await mayan.downloadfile('download') == stub.download
+    file = io.BytesIO()
+    try:
+        await mayan.downloadfile('missing', file)
+    except Exception:
+        pass
+    else:
+        raise AssertionError('A failed download has to raise')
+    assert file.getvalue() == b''
+
+
+async def check_concurrency(baseurl: str, stub: StubMayan, concurrency: int, requests: int) -> float:
+    # No more requests than the concurrency limit may reach the server at the same time
+    stub.max_in_flight = 0
+    async with AsyncMayan(baseurl, concurrency=concurrency) as mayan:
+        await mayan.login('benchmark', 'benchmark')
+        start = time.perf_counter()
+        results = await asyncio.gather(*[mayan.get('slow') for _ in range(requests)])
+        elapsed = time.perf_counter() - start
+    assert all(status == 200 for _, status in results)
+    assert stub.max_in_flight == min(concurrency, requests), stub.max_in_flight
+    return elapsed
+
+
+async def run_checks(requests: int = 32):
+    stub = StubMayan()
+    runner = web.AppRunner(stub.create_app())
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    try:
+        host, port = runner.addresses[0][:2]
+        baseurl = 'http://{0}:{1}/api/v4/'.format(host, port)
+        async with AsyncMayan(baseurl, backoff=0) as mayan:
+            await mayan.login('benchmark', 'benchmark')
+            await check_retries(mayan, stub)
+            await check_upload(mayan, stub)
+            await check_downloads(mayan, stub)
+        sequential = await check_concurrency(baseurl, stub, 1, requests)
+        for concurrency in (4, 16):
+            concurrent = await check_concurrency(baseurl, stub, concurrency, requests)
+            print('{0:>3} requests  concurrency {1:>2}: {2:8.4f}s -> {3:8.4f}s ({4:6.1f}x)'.format(
+                requests, concurrency, sequential, concurrent, sequential / concurrent))
+    finally:
+        await runner.cleanup()
+
+
+def run():
+    asyncio.run(run_checks())
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,49 @@
+"""Compare the windowed string matching against the exhaustive word combination search on synthetic pages.
+
+Run from the repository root: python -m benchmarks.matching
+"""
+
+import random
+
+from metadatamagic.analysis.parser import parse_matching_strings
+
+from benchmarks.overlap import create_page, measure
+
+
+def create_searches(page, number_of_searches: int, seed: int) -> list[str]:
+    # Sequences of up to three words taken from the page, some of them with an OCR like typo
+    rng = random.Random(seed)
+    words = page.words
+    searches = []
+    for _ in range(number_of_searches):
+        start = rng.randrange(len(words))
+        search = ' '.join(word.text for word in words[start:start + rng.randint(1, 3)])
+        if rng.random() < 0.5:
+            position = rng.randrange(len(search))
+            search = search[:position] + rng.choice('0Il') + search[position + 1:]
+        searches.append(search)
+    return searches
+
+
+def as_comparable(results) -> list[tuple[list[int], int]]:
+    return [([id(word) for word in words], ratio) for words, ratio in results]
+
+
+def run(sizes=(50, 200, 500), number_of_searches=10):
+    for size in sizes:
+        page = create_page(size, size)
+        searches = create_searches(page, number_of_searches, size)
+
+        exhaustive_time, exhaustive = measure(
+            lambda: [parse_matching_strings(page, search, exhaustive=True) for search in searches], repeat=1)
+        windowed_time, windowed = measure(
+            lambda: [parse_matching_strings(page, search) for search in searches])
+
+        for search, exhaustive_results, windowed_results in zip(searches, exhaustive, windowed):
+            assert as_comparable(exhaustive_results) == as_comparable(windowed_results), search
+        print('{0:>5} words  {1} searches: {2:8.4f}s -> {3:8.4f}s ({4:6.1f}x)'.format(
+            size, len(searches), exhaustive_time, windowed_time, exhaustive_time / windowed_time))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,122 @@
+"""Compare the vectorised PageType overlap engine against the former nested loops on synthetic pages.
+
+Run from the repository root: python -m benchmarks.overlap
+"""
+
+import random
+import time
+
+from metadatamagic.model import Block, Document, Line, Page, Word
+from metadatamagic.model.cluster import PageType
+
+VOCABULARY = ['Rechnung', 'Datum', 'Betrag', 'EUR', 'Kunde', 'Nummer', 'Summe', 'MwSt', 'Netto', 'Brutto',
+              'Position', 'Menge', 'Preis', 'Gesamt', 'Seite', 'GmbH', 'Straße', 'Bank', 'IBAN', 'BIC']
+
+
+def create_page(number_of_words: int, seed: int, jitter: float = 0.002) -> Page:
+    rng = random.Random(seed)
+    document = Document(seed, 'benchmark', {}, None)
+    page = Page(1, 'de', document, (3508, 2480))
+    words_per_line = 10
+    lines_per_block = 5
+    number_of_lines = -(-number_of_words // words_per_line)
+    line_height = 0.9 / number_of_lines
+    word_width = 0.9 / words_per_line
+    created = 0
+    for block_start in range(0, number_of_lines, lines_per_block):
+        block_lines = range(block_start, min(block_start + lines_per_block, number_of_lines))
+        block = Block(page, ((0.05, 0.05 + block_start * line_height),
+                             (0.95, 0.05 + (block_lines[-1] + 1) * line_height)))
+        for line_index in block_lines:
+            top = 0.05 + line_index * line_height
+            line = Line(block, ((0.05, top), (0.95, top + line_height * 0.8)))
+            for word_index in range(words_per_line):
+                if created == number_of_words:
+                    break
+                # The same layout for every seed, only the texts and a little OCR jitter differ
+                text = VOCABULARY[(line_index * words_per_line + word_index) % len(VOCABULARY)]
+                if rng.random() < 0.1:
+                    text = rng.choice(VOCABULARY)
+                left = 0.05 + word_index * word_width + rng.uniform(-jitter, jitter)
+                line.add_word(Word(text, line, ((left, top + rng.uniform(-jitter, jitter)),
+                                                (left + word_width * 0.8, top + line_height * 0.8))))
+                created += 1
+            block.add_line(line)
+        page.add_block(block)
+    return page
+
+
+def legacy_add_page(words: list[Word], page: Page) -> list[Word]:
+    delete = []
+    for word in words:
+        overlap = False
+        for new_word in page.words:
+            if word.text == new_word.text:
+                if word.position.overlaps(new_word.position):
+                    overlap = True
+                    break
+        if not overlap:
+            delete.append(word)
+    return [word for word in words if word not in delete]
+
+
+def legacy_calculate_fit(words: list[Word], page: Page) -> int:
+    matches = 0
+    for new_word in page.words:
+        found_current = False
+        for block in page.blocks:
+            if block.position.overlaps(new_word.position):
+                for line in block.lines:
+                    if line.position.overlaps(new_word.position):
+                        for word in words:
+                            if word.text == new_word.text:
+                                if word.position.overlaps(new_word.position):
+                                    matches += 1
+                                    found_current = True
+                                    break
+                    if found_current:
+                        break
+            if found_current:
+                break
+    return round((matches / len(words)) * 100)
+
+
+def measure(function, repeat: int = 3) -> tuple[float, object]:
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def run(sizes=(100, 500, 2000)):
+    for size in sizes:
+        first = create_page(size, 1)
+        second = create_page(size, 2)
+        third = create_page(size, 3)
+
+        legacy_time, legacy_words = measure(lambda: legacy_add_page(legacy_add_page(first.words, second), third))
+        legacy_fit_time, legacy_fit = measure(lambda: legacy_calculate_fit(legacy_words, first))
+
+        def vectorised_add():
+            page_type = PageType(None)
+            page_type.add_page(first)
+            page_type.add_page(second)
+            page_type.add_page(third)
+            return page_type
+
+        vector_time, page_type = measure(vectorised_add)
+        vector_fit_time, vector_fit = measure(lambda: page_type.calculate_fit(first))
+
+        assert [word.text for word in legacy_words] == list(page_type.word_texts)
+        assert legacy_fit == vector_fit
+        print('{0:>5} words  add_page: {1:8.4f}s -> {2:8.4f}s ({3:6.1f}x)  calculate_fit: {4:8.4f}s -> {5:8.4f}s ({6:6.1f}x)'.format(
+            size, legacy_time, vector_time, legacy_time / vector_time,
+            legacy_fit_time, vector_fit_time, legacy_fit_time / vector_fit_time))
+
+
+if __name__ == '__main__':
+    run()
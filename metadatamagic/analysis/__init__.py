@@ -1,4 +1,7 @@
 """Analysis functions for model objects."""
 
 from .documentanalyser import *
-from .parser import *
\ No newline at end of file
+from .parser import *
+from .predictor import *
+from .pipeline import *
+from .trainer import *
\ No newline at end of file
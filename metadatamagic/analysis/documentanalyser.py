@@ -1,83 +1,220 @@
 import logging
 import os
-import re
 import sys
 
-import matplotlib.pyplot as plt
+from concurrent.futures import Executor, ProcessPoolExecutor
 from datetime import datetime
+from itertools import repeat
+from typing import Any, Callable
 import numpy as np
-import torch
-from doctr.datasets import vocabs
+import pypdfium2 as pdfium
 from doctr.io import DocumentFile
-from doctr.models import crnn_vgg16_bn, ocr_predictor
 from price_parser import Price
 
-from ..io import ADDITIONAL_VOCAB, DEFAULT_LANGUAGE, METADATA
+from ..io import (CLUSTER_INDEX_MAX_CANDIDATES, CLUSTER_INDEX_MIN_SHARE, METADATA, OCR_BATCH_SIZE,
+                  ResultStore, get_result_store)
 from ..model import (Block, BoundingBox, Metadata, DateMetadata, Document, DocumentCluster, DocumentType, Line,
-                     MoneyMetadata, Page, Word, create_page_map)
+                     MetadataCandidate, MoneyMetadata, Page, PageType, PdfFile, Word, find_page_type)
 from .parser import parse_dates, parse_prices, parse_matching_strings
+from .predictor import get_predictor, get_recognition_model
 
-__all__ = ['ocr_document', 'locate_metadata', 'find_best_cluster', 'predict_metadata']
+__all__ = ['ocr_document', 'ocr_documents', 'load_cached_result', 'locate_metadata', 'find_best_cluster', 'predict_metadata']
 
 _logger = logging.getLogger(__name__)
 
-# TODO: Use language settings (FR, EN, DE)
-
+# Pages per task when pages are processed on a process pool
+PAGE_CHUNK_SIZE = 4
 
-def find_recognition_model():
-    model_path = os.path.join('metadatamagic', 'dist', 'models')
-    pattern = re.compile(r'crnn_vgg16_bn_(\d{8}-\d{6}).pt')
-    model_files = [file for file in os.listdir(model_path)
-                   if pattern.fullmatch(file)]
-    file_name = (max(model_files, key=lambda f: datetime.strptime(
-        pattern.match(f)[1], '%Y%m%d-%H%M%S')))
-    return os.path.join(model_path, file_name)
+# TODO: Use language settings (FR, EN, DE)
 
 
 def get_position(geometry):
     return ((geometry[0][0], geometry[0][1]), (geometry[1][0], geometry[1][1]))
 
 
-def ocr_document(document: Document):
+def get_pdf_source(pdf):
+    # doctr opens file backed pdfs by path so that pdfium reads them lazily from disk
+    if isinstance(pdf, PdfFile):
+        return pdf.path
+    return pdf
+
+
+def get_model_name() -> str:
+    model_file = get_recognition_model()
+    return os.path.basename(model_file) if model_file else 'pretrained'
+
 
-    model = crnn_vgg16_bn(
-        pretrained=False, vocab=vocabs.VOCABS['german'] + ADDITIONAL_VOCAB)
+def get_result_cache(predictor, result_store: ResultStore, model_name: str) -> tuple[ResultStore, str]:
+    # Results of an injected predictor are only cached under an explicit model name, they must not be mixed up with
+    # the results of the model on disk
+    if model_name is None:
+        if predictor is not None:
+            if result_store is not None:
+                raise ValueError('Caching the results of an injected predictor requires a model name')
+            return None, None
+        model_name = get_model_name()
+    return result_store if result_store is not None else get_result_store(), model_name
 
-    model_file = find_recognition_model()
-    if model_file:
-        model.load_state_dict(torch.load(model_file))
 
-    predictor = ocr_predictor(
-        reco_arch=model, pretrained=True, detect_language=True)
+def ocr_document(document: Document, predictor=None, result_store: ResultStore = None, model_name: str = None):
+    # Pages may have been loaded from the result store when the document was downloaded
+    if document.pages:
+        return
+    result_store, model_name = get_result_cache(predictor, result_store, model_name)
+    if load_cached_pages(document, result_store, model_name):
+        return
 
-    doc = DocumentFile.from_pdf(document.pdf, scale=4)
+    # The cached predictor is only built once per process (and again when a newer model shows up)
+    if predictor is None:
+        predictor = get_predictor()
+
+    doc = DocumentFile.from_pdf(get_pdf_source(document.pdf), scale=4)
     result = predictor(doc)
     #result.show(doc)
     dictionary = result.export()
 
     for page_dict in dictionary['pages']:
-        dimensions = (page_dict['dimensions'][0], page_dict['dimensions'][1])
-        index = page_dict['page_idx'] + 1
-        language = page_dict['language']['value']
-        if not language:
-            language = 'unknown'
-        page = Page(index, language, document, dimensions)
-        for block_dict in page_dict['blocks']:
-            block_position = get_position(block_dict['geometry'])
-            block = Block(page, block_position)
-            for line_dict in block_dict['lines']:
-                line_position = get_position(line_dict['geometry'])
-                line = Line(block, line_position)
-                for word_dict in line_dict['words']:
-                    word_position = get_position(word_dict['geometry'])
-                    word = Word(word_dict['value'], line, word_position)
-                    line.add_word(word)
-                block.add_line(line)
-            page.add_block(block)
+        page = create_page(page_dict, document, page_dict['page_idx'] + 1)
+        document.pages.append(page)
+    store_pages(document, result_store, model_name)
+
+
+def ocr_documents(documents: list[Document], batch_size: int = OCR_BATCH_SIZE, predictor=None,
+                  result_store: ResultStore = None, model_name: str = None):
+    result_store, model_name = get_result_cache(predictor, result_store, model_name)
+    documents = [document for document in documents
+                 if not document.pages and not load_cached_pages(document, result_store, model_name)]
+    if not documents:
+        return
+
+    if predictor is None:
+        predictor = get_predictor()
+
+    batch = []
+    for document, index, image in render_pages(documents):
+        batch.append((document, index, image))
+        if len(batch) >= batch_size:
+            ocr_page_batch(batch, predictor)
+            batch = []
+    if batch:
+        ocr_page_batch(batch, predictor)
+
+    for document in documents:
+        store_pages(document, result_store, model_name)
+
+
+def load_cached_result(document: Document) -> bool:
+    # Loads the pages of a document from the default result store. Passed to the document loader so that documents
+    # with a cached result are neither downloaded nor optimized.
+    return load_cached_pages(document, get_result_store(), get_model_name())
+
+
+def load_cached_pages(document: Document, result_store: ResultStore, model_name: str) -> bool:
+    if result_store is None or not document.checksum:
+        return False
+    page_dicts = result_store.get(document.checksum, model_name)
+    if page_dicts is None:
+        return False
+    _logger.info('Using cached OCR result for document %s', document.mayan_document_id)
+    for page_dict in page_dicts:
+        document.pages.append(create_page(page_dict, document, page_dict['page_idx'] + 1))
+    return True
+
+
+def store_pages(document: Document, result_store: ResultStore, model_name: str):
+    if result_store is not None and document.checksum:
+        result_store.put(document.checksum, model_name, [page_to_dict(page) for page in document.pages])
+
+
+def render_pages(documents: list[Document]):
+    # Pages are rendered one at a time (DocumentFile.from_pdf renders all pages of a document at once) so that only
+    # the pages of the current batch are held in memory
+    for document in documents:
+        pdf = pdfium.PdfDocument(get_pdf_source(document.pdf))
+        try:
+            for index in range(len(pdf)):
+                page = pdf[index]
+                image, _ = page.render_to(pdfium.BitmapConv.numpy_ndarray, scale=4, rev_byteorder=True)
+                page.close()
+                yield document, index + 1, image
+        finally:
+            pdf.close()
+
+
+def ocr_page_batch(batch: list[tuple[Document, int, np.ndarray]], predictor):
+    result = predictor([image for _, _, image in batch])
+    dictionary = result.export()
+    # Exported pages keep the order of the input images
+    for (document, index, _), page_dict in zip(batch, dictionary['pages']):
+        page = create_page(page_dict, document, index)
         document.pages.append(page)
 
 
-def locate_metadata(document: Document):
+def create_page(page_dict: dict, document: Document, index: int) -> Page:
+    dimensions = (page_dict['dimensions'][0], page_dict['dimensions'][1])
+    language = page_dict['language']['value']
+    if not language:
+        language = 'unknown'
+    page = Page(index, language, document, dimensions)
+    for block_dict in page_dict['blocks']:
+        block_position = get_position(block_dict['geometry'])
+        block = Block(page, block_position)
+        for line_dict in block_dict['lines']:
+            line_position = get_position(line_dict['geometry'])
+            line = Line(block, line_position)
+            for word_dict in line_dict['words']:
+                word_position = get_position(word_dict['geometry'])
+                word = Word(word_dict['value'], line, word_position)
+                line.add_word(word)
+            block.add_line(line)
+        page.add_block(block)
+    page.build_index()
+    return page
+
+
+def get_geometry(position: BoundingBox):
+    return [[float(position.left_top.x), float(position.left_top.y)],
+            [float(position.right_bot.x), float(position.right_bot.y)]]
+
+
+# Inverse of create_page using the structure of the doctr export
+def page_to_dict(page: Page) -> dict:
+    return {
+        'page_idx': page.index - 1,
+        'dimensions': [int(dimension) for dimension in page.dimensions],
+        'language': {'value': page.language},
+        'blocks': [{
+            'geometry': get_geometry(block.position),
+            'lines': [{
+                'geometry': get_geometry(line.position),
+                'words': [{'value': word.text, 'geometry': get_geometry(word.position)} for word in line.words]
+            } for line in block.lines]
+        } for block in page.blocks]
+    }
+
+
+def locate_metadata(document: Document, first_match: bool=False, executor: Executor=None):
+    # Each page is parsed once per parser type and all metadata of that type are matched against the result. With
+    # first_match the search for a metadata stops at the first page it was found on. Pages are located in parallel
+    # when an executor (thread or process pool) is given.
+    metadatas = create_metadata(document)
+    targets = [(metadata.metadata_name, metadata.metadata_type, metadata.metadata_value) for metadata in metadatas]
+    if len(targets) == 0:
+        return
+    if executor is None:
+        for page in document.pages:
+            found = locate_page(page, targets)
+            add_occurrences(metadatas, page, found, first_match)
+            if first_match:
+                targets = [target for target in targets if not found.get(target[0])]
+                if len(targets) == 0:
+                    break
+    else:
+        for page, found in zip(document.pages, map_pages(locate_page, document.pages, (targets,), executor)):
+            add_occurrences(metadatas, page, found, first_match)
+
+def create_metadata(document: Document) -> list[Metadata]:
+    metadatas = []
     for metadata_name, metadata_value in document.mayan_metadata.items():
         if metadata_name in METADATA:
             metadata_type = METADATA[metadata_name]['type']
@@ -85,39 +222,47 @@ def locate_metadata(document: Document):
                 date_format = METADATA[metadata_name]['format']
                 metadata_value_date = datetime.strptime(
                     metadata_value, date_format)
-                metadata = DateMetadata(
-                    metadata_name, metadata_type, metadata_value_date)
-                document.metadata.append(metadata)
-
-                for page in document.pages:
-                    date_tuples = parse_dates(page)
-                    for date_tuple in date_tuples:
-                        date = date_tuple[0]
-                        if date == metadata_value_date:
-                            source_words = date_tuple[1]
-                            position = calculate_position(source_words)
-                            metadata.add_position(page, date_tuple[1], position)
-
+                metadatas.append(DateMetadata(
+                    metadata_name, metadata_type, metadata_value_date))
             if metadata_type == 'money':
                 metadata_value_price = Price.fromstring(metadata_value)
-                metadata = MoneyMetadata(
-                    metadata_name, metadata_type, metadata_value_price)
-                document.metadata.append(metadata)
-                for page in document.pages:
-                    prices = parse_prices(page, metadata_value_price.currency)
-                    for price in prices:
-                        if price[0].amount == metadata_value_price.amount and price[0].currency == metadata_value_price.currency:
-                            position = calculate_position(price[1])
-                            metadata.add_position(page, price[1], position)
-            
+                metadatas.append(MoneyMetadata(
+                    metadata_name, metadata_type, metadata_value_price))
             if metadata_type == 'string':
-                metadata = Metadata(metadata_name, metadata_type, metadata_value)
-                document.metadata.append(metadata)
-                for page in document.pages:
-                    results = parse_matching_strings(page, metadata_value)
-                    for result in results:
-                        position = calculate_position(result[0])
-                        metadata.add_position(page, result[0], position)
+                metadatas.append(Metadata(metadata_name, metadata_type, metadata_value))
+    document.metadata.extend(metadatas)
+    return metadatas
+
+def locate_page(page: Page, targets: list[tuple[str, str, Any]]) -> dict[str, list[list[int]]]:
+    # Word indices of every occurrence of the target values on the page
+    found = {}
+    dates = None
+    prices = {}
+    for metadata_name, metadata_type, metadata_value in targets:
+        if metadata_type == 'date':
+            if dates is None:
+                dates = parse_dates(page)
+            found[metadata_name] = [get_word_indices(words) for date, words in dates if date == metadata_value]
+        if metadata_type == 'money':
+            # The currency is the hint for prices without a currency so prices are parsed once per currency
+            if metadata_value.currency not in prices:
+                prices[metadata_value.currency] = parse_prices(page, metadata_value.currency)
+            found[metadata_name] = [get_word_indices(words) for price, words in prices[metadata_value.currency]
+                                    if price.amount == metadata_value.amount and price.currency == metadata_value.currency]
+        if metadata_type == 'string':
+            found[metadata_name] = [get_word_indices(words) for words, _ in parse_matching_strings(page, metadata_value)]
+    return found
+
+def get_word_indices(words: list[Word]) -> list[int]:
+    return [word.index for word in words]
+
+def add_occurrences(metadatas: list[Metadata], page: Page, found: dict[str, list[list[int]]], first_match: bool=False):
+    for metadata in metadatas:
+        if first_match and metadata.occurrences:
+            continue
+        for word_indices in found.get(metadata.metadata_name, ()):
+            words = [page.get_word(index) for index in word_indices]
+            metadata.add_position(page, words, calculate_position(words))
 
 # TODO: If we have a line break between words we get huge areas
 def calculate_position(words: list[Word]) -> BoundingBox:
@@ -135,62 +280,119 @@ def calculate_position(words: list[Word]) -> BoundingBox:
     return BoundingBox(((l_top_x, l_top_y), (r_bot_x, r_bot_y)))
 
 # TODO: Find a way to better match filled than empty metadata
-def find_best_cluster(document_type: DocumentType, document: Document):
+def get_block_texts(document: Document) -> list[str]:
+    return [' '.join(word.text for word in block.words) for page in document.pages for block in page.blocks]
+
+def find_best_cluster(document_type: DocumentType, document: Document, executor: Executor=None):
     best_match_score = 0
     best_match_cluster = None
-    for cluster in document_type.cluster_map.values():
+    groupby = [meta_key for meta_key, settings in METADATA.items() if settings['groupby']]
+    # Only clusters whose groupby values (or synonyms) share enough trigrams with the document are matched
+    candidate_clusters = document_type.cluster_index.find_candidates(
+        get_block_texts(document), groupby, CLUSTER_INDEX_MIN_SHARE, CLUSTER_INDEX_MAX_CANDIDATES)
+    cluster_strings = {cluster_id: document_type.cluster_index.get_strings(cluster_id, groupby)
+                       for cluster_id in candidate_clusters}
+    search_scores = None
+    if executor is not None:
+        # All pages are matched against every search string at once and the best score per string is kept
+        searches = list(dict.fromkeys(candidate for strings in cluster_strings.values()
+                                      for candidates in strings.values() for candidate in candidates))
+        search_scores = dict.fromkeys(searches, 0)
+        for page_scores in map_pages(match_page, document.pages, (searches,), executor):
+            for search, score in page_scores.items():
+                search_scores[search] = max(search_scores[search], score)
+    for cluster_id in candidate_clusters:
         cluster_scores = {}
-        for meta_key in cluster.metadata.keys():
-            if METADATA[meta_key]['groupby']:
-                if meta_key not in cluster_scores:
-                    cluster_scores[meta_key] = 0
-                stop_search = False
-                candidates = [synonym for synonym, actual in cluster.synonyms.items() if actual == cluster.metadata[meta_key]]
-                candidates.append(cluster.metadata[meta_key])
-                for candidate in candidates:
-                    for page in document.pages:
-                        matches = parse_matching_strings(page, candidate, 1)
-                        if matches and len(matches) == 1:
-                            page_match = matches[0][1]
-                            if page_match > cluster_scores[meta_key]:
-                                cluster_scores[meta_key] = page_match
-                                if page_match == 100:
-                                    stop_search = True
-                                    break
-                    if stop_search:
-                        break
+        for meta_key, candidates in cluster_strings[cluster_id].items():
+            if search_scores is not None:
+                cluster_scores[meta_key] = max(search_scores[candidate] for candidate in candidates)
+                continue
+            cluster_scores[meta_key] = 0
+            stop_search = False
+            for candidate in candidates:
+                for page in document.pages:
+                    matches = parse_matching_strings(page, candidate, 1)
+                    if matches and len(matches) == 1:
+                        page_match = matches[0][1]
+                        if page_match > cluster_scores[meta_key]:
+                            cluster_scores[meta_key] = page_match
+                            if page_match == 100:
+                                stop_search = True
+                                break
+                if stop_search:
+                    break
+        if len(cluster_scores) == 0:
+            continue
         avg_score = sum(cluster_scores.values()) / len(cluster_scores.values())
         if avg_score > best_match_score:
             best_match_score = avg_score
-            best_match_cluster = cluster
-    return best_match_cluster, best_match_score
-
-def predict_metadata(cluster: DocumentCluster, document: Document):
-    temp_dict = cluster.dictionary
-    for word in document.words:
-        if word.text not in temp_dict:
-            temp_dict[word.text] = len(temp_dict) + 1
-    reversed_dict = {key: value for value, key in temp_dict.items()}
-    for page in document.pages:
-        page_type = cluster.get_page_type_for_document_page(page)
-        if page_type:
-            page_map = create_page_map(temp_dict, page)
-            # Use the same logic as for add_document to find best matching page_type
-            plt.imshow(page_type.metadata_map, cmap='hot', interpolation='nearest')
-            plt.imshow(page_map, cmap='hot', interpolation='nearest')
-            metadata_names = np.unique(page_type.metadata_map)
-            for metadata_name in metadata_names:
-                # Only search like this for metadata that is expected at this location
-                if metadata_name > 0:
-                    if not METADATA[reversed_dict[metadata_name]]['groupby']:
-                        mask = np.divide(page_type.metadata_map, page_type.metadata_map, where=page_type.metadata_map == metadata_name)
-                        plt.imshow(mask, cmap='hot', interpolation='nearest')
-                        words, word_counts = np.unique(np.multiply(mask, page_map), return_counts=True)
-                        _logger.warning('Page {0} of document {2} contains the following candidates for metadata {1}:'.format(str(page.index), str(reversed_dict[metadata_name]), str(document.mayan_document_id)))
-                        i = 0
-                        while i < len(words):
-                            if words[i] > 0:
-                                _logger.warning(str(reversed_dict[words[i]]) + ' -> ' + str(word_counts[i]))
-                            i+=1
-                        # Add logic to find floating metadata
+            best_match_cluster = cluster_id
+    if best_match_cluster is None:
+        return None, best_match_score
+    return document_type.get_cluster(best_match_cluster), best_match_score
+
+def match_page(page: Page, searches: list[str]) -> dict[str, int]:
+    # Best match score of every search string on the page
+    scores = {}
+    for search in searches:
+        matches = parse_matching_strings(page, search, 1)
+        scores[search] = matches[0][1] if matches else 0
+    return scores
+
+def predict_metadata(cluster: DocumentCluster, document: Document,
+                     executor: Executor=None) -> dict[str, list[MetadataCandidate]]:
+    # Only search like this for metadata that is expected at this location
+    label_names = {cluster.dictionary[metadata_name]: metadata_name for metadata_name, settings in METADATA.items()
+                   if not settings['groupby'] and metadata_name in cluster.dictionary}
+    candidates = {}
+    for page, page_candidates in zip(document.pages, map_pages(predict_page, document.pages,
+                                                               (cluster.page_types, label_names), executor)):
+        for metadata_name, word_index, score in page_candidates:
+            candidates.setdefault(metadata_name, []).append(
+                MetadataCandidate(metadata_name, page, [page.get_word(word_index)], score))
+    for metadata_name, metadata_candidates in candidates.items():
+        metadata_candidates.sort(key=lambda candidate: candidate.score, reverse=True)
+        _logger.debug('Document %s contains the following candidates for metadata %s: %s',
+                      document.mayan_document_id, metadata_name, metadata_candidates)
+    return candidates
+
+def predict_page(page: Page, page_types: list[PageType], label_names: dict[int, str]) -> list[tuple[str, int, float]]:
+    # (metadata name, word index, score) of all words in the metadata areas of the best matching page type
+    candidates = []
+    # Use the same logic as for add_document to find best matching page_type
+    page_type = find_page_type(page_types, page)
+    if page_type and page_type.metadata_map is not None:
+        for label in page_type.metadata_map.labels_present():
+            metadata_name = label_names.get(int(label))
+            if metadata_name is None:
+                continue
+            for word_index, score in page_type.locate_label(page, label):
+                candidates.append((metadata_name, word_index, score))
+            # Add logic to find floating metadata
+    return candidates
+
+def map_pages(function: Callable, pages: list[Page], args: tuple, executor: Executor=None) -> list:
+    # function(page, *args) for every page in page order. Without an executor the pages are processed inline. Process
+    # pools get the pages in the layout of the OCR result instead of the whole document. Results may only refer to
+    # words by their index.
+    if executor is None:
+        return [function(page, *args) for page in pages]
+    if isinstance(executor, ProcessPoolExecutor):
+        payloads = [get_page_payload(page) for page in pages]
+        return list(executor.map(run_page_payload, payloads, repeat(function), repeat(args),
+                                 chunksize=PAGE_CHUNK_SIZE))
+    return list(executor.map(function, pages, *[repeat(arg) for arg in args]))
+
+def get_page_payload(page: Page):
+    # A page rebuilt from its dict has its words indexed in block, line, word order. Pages with a different order are
+    # sent as they are.
+    if all(word.index == index for index, word in enumerate(word for block in page.blocks for line in block.lines
+                                                            for word in line.words)):
+        return page_to_dict(page)
+    return page
 
+def run_page_payload(payload, function: Callable, args: tuple):
+    if isinstance(payload, dict):
+        # The page only needs a document to attach its elements to
+        payload = create_page(payload, Document(None, None, {}, None), payload['page_idx'] + 1)
+    return function(payload, *args)
@@ -1,9 +1,17 @@
+import functools
 import logging
+import math
+import re
 
+import numpy as np
 from babel import Locale
+from babel.numbers import get_decimal_symbol
 from dateparser.date import DateDataParser
 from thefuzz import fuzz
 from price_parser import Price
+from price_parser.parser import extract_currency_symbol, extract_price_text, parse_number
+from rapidfuzz import fuzz as rapid_fuzz
+from rapidfuzz import process
 
 from ..io import DEFAULT_LANGUAGE, MIN_CONFIDENCE
 from ..model import Page, Word
@@ -12,48 +20,173 @@ __all__ = ['parse_dates', 'parse_prices', 'parse_matching_strings']
 
 _logger = logging.getLogger(__name__)
 
+# Word combinations have to score higher than this to match a search string
+MATCH_THRESHOLD = MIN_CONFIDENCE * 0.8
+# The combined score can never be higher than the ratio so lower ratios can be skipped
+MIN_MATCH_RATIO = math.floor(MATCH_THRESHOLD) + 1
+
 DATE_PARSER_SETTINGS = {'PREFER_DAY_OF_MONTH': 'first',
                         'PREFER_DATES_FROM': 'past', 'REQUIRE_PARTS': ['month', 'year']}
+# Parsed dates (or None) per parser and text. The cache is cleared when it reaches this size.
+DATE_RESULT_CACHE_SIZE = 100000
+# Parsed prices per currency, separators and text. The cache is cleared when it reaches this size.
+PRICE_RESULT_CACHE_SIZE = 100000
+
+DIGIT = re.compile(r'\d')
+
+_date_results = {}
+_price_results = {}
 
 
 def parse_dates(page: Page):
     dates = []
     parser = get_date_parser(page.language, DEFAULT_LANGUAGE)
+    results = _date_results.setdefault(id(parser), {})
     combinations = create_word_combinations(page.words, max_length=3)
     for combination in combinations:
         text = ' '.join([word.text for word in combination])
         # Compensate common OCR errors
         text = text.replace('O', '0')
-        try:
-            date = parser.get_date_data(text)
-            if date.date_obj is not None:
-                dates.append((date.date_obj, combination))
-        except Exception as e:
-            logging.warning(
-                'Failed to parse date for text {0}: {1}'.format(text, e))
+        # Dates need a year so texts without any digit are skipped
+        if not DIGIT.search(text):
+            continue
+        if text in results:
+            date_obj = results[text]
+        else:
+            date_obj = None
+            try:
+                date_obj = parser.get_date_data(text).date_obj
+            except Exception as e:
+                logging.warning(
+                    'Failed to parse date for text {0}: {1}'.format(text, e))
+            if len(results) >= DATE_RESULT_CACHE_SIZE:
+                results.clear()
+            results[text] = date_obj
+        if date_obj is not None:
+            dates.append((date_obj, combination))
     return dates
 
 
 def parse_prices(page: Page, currency: str):
     prices = []
     separators = get_decimal_separators(page.language, DEFAULT_LANGUAGE)
-    for word in page.words:
-        for sep in separators:
-            price = Price.fromstring(
-                word.text, currency_hint=currency, decimal_separator=sep)
-            if price.amount and price.currency:
-                prices.append((price, [word]))
+    words = page.words
+    text_prices = extract_prices([word.text for word in words], currency, separators)
+    for word in words:
+        for price in text_prices.get(word.text, ()):
+            prices.append((price, [word]))
     return prices
 
 
-def parse_matching_strings(page: Page, search: str, limit: int=None):
+def extract_prices(texts: list[str], currency: str, separators: frozenset[str]) -> dict[str, list[Price]]:
+    # Prices of every distinct text. Texts without a digit can not have an amount and are skipped. Other texts
+    # are parsed once for all pages: this does the same as Price.fromstring for each separator but finds the
+    # currency and the amount text only once per text since neither depends on the separator.
+    results = _price_results.setdefault((currency, separators), {})
+    prices = {}
+    for text in set(texts):
+        if text not in results:
+            if len(results) >= PRICE_RESULT_CACHE_SIZE:
+                results.clear()
+            results[text] = parse_price_text(text, currency, separators)
+        if results[text]:
+            prices[text] = results[text]
+    return prices
+
+
+def parse_price_text(text: str, currency: str, separators: frozenset[str]) -> list[Price]:
+    if not DIGIT.search(text):
+        return []
+    text_currency = extract_currency_symbol(text, currency)
+    if not text_currency or not text_currency.strip():
+        return []
+    text_currency = text_currency.strip()
+    amount_text = extract_price_text(text)
+    if amount_text is None:
+        return []
+    text_prices = []
+    for sep in separators:
+        amount = parse_number(amount_text, sep)
+        if amount:
+            text_prices.append(Price(amount=amount, currency=text_currency, amount_text=amount_text))
+    return text_prices
+
+
+def parse_matching_strings(page: Page, search: str, limit: int=None, exhaustive: bool=False):
+    if exhaustive:
+        return parse_matching_strings_exhaustive(page, search, limit)
+    results = []
+    search_low = search.lower()
+    min_length, max_length = get_window_bounds(len(search_low))
+    for block in page.blocks:
+        words = block.words
+        block_results = find_matching_windows(search_low, [word.text for word in words], min_length, max_length)
+        for start, end, combo_ratio in suppress_overlapping_windows(block_results, len(words)):
+            results.append((words[start:end + 1], combo_ratio))
+    if len(results) > 0:
+        results_sorted = sorted(results, key = lambda x: x[1], reverse=True)
+        if limit and len(results) > limit:
+            return results_sorted[:limit]
+        return results_sorted
+    return results
+
+
+def get_window_bounds(search_length: int) -> tuple[int, int]:
+    # The ratio is 2 * matches / (search length + text length) and there can not be more matches than characters in
+    # the shorter text. Texts out of these bounds can never reach MIN_MATCH_RATIO (after rounding).
+    factor = 200 / (MIN_MATCH_RATIO - 0.5) - 1
+    return math.ceil(search_length / factor - 1e-9), math.floor(search_length * factor + 1e-9)
+
+
+def find_matching_windows(search_low: str, texts: list[str], min_length: int, max_length: int) -> list[tuple[int, int, int]]:
+    # Scores all contiguous word sequences (start, end) whose text length is within the bounds in one batch
+    windows = []
+    window_texts = []
+    for start in range(len(texts)):
+        for end in range(start, len(texts)):
+            text = ' '.join(texts[start:end + 1]).lower()
+            # Texts only get longer from here
+            if len(text) > max_length:
+                break
+            if len(text) >= min_length:
+                windows.append((start, end))
+                window_texts.append(text)
+    results = []
+    if len(windows) == 0:
+        return results
+    ratios = process.cdist([search_low], window_texts, scorer=rapid_fuzz.ratio, dtype=np.float64)[0]
+    for (start, end), text, ratio in zip(windows, window_texts, ratios):
+        # Same rounding as thefuzz
+        ratio = int(round(ratio))
+        if ratio < MIN_MATCH_RATIO:
+            continue
+        partial_ratio = int(round(rapid_fuzz.partial_ratio(search_low, text)))
+        combo_ratio = round((ratio * partial_ratio) / 100)
+        if combo_ratio > MATCH_THRESHOLD:
+            results.append((start, end, combo_ratio))
+    # Order of the exhaustive search: by end, the single word first and then by start
+    results.sort(key=lambda result: (result[1], result[0] != result[1], result[0]))
+    return results
+
+
+def suppress_overlapping_windows(windows: list[tuple[int, int, int]], length: int) -> list[tuple[int, int, int]]:
+    # Drops windows that share a word with a better scoring window
+    best = [0] * length
+    for start, end, score in windows:
+        for i in range(start, end + 1):
+            if score > best[i]:
+                best[i] = score
+    return [(start, end, score) for start, end, score in windows if max(best[start:end + 1]) <= score]
+
+
+def parse_matching_strings_exhaustive(page: Page, search: str, limit: int=None):
     results = []
     for block in page.blocks:
         block_results = []
         combos = create_word_combinations(block.words, len(block.words))
         for combo in combos:
             _, _, combo_ratio = match_score(search, combo)
-            if combo_ratio > MIN_CONFIDENCE * 0.8:
+            if combo_ratio > MATCH_THRESHOLD:
                 block_results.append((combo, combo_ratio))
         for result_tuple in block_results:
             if not has_better_match(result_tuple, block_results):
@@ -112,6 +245,7 @@ def create_word_combinations(words: list[Word], max_length=1) -> list[Word]:
     return result
 
 
+@functools.lru_cache(maxsize=None)
 def get_date_parser(language: str = None, fallback_language: str = None) -> DateDataParser:
     if language is None:
         if fallback_language is not None:
@@ -139,15 +273,16 @@ def get_date_parser(language: str = None, fallback_language: str = None) -> Date
                 return get_date_parser(language=fallback_language)
 
 
-def get_decimal_separators(language: str = None, fallback_language: str = None) -> str:
+@functools.lru_cache(maxsize=None)
+def get_decimal_separators(language: str = None, fallback_language: str = None) -> frozenset[str]:
     try:
-        locale = Locale(language)
+        # Newer Babel versions key number_symbols by numbering system first
         decimal = {'.'}
-        decimal.update(locale.number_symbols['decimal'])
-        return decimal
+        decimal.update(get_decimal_symbol(Locale(language)))
+        return frozenset(decimal)
     except Exception as e:
         _logger.warning('Language {0} is not supported'.format(language))
         if language == fallback_language:
-            return {'.'}
+            return frozenset({'.'})
         else:
             return get_decimal_separators(language=fallback_language)
@@ -0,0 +1,211 @@
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+from ..io import ModelStore, download_document, get_model_store, load_document_cluster, optimize_document
+from ..model import Document, DocumentType
+from .documentanalyser import load_cached_result, locate_metadata, ocr_document
+
+__all__ = ['Pipeline', 'StageReport', 'train_document']
+
+_logger = logging.getLogger(__name__)
+
+# Marks the end of a stage input. Every worker consumes exactly one.
+_STOP = None
+
+
+def train_document(document_type: DocumentType, document: Document):
+    cluster = document_type.get_document_cluster(document.mayan_metadata)
+    # Clusters of document types from a ModelStore load their components on demand
+    if cluster.dictionary is None:
+        load_document_cluster(cluster)
+    cluster.add_document(document)
+    return cluster
+
+
+def _download(document_id):
+    return download_document(document_id, load_pages=load_cached_result)
+
+
+def _ocr(document: Document):
+    try:
+        ocr_document(document)
+    finally:
+        # Later stages only need the recognized pages
+        document.release_pdf()
+    return document
+
+
+def _locate(document: Document):
+    locate_metadata(document)
+    return document
+
+
+def _run_worker(name: str, function, in_queue, out_queue, stats_queue):
+    items = 0
+    errors = 0
+    busy = 0.0
+    while True:
+        item = in_queue.get()
+        if item is _STOP:
+            break
+        start = time.perf_counter()
+        try:
+            result = function(item)
+        except Exception as e:
+            _logger.exception('Stage {0} failed to process item: {1}'.format(name, e))
+            result = None
+            errors += 1
+        busy += time.perf_counter() - start
+        items += 1
+        if result is not None and out_queue is not None:
+            # Blocks while the next stage is saturated (backpressure)
+            out_queue.put(result)
+    stats_queue.put((name, items, errors, busy))
+
+
+def _run_cluster_writer(name: str, in_queue, stats_queue, save_interval: int):
+    # The only process that owns (and writes) model state
+    store = get_model_store()
+    dirty = {}
+    items = 0
+    errors = 0
+    busy = 0.0
+    while True:
+        document = in_queue.get()
+        if document is _STOP:
+            break
+        start = time.perf_counter()
+        try:
+            document_type = store.get_document_type(document.mayan_document_type)
+            cluster = train_document(document_type, document)
+            dirty[cluster.cluster_id] = cluster
+        except Exception as e:
+            _logger.exception('Stage {0} failed to process document {1}: {2}'.format(
+                name, document.mayan_document_id, e))
+            errors += 1
+        items += 1
+        if save_interval and len(dirty) > 0 and items % save_interval == 0:
+            _save_models(store, dirty)
+        busy += time.perf_counter() - start
+    start = time.perf_counter()
+    _save_models(store, dirty)
+    busy += time.perf_counter() - start
+    stats_queue.put((name, items, errors, busy))
+
+
+def _save_models(store: ModelStore, dirty: dict):
+    if len(dirty) > 0:
+        store.save()
+    dirty.clear()
+
+
+class StageReport:
+
+    def __init__(self, name: str, workers: int, items: int, errors: int, busy: float, elapsed: float) -> None:
+        self.name = name
+        self.workers = workers
+        self.items = items
+        self.errors = errors
+        # Summed processing time of all workers of the stage
+        self.busy = busy
+        # Wall clock time from pipeline start until the stage drained
+        self.elapsed = elapsed
+
+    @property
+    def throughput(self) -> float:
+        return self.items / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def utilization(self) -> float:
+        return self.busy / (self.elapsed * self.workers) if self.elapsed > 0 else 0.0
+
+    def __repr__(self):
+        return '{0}: {1} items ({2} errors) with {3} workers, {4:.2f} items/s, {5:.0%} utilization'.format(
+            self.name, self.items, self.errors, self.workers, self.throughput, self.utilization)
+
+    __str__ = __repr__
+
+
+class Pipeline:
+
+    def __init__(self, workers: dict[str, int] = None, queue_size: int = 8, save_interval: int = 100,
+                 context: str = None) -> None:
+        cpus = os.cpu_count() or 1
+        self.workers = {'download': 8, 'optimize': max(1, cpus // 4), 'ocr': cpus, 'locate': max(1, cpus // 4)}
+        if workers:
+            self.workers.update(workers)
+        # Maximum number of items waiting in front of each stage
+        self.queue_size = queue_size
+        # Number of documents after which the cluster writer persists the models (0 saves at the end only)
+        self.save_interval = save_interval
+        self.context = multiprocessing.get_context(context)
+
+    def run(self, document_ids) -> list[StageReport]:
+        ctx = self.context
+        stats_queue = ctx.Queue()
+        id_queue = ctx.Queue(maxsize=self.queue_size)
+        downloaded_queue = ctx.Queue(maxsize=self.queue_size)
+        optimized_queue = ctx.Queue(maxsize=self.queue_size)
+        recognized_queue = ctx.Queue(maxsize=self.queue_size)
+        located_queue = ctx.Queue(maxsize=self.queue_size)
+
+        # Network bound downloads run in threads, CPU bound stages in processes
+        stages = [
+            ('download', [threading.Thread(target=_run_worker, daemon=True,
+                                           args=('download', _download, id_queue, downloaded_queue, stats_queue))
+                          for _ in range(self.workers['download'])], id_queue),
+            ('optimize', [ctx.Process(target=_run_worker,
+                                      args=('optimize', optimize_document, downloaded_queue, optimized_queue, stats_queue))
+                          for _ in range(self.workers['optimize'])], downloaded_queue),
+            ('ocr', [ctx.Process(target=_run_worker,
+                                 args=('ocr', _ocr, optimized_queue, recognized_queue, stats_queue))
+                     for _ in range(self.workers['ocr'])], optimized_queue),
+            ('locate', [ctx.Process(target=_run_worker,
+                                    args=('locate', _locate, recognized_queue, located_queue, stats_queue))
+                        for _ in range(self.workers['locate'])], recognized_queue),
+            ('cluster', [ctx.Process(target=_run_cluster_writer,
+                                     args=('cluster', located_queue, stats_queue, self.save_interval))],
+             located_queue),
+        ]
+
+        start = time.perf_counter()
+        # Fork the worker processes before any download thread is running
+        for _, workers, _ in reversed(stages):
+            for worker in workers:
+                worker.start()
+
+        for document_id in document_ids:
+            id_queue.put(document_id)
+
+        # Drain the stages in order so that every stage sees all items of its predecessor
+        elapsed = {}
+        for name, workers, in_queue in stages:
+            for _ in workers:
+                in_queue.put(_STOP)
+            for worker in workers:
+                worker.join()
+            elapsed[name] = time.perf_counter() - start
+
+        totals = {}
+        for _ in range(sum(len(workers) for _, workers, _ in stages)):
+            try:
+                name, items, errors, busy = stats_queue.get(timeout=10)
+            except queue.Empty:
+                _logger.warning('Missing throughput statistics from a pipeline worker')
+                break
+            total = totals.setdefault(name, [0, 0, 0.0])
+            total[0] += items
+            total[1] += errors
+            total[2] += busy
+
+        reports = []
+        for name, workers, _ in stages:
+            items, errors, busy = totals.get(name, (0, 0, 0.0))
+            report = StageReport(name, len(workers), items, errors, busy, elapsed[name])
+            _logger.info('Pipeline stage %s', report)
+            reports.append(report)
+        return reports
@@ -0,0 +1,82 @@
+import logging
+import os
+import re
+import threading
+
+import torch
+from doctr.datasets import vocabs
+from doctr.models import crnn_vgg16_bn, ocr_predictor
+
+from ..io import ADDITIONAL_VOCAB
+
+__all__ = ['get_predictor', 'get_recognition_model', 'clear_predictors']
+
+_logger = logging.getLogger(__name__)
+
+MODEL_PATH = os.path.join('metadatamagic', 'dist', 'models')
+MODEL_PATTERN = re.compile(r'crnn_vgg16_bn_(\d{8}-\d{6}).pt')
+DEFAULT_VOCAB = vocabs.VOCABS['german'] + ADDITIONAL_VOCAB
+
+# Process wide cache of predictors keyed by (model file, vocab)
+_predictors = {}
+_predictors_lock = threading.Lock()
+# Last directory scan per model path: model path -> (directory mtime, model file)
+_model_scans = {}
+
+
+def find_recognition_model(model_path: str = MODEL_PATH) -> str:
+    try:
+        model_files = [file for file in os.listdir(model_path)
+                       if MODEL_PATTERN.fullmatch(file)]
+    except FileNotFoundError:
+        return None
+    if not model_files:
+        return None
+    # Timestamps are formatted as %Y%m%d-%H%M%S so they sort chronologically as plain strings
+    file_name = max(model_files, key=lambda f: MODEL_PATTERN.match(f)[1])
+    return os.path.join(model_path, file_name)
+
+
+def get_recognition_model(model_path: str = MODEL_PATH) -> str:
+    # Adding a new model file changes the directory mtime so we only rescan when that happens
+    try:
+        mtime = os.stat(model_path).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+    scan = _model_scans.get(model_path)
+    if scan is None or scan[0] != mtime:
+        scan = (mtime, find_recognition_model(model_path))
+        _model_scans[model_path] = scan
+    return scan[1]
+
+
+def create_predictor(model_file: str = None, vocab: str = DEFAULT_VOCAB):
+    _logger.info('Creating OCR predictor with recognition model %s', model_file)
+    model = crnn_vgg16_bn(pretrained=False, vocab=vocab)
+    if model_file:
+        model.load_state_dict(torch.load(model_file))
+    return ocr_predictor(reco_arch=model, pretrained=True, detect_language=True)
+
+
+def get_predictor(vocab: str = DEFAULT_VOCAB, model_path: str = MODEL_PATH):
+    model_file = get_recognition_model(model_path)
+    key = (model_file, vocab)
+    predictor = _predictors.get(key)
+    if predictor is not None:
+        return predictor
+    with _predictors_lock:
+        predictor = _predictors.get(key)
+        if predictor is None:
+            # A newer model showed up: drop the outdated predictors for this vocab
+            for stale_key in [k for k in _predictors if k[1] == vocab]:
+                _logger.info('Discarding OCR predictor for outdated model %s', stale_key[0])
+                del _predictors[stale_key]
+            predictor = create_predictor(model_file, vocab)
+            _predictors[key] = predictor
+    return predictor
+
+
+def clear_predictors():
+    with _predictors_lock:
+        _predictors.clear()
+        _model_scans.clear()
@@ -0,0 +1,179 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from ..io import TRAINING_CHECKPOINT_LOCATION, get_model_store, list_documents, load_document, write_atomic
+from ..model.cluster import get_cluster_id
+from .documentanalyser import load_cached_result, locate_metadata, ocr_documents
+from .pipeline import train_document
+
+__all__ = ['BatchTrainer', 'group_documents', 'train_cluster']
+
+_logger = logging.getLogger(__name__)
+
+# Documents that are downloaded ahead and recognized together
+DOCUMENT_BATCH_SIZE = 4
+# Trained documents after which the changes of a cluster are appended to its log instead of being kept in memory
+SAVE_INTERVAL = 100
+CHECKPOINT_VERSION = 1
+
+
+def group_documents(mayan_document_type: str, documents) -> dict[str, list]:
+    # Ids of the (document id, metadata) pairs by the cluster they are trained into
+    clusters = {}
+    for document_id, metadata in documents:
+        clusters.setdefault(get_cluster_id(mayan_document_type, metadata), []).append(document_id)
+    return clusters
+
+
+def load_documents(document_ids: list):
+    # Batches of (document id, document or None) where the next batch is downloaded while the current one is processed
+    batches = [document_ids[i:i + DOCUMENT_BATCH_SIZE] for i in range(0, len(document_ids), DOCUMENT_BATCH_SIZE)]
+    with ThreadPoolExecutor(max_workers=DOCUMENT_BATCH_SIZE) as executor:
+        pending = [executor.submit(load_document, document_id, load_cached_result)
+                   for document_id in batches[0]] if batches else []
+        for i, batch in enumerate(batches):
+            current = pending
+            if i + 1 < len(batches):
+                pending = [executor.submit(load_document, document_id, load_cached_result)
+                           for document_id in batches[i + 1]]
+            documents = []
+            for document_id, future in zip(batch, current):
+                try:
+                    documents.append((document_id, future.result()))
+                except Exception as e:
+                    _logger.exception('Could not load document {0}: {1}'.format(document_id, e))
+                    documents.append((document_id, None))
+            yield documents
+
+
+def train_cluster(mayan_document_type: str, cluster_id: str, document_ids: list) -> tuple[str, int, int, float]:
+    # Trains the documents of a cluster in this process. Changes are appended to the log every SAVE_INTERVAL
+    # documents and the model files are compacted once at the end. Returns the cluster id, the number of trained and
+    # failed documents and the elapsed time.
+    start = time.perf_counter()
+    store = get_model_store()
+    document_type = store.get_document_type(mayan_document_type)
+    trained = 0
+    errors = 0
+    # Documents whose metadata changed since they were listed end up in other clusters
+    clusters = {}
+    for batch in load_documents(document_ids):
+        loaded = [document for _, document in batch if document is not None]
+        errors += len(batch) - len(loaded)
+        documents = loaded
+        try:
+            ocr_documents(loaded)
+        except Exception as e:
+            _logger.exception('Could not recognize documents {0}: {1}'.format(
+                [document.mayan_document_id for document in loaded], e))
+            errors += len(loaded)
+            documents = []
+        finally:
+            # Training only needs the recognized pages
+            for document in loaded:
+                document.release_pdf()
+        for document in documents:
+            try:
+                locate_metadata(document)
+                cluster = train_document(document_type, document)
+                clusters[cluster.cluster_id] = cluster
+                trained += 1
+            except Exception as e:
+                _logger.exception('Could not train document {0}: {1}'.format(document.mayan_document_id, e))
+                errors += 1
+                continue
+            if trained % SAVE_INTERVAL == 0:
+                for cluster in clusters.values():
+                    store.save_cluster(cluster, compact=False)
+    for cluster in clusters.values():
+        # A bulk build ends with fresh model files instead of a log of all of its documents
+        store.save_cluster(cluster, compact=True)
+        store.unload_cluster(cluster)
+    store.save_document_type(document_type)
+    return cluster_id, trained, errors, time.perf_counter() - start
+
+
+class BatchTrainer:
+
+    # Trains all clusters of a document type from its documents in Mayan. The documents are listed and grouped by
+    # cluster once, then the clusters are trained in parallel processes (largest first, every cluster in a single
+    # process). Finished clusters are recorded in a checkpoint so an interrupted run continues with the remaining ones.
+    def __init__(self, processes: int = None, checkpoint_location: str = TRAINING_CHECKPOINT_LOCATION,
+                 context: str = None) -> None:
+        self.processes = processes or os.cpu_count() or 1
+        self.checkpoint_location = checkpoint_location
+        self.context = multiprocessing.get_context(context)
+
+    def get_checkpoint_path(self, mayan_document_type: str) -> str:
+        return os.path.join(self.checkpoint_location, mayan_document_type + '.json')
+
+    def load_checkpoint(self, mayan_document_type: str) -> dict:
+        path = self.get_checkpoint_path(mayan_document_type)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            checkpoint = json.load(f)
+        if checkpoint.get('version', 0) > CHECKPOINT_VERSION:
+            raise ValueError('{0} has the unsupported checkpoint version {1}'.format(path, checkpoint['version']))
+        return checkpoint
+
+    def save_checkpoint(self, mayan_document_type: str, checkpoint: dict):
+        data = json.dumps(checkpoint, ensure_ascii=False).encode('utf-8')
+        write_atomic(self.get_checkpoint_path(mayan_document_type), lambda f: f.write(data))
+
+    def run(self, mayan_document_type: str, resume: bool = True) -> dict[str, int]:
+        checkpoint = self.load_checkpoint(mayan_document_type) if resume else None
+        if checkpoint is None:
+            _logger.info('Listing the documents of document type {0}'.format(mayan_document_type))
+            checkpoint = {'version': CHECKPOINT_VERSION, 'document_type': mayan_document_type,
+                          'clusters': group_documents(mayan_document_type, list_documents(mayan_document_type)),
+                          'done': {}}
+            self.save_checkpoint(mayan_document_type, checkpoint)
+        clusters = checkpoint['clusters']
+        done = checkpoint['done']
+        pending = sorted((cluster_id for cluster_id in clusters if cluster_id not in done),
+                         key=lambda cluster_id: len(clusters[cluster_id]), reverse=True)
+        _logger.info('Training {0} of {1} clusters ({2} documents) of document type {3} with {4} processes'.format(
+            len(pending), len(clusters), sum(len(clusters[cluster_id]) for cluster_id in pending), mayan_document_type,
+            self.processes))
+        failed = 0
+        if pending:
+            processes = min(self.processes, len(pending))
+            with ProcessPoolExecutor(max_workers=processes, mp_context=self.context) as executor:
+                futures = {executor.submit(train_cluster, mayan_document_type, cluster_id, clusters[cluster_id]):
+                           cluster_id for cluster_id in pending}
+                for future in as_completed(futures):
+                    try:
+                        cluster_id, trained, errors, elapsed = future.result()
+                    except Exception as e:
+                        # The cluster is trained again when the run is resumed
+                        _logger.exception('Could not train cluster {0}: {1}'.format(futures[future], e))
+                        failed += 1
+                        continue
+                    done[cluster_id] = {'documents': trained, 'errors': errors}
+                    self.save_checkpoint(mayan_document_type, checkpoint)
+                    _logger.info('Trained cluster {0} from {1} documents ({2} errors) in {3:.0f}s, {4} of {5} '
+                                 'clusters done'.format(cluster_id, trained, errors, elapsed, len(done), len(clusters)))
+        return {'clusters': len(clusters), 'done': len(done), 'failed': failed,
+                'documents': sum(result['documents'] for result in done.values()),
+                'errors': sum(result['errors'] for result in done.values())}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Train the clusters of a document type from all of its documents')
+    parser.add_argument('document_type', help='label of the Mayan document type')
+    parser.add_argument('--processes', type=int, default=None, help='number of clusters trained in parallel')
+    parser.add_argument('--checkpoint-location', default=TRAINING_CHECKPOINT_LOCATION)
+    parser.add_argument('--restart', action='store_true', help='list the documents again and ignore finished clusters')
+    args = parser.parse_args()
+    trainer = BatchTrainer(args.processes, args.checkpoint_location)
+    print(trainer.run(args.document_type, resume=not args.restart))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,5 @@
 """A package for handling requests against Mayan EDMS api."""
 
-from .mayan import *
\ No newline at end of file
+from .mayan import *
+from .catalogue import *
+from .asyncmayan import *
\ No newline at end of file
@@ -0,0 +1,212 @@
+import asyncio
+import json
+import logging
+import math
+from json import JSONDecodeError
+from typing import Union
+from urllib.parse import parse_qsl, urlsplit
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from .mayan import DOWNLOAD_CHUNK_SIZE, Endpoint, page_url
+
+__all__ = ['AsyncMayan']
+
+_logger = logging.getLogger(__name__)
+
+# Number of requests that may be in flight at the same time
+DEFAULT_CONCURRENCY = 32
+DEFAULT_RETRIES = 3
+# Seconds to wait before the first retry. Doubles with every further attempt.
+DEFAULT_BACKOFF = 0.5
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+# Methods that are retried by default. Mayan may have processed a failed POST or PUT already.
+RETRY_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+
+
+class AsyncMayan(object):
+    def __init__(self, baseurl, test=False, concurrency=DEFAULT_CONCURRENCY, retries=DEFAULT_RETRIES,
+                 backoff=DEFAULT_BACKOFF):
+        if aiohttp is None:
+            raise Exception('The async Mayan client requires aiohttp (pip install metadatamagic[async])')
+        self.test = test
+        self.baseurl = baseurl
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.session = None
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    def ep(self, endpoint: str, *, params: dict = {}, base: str = None):
+        if base is None:
+            base = self.baseurl
+        return Endpoint(endpoint, params=params, base=base)
+
+    def _endpoint(self, endpoint: Union[str, Endpoint]):
+        # Absolute urls (e.g. download urls returned by the api) are used as they are
+        if isinstance(endpoint, str) and "://" not in endpoint:
+            return self.ep(endpoint)
+        return endpoint
+
+    async def login(self, username, password):
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        self.session = aiohttp.ClientSession(connector=connector)
+        auth_data = {"username": username, "password": password}
+        status, _, content = await self._request(
+            "POST", self.ep("auth/token/obtain", params={"format": "json"}), data=auth_data,
+            auth=aiohttp.BasicAuth(username, password))
+        _logger.debug("Login returned status: %s", status)
+        if status != 200:
+            raise Exception("Login Failed")
+        token = json.loads(content)["token"]
+        # aiohttp sets the content type per request (json or multipart)
+        self.session.headers.update({
+            "Accept": "application/json",
+            "Authorization": f"Token {token}",
+        })
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def _request(self, method: str, endpoint: Union[str, Endpoint], *, retry: bool = None, create_data=None,
+                       read=None, **kwargs):
+        # create_data builds the request body for every attempt (aiohttp can not send a form twice), read consumes
+        # the response of the final attempt (the whole body by default)
+        url = str(endpoint)
+        retries = self.retries if (method in RETRY_METHODS if retry is None else retry) else 0
+        attempt = 0
+        while True:
+            if create_data is not None:
+                kwargs['data'] = create_data()
+            try:
+                async with self._semaphore:
+                    async with self.session.request(method, url, **kwargs) as response:
+                        if response.status not in RETRY_STATUS_CODES or attempt >= retries:
+                            content = await read(response) if read is not None else await response.read()
+                            return response.status, response.headers, content
+                        _logger.debug("Request %s %s returned %s", method, url, response.status)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt >= retries:
+                    raise
+                _logger.debug("Request %s %s failed: %s", method, url, e)
+            delay = self.backoff * (2 ** attempt)
+            attempt += 1
+            _logger.info("Retrying %s %s in %.1fs (attempt %s)", method, url, delay, attempt)
+            await asyncio.sleep(delay)
+
+    async def _json(self, method: str, endpoint: Union[str, Endpoint], **kwargs):
+        status, _, content = await self._request(method, endpoint, **kwargs)
+        try:
+            return json.loads(content), status
+        except JSONDecodeError:
+            return {}, status
+
+    async def all(self, endpoint: Union[str, Endpoint]):
+        if isinstance(endpoint, str):
+            endpoint = self.ep(endpoint)
+        page, _ = await self._json("GET", endpoint)
+        results = list(page["results"])
+        if page["next"] != None and page.get("count") and len(page["results"]) > 0:
+            # Request all remaining pages at once, bounded by the concurrency limit
+            page_count = math.ceil(page["count"] / len(page["results"]))
+            first_index = int(dict(parse_qsl(urlsplit(page["next"]).query)).get("page", 2))
+            pages = await asyncio.gather(*[self._json("GET", page_url(page["next"], index))
+                                           for index in range(first_index, page_count + 1)])
+            for next_page, _ in pages:
+                results += next_page["results"]
+            return results
+        while page["next"] != None:
+            page, _ = await self._json("GET", self.ep(page["next"]))
+            results += page["results"]
+        return results
+
+    async def first(self, endpoint: Union[str, Endpoint]):
+        page, _ = await self.get(endpoint)
+        return page["results"]
+
+    async def get(self, endpoint: Union[str, Endpoint]):
+        endpoint = self._endpoint(endpoint)
+        result, status = await self._json("GET", endpoint)
+        if status != 200:
+            _logger.warning(json.dumps(result, indent=2))
+        return result, status
+
+    async def post(self, endpoint: Union[str, Endpoint], json_data):
+        endpoint = self._endpoint(endpoint)
+        if self.test:
+            print("WOULD POST", str(endpoint), json.dumps(json_data, indent=2))
+            return {}
+        result, status = await self._json("POST", endpoint, json=json_data)
+        if status not in [200, 201]:
+            _logger.warning(json.dumps(result, indent=2))
+        return result
+
+    async def uploadfile(self, endpoint: Union[str, Endpoint], json_data, file_data, retry=False):
+        # Uploads are only retried on request since a failed attempt may still have created the document
+        endpoint = self._endpoint(endpoint)
+        if self.test:
+            print("WOULD POST", str(endpoint), json.dumps(json_data, indent=2))
+            return {}
+        positions = {key: value.tell() for key, value in file_data.items() if hasattr(value, "seek")}
+
+        def create_form():
+            form = aiohttp.FormData()
+            for key, value in json_data.items():
+                form.add_field(key, str(value))
+            for key, value in file_data.items():
+                # File objects are sent again from where the first attempt started
+                if key in positions:
+                    value.seek(positions[key])
+                form.add_field(key, value)
+            return form
+
+        result, status = await self._json("POST", endpoint, retry=retry, create_data=create_form)
+        if status != 202:
+            _logger.warning(json.dumps(result, indent=2))
+        return result
+
+    async def downloadfile(self, endpoint: Union[str, Endpoint], file=None):
+        endpoint = self._endpoint(endpoint)
+        if file is None:
+            status, _, content = await self._request("GET", endpoint)
+            if status != 200:
+                _logger.warning("Download failed")
+            return content
+        start = file.tell()
+
+        async def write(response):
+            # Stream the response into the given file object chunk by chunk, a retried download starts over. Error
+            # pages must not end up in the file.
+            if response.status != 200:
+                return None
+            file.seek(start)
+            file.truncate()
+            async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                file.write(chunk)
+            return file
+
+        status, _, _ = await self._request("GET", endpoint, read=write)
+        if status != 200:
+            raise Exception("Download failed with status {0}".format(status))
+        return file
+
+    async def put(self, endpoint: Union[str, Endpoint], json_data):
+        endpoint = self._endpoint(endpoint)
+        if self.test:
+            print("WOULD PUT", str(endpoint), json.dumps(json_data, indent=2))
+            return {}
+        result, status = await self._json("PUT", endpoint, json=json_data)
+        if status != 200:
+            _logger.warning(json.dumps(result, indent=2))
+        return result
@@ -0,0 +1,130 @@
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+__all__ = ['Catalogue']
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = 24 * 60 * 60
+
+# In-memory entries shared by all Catalogue instances of a process: cache file -> {key: entry}
+_memory = {}
+# Guards the entries and the cache files. Reentrant since changes write the file while holding it.
+_memory_lock = threading.RLock()
+
+
+# Cache for Mayan lists that rarely change (document types, metadata types, tags, ...)
+class Catalogue(object):
+
+    def __init__(self, baseurl: str, location: str = None, ttl: float = DEFAULT_TTL):
+        self.baseurl = baseurl
+        self.location = location
+        self.ttl = ttl
+        name = hashlib.md5(str.encode(baseurl)).hexdigest() + '.json'
+        self.path = os.path.join(location, name) if location else None
+        self._cache_key = self.path or baseurl
+        # Open batches and whether changes were made within them
+        self._batches = 0
+        self._dirty = False
+
+    @property
+    def entries(self) -> dict:
+        with _memory_lock:
+            entries = _memory.get(self._cache_key)
+            if entries is None:
+                entries = self._read()
+                _memory[self._cache_key] = entries
+            return entries
+
+    def get(self, key: str):
+        return self.entries.get(key)
+
+    def is_fresh(self, entry: dict) -> bool:
+        return entry is not None and time.time() - entry['fetched'] < self.ttl
+
+    def put(self, key: str, results: list, etag: str = None, last_modified: str = None, pages: dict = None):
+        # pages holds the validators (etag and last_modified) of every further page of the list by url
+        entry = {'fetched': time.time(), 'etag': etag, 'last_modified': last_modified, 'pages': pages or {},
+                 'results': results}
+        with _memory_lock:
+            self.entries[key] = entry
+            self._write()
+        return entry
+
+    def touch(self, key: str):
+        # The server confirmed that the cached results are still valid
+        with _memory_lock:
+            entry = self.entries[key]
+            entry['fetched'] = time.time()
+            self._write()
+        return entry
+
+    def validators(self, key: str, url: str = None) -> dict:
+        # Conditional request headers for the first page of the list or for the further page with the given url
+        entry = self.get(key)
+        headers = {}
+        if entry is not None:
+            page = entry if url is None else entry.get('pages', {}).get(url, {})
+            if page.get('etag'):
+                headers['If-None-Match'] = page['etag']
+            if page.get('last_modified'):
+                headers['If-Modified-Since'] = page['last_modified']
+        return headers
+
+    def invalidate(self, key: str = None):
+        with _memory_lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+            self._write()
+
+    @contextlib.contextmanager
+    def batch(self):
+        # Changes made within the batch are written to the cache file once at its end
+        with _memory_lock:
+            self._batches += 1
+        try:
+            yield self
+        finally:
+            with _memory_lock:
+                self._batches -= 1
+                if self._batches == 0 and self._dirty:
+                    self._write()
+
+    def _read(self) -> dict:
+        if self.path is None or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except Exception as e:
+            _logger.warning('Could not read catalogue cache {0}: {1}'.format(self.path, e))
+            return {}
+
+    def _write(self):
+        if self.path is None:
+            return
+        with _memory_lock:
+            if self._batches > 0:
+                self._dirty = True
+                return
+            self._dirty = False
+            tmp_path = None
+            try:
+                os.makedirs(self.location, exist_ok=True)
+                # Write to a temporary file first so that concurrent readers never see partial files
+                fd, tmp_path = tempfile.mkstemp(dir=self.location, suffix='.tmp')
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(self.entries, f)
+                os.replace(tmp_path, self.path)
+            except Exception as e:
+                _logger.warning('Could not write catalogue cache {0}: {1}'.format(self.path, e))
+                if tmp_path is not None and os.path.exists(tmp_path):
+                    os.remove(tmp_path)
@@ -1,15 +1,27 @@
 import json
 import logging
+import math
 import re
+from concurrent.futures import ThreadPoolExecutor
 from json import JSONDecodeError
 from typing import Union
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from .catalogue import Catalogue
 
 __all__ = []
 
 _logger = logging.getLogger(__name__)
 
+# Number of pooled connections kept open to the Mayan host
+DEFAULT_POOL_SIZE = 16
+# Number of requests that are issued concurrently for paginated and per document type lookups
+DEFAULT_MAX_WORKERS = 8
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
 # TODO: Fix error handling
 
 
@@ -61,11 +73,38 @@ class Endpoint(object):
     __str__ = __repr__
 
 
+def page_url(url: str, page: int) -> str:
+    scheme, netloc, path, query, fragment = urlsplit(url)
+    params = [(key, value) for key, value in parse_qsl(query) if key != 'page']
+    params.append(('page', str(page)))
+    return urlunsplit((scheme, netloc, path, urlencode(params), fragment))
+
+
+def page_validators(response: requests.Response) -> dict:
+    return {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+
+
 class Mayan(object):
-    def __init__(self, baseurl, test=False):
+    def __init__(self, baseurl, test=False, pool_size=DEFAULT_POOL_SIZE, max_workers=DEFAULT_MAX_WORKERS,
+                 catalogue: Catalogue = None):
         self.test = test
         self.baseurl = baseurl
-        pass
+        self.catalogue = catalogue
+        self.pool_size = pool_size
+        self.max_workers = max_workers
+        self._executor = None
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        self.session.close()
 
     def ep(self, endpoint: str, *, params: dict = {}, base: str = None):
         if base is None:
@@ -74,6 +113,9 @@ class Mayan(object):
 
     def login(self, username, password):
         self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
         self.session.auth = (username, password)
         auth_data = {"username": username, "password": password}
         token_response = self.session.post(
@@ -90,28 +132,108 @@ class Mayan(object):
             "Authorization": f"Token {token}",
         }
 
-    def load(self):
-        self.content_types = self.all("content_types")
+    def load(self, refresh=False):
+        if self.catalogue is None:
+            self._load()
+            return
+        # A cold catalogue is written once after all lookups instead of once per list
+        with self.catalogue.batch():
+            if refresh:
+                self.catalogue.invalidate()
+            self._load()
+
+    def _load(self):
+        self.content_types = self.cached_all("content_types")
         self.document_types = {
-            x["label"]: x for x in self.all("document_types")}
-        self.metadata_types = self.all("metadata_types")
-        self.tags = {x["label"]: x for x in self.all("tags")}
-        for dt, document_type in self.document_types.items():
-            self.document_types[dt]["metadatas"] = self.all(
-                self.ep("metadata_types", base=document_type["url"])
-            )
-
-    def all(self, endpoint: Union[str, Endpoint]):
+            x["label"]: x for x in self.cached_all("document_types")}
+        self.metadata_types = self.cached_all("metadata_types")
+        self.tags = {x["label"]: x for x in self.cached_all("tags")}
+        # The lookups run on the shared executor so they must not paginate in parallel themselves
+        metadatas = self.executor.map(
+            lambda document_type: self.cached_all(
+                self.ep("metadata_types", base=document_type["url"]), parallel=False),
+            self.document_types.values())
+        for document_type, metadata in zip(self.document_types.values(), metadatas):
+            document_type["metadatas"] = metadata
+
+    def cached_all(self, endpoint: Union[str, Endpoint], parallel=True):
+        if self.catalogue is None:
+            return self.all(endpoint, parallel)
         if isinstance(endpoint, str):
             endpoint = self.ep(endpoint)
-        results = []
-        page = {"next": endpoint}
+        key = str(endpoint)
+        entry = self.catalogue.get(key)
+        if self.catalogue.is_fresh(entry):
+            return entry["results"]
+        # Revalidate stale entries with a conditional request where the server supports it
+        result = self.session.get(endpoint, headers=self.catalogue.validators(key))
+        if result.status_code == 304 and entry is not None:
+            if self._pages_unchanged(key, entry, parallel):
+                _logger.debug("Catalogue entry %s is still valid", key)
+                return self.catalogue.touch(key)["results"]
+            # A further page changed so the whole list is collected again
+            result = self.session.get(endpoint)
+        pages = {}
+        results = self._collect(result.json(), parallel, pages)
+        self.catalogue.put(key, results, result.headers.get("ETag"), result.headers.get("Last-Modified"), pages)
+        return results
+
+    def _pages_unchanged(self, key: str, entry: dict, parallel=True) -> bool:
+        # The validators of the first page only cover its own results, every further page is revalidated as well.
+        # Entries without page validators can not be revalidated.
+        if "pages" not in entry:
+            return False
+        urls = list(entry["pages"])
+        headers = [self.catalogue.validators(key, url) for url in urls]
+        if not all(headers):
+            return False
+        mapper = self.executor.map if parallel else map
+        statuses = mapper(lambda url, page_headers: self.session.get(url, headers=page_headers).status_code,
+                          urls, headers)
+        return all(status == 304 for status in list(statuses))
+
+    def all(self, endpoint: Union[str, Endpoint], parallel=True):
+        if isinstance(endpoint, str):
+            endpoint = self.ep(endpoint)
+        return self._collect(self.session.get(endpoint).json(), parallel)
+
+    def iterate(self, endpoint: Union[str, Endpoint]):
+        # Results page by page without collecting all of them first
+        if isinstance(endpoint, str):
+            endpoint = self.ep(endpoint)
+        page = self.session.get(endpoint).json()
+        yield from page["results"]
         while page["next"] != None:
-            if isinstance(page["next"], str):
-                page["next"] = self.ep(page["next"])
-            result = self.session.get(page["next"])
-            page = result.json()
+            page = self.session.get(self.ep(page["next"])).json()
+            yield from page["results"]
+
+    def _collect(self, page: dict, parallel=True, pages: dict = None):
+        # pages receives the validators of every further page by url when given
+        results = list(page["results"])
+        if parallel and page["next"] != None and page.get("count") and len(page["results"]) > 0:
+            return results + self._remaining_pages(page, pages)
+        while page["next"] != None:
+            url = str(self.ep(page["next"]))
+            response = self.session.get(url)
+            page = response.json()
             results += page["results"]
+            if pages is not None:
+                pages[url] = page_validators(response)
+        return results
+
+    def _remaining_pages(self, first_page: dict, pages: dict = None):
+        # The first page tells us the total count and the page size so all other pages can be fetched at once
+        page_count = math.ceil(first_page["count"] / len(first_page["results"]))
+        next_query = dict(parse_qsl(urlsplit(first_page["next"]).query))
+        first_index = int(next_query.get("page", 2))
+        urls = [page_url(first_page["next"], index)
+                for index in range(first_index, page_count + 1)]
+        responses = self.executor.map(self.session.get, urls)
+        results = []
+        for url, response in zip(urls, responses):
+            results += response.json()["results"]
+            if pages is not None:
+                pages[url] = page_validators(response)
         return results
 
     def first(self, endpoint: Union[str, Endpoint]):
@@ -156,13 +278,20 @@ class Mayan(object):
         except JSONDecodeError:
             return {}
 
-    def downloadfile(self, endpoint: Union[str, Endpoint]):
+    def downloadfile(self, endpoint: Union[str, Endpoint], file=None):
         if endpoint is str:
             endpoint = self.ep(endpoint)
-        result = self.session.get(endpoint)
-        if result.status_code != 200:
-            _logger.warning("Download failed", indent=2)
-        return result.content
+        if file is None:
+            result = self.session.get(endpoint)
+            if result.status_code != 200:
+                _logger.warning("Download failed")
+            return result.content
+        # Stream the response into the given file object chunk by chunk. Error pages must not end up in the file.
+        with self.session.get(endpoint, stream=True) as result:
+            result.raise_for_status()
+            for chunk in result.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                file.write(chunk)
+        return file
 
     def put(self, endpoint: Union[str, Endpoint], json_data):
         if endpoint is str:
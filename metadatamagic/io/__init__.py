@@ -2,4 +2,7 @@
 
 from .documentloader import *
 from .configloader import *
-from .modelio import *
\ No newline at end of file
+from .modelio import *
+from .resultstore import *
+from .modelstore import *
+from .migration import *
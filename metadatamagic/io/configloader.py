@@ -4,13 +4,33 @@ import os
 
 _logger = logging.getLogger(__name__)
 
-__all__ = ['DEFAULT_LANGUAGE', 'ADDITIONAL_VOCAB', 'METADATA', 'MIN_CONFIDENCE', 'MODEL_STORAGE_LOCATION']
+__all__ = ['DEFAULT_LANGUAGE', 'ADDITIONAL_VOCAB', 'METADATA', 'MIN_CONFIDENCE', 'MODEL_STORAGE_LOCATION', 'OCR_BATCH_SIZE', 'CATALOGUE_CACHE_LOCATION', 'CATALOGUE_TTL', 'SPOOL_LOCATION', 'OCR_CACHE_LOCATION', 'OCR_CACHE_SIZE', 'CLUSTER_INDEX_MIN_SHARE', 'CLUSTER_INDEX_MAX_CANDIDATES', 'MODEL_CACHE_SIZE', 'MODEL_LOG_SIZE', 'TRAINING_CHECKPOINT_LOCATION']
 
 #TODO: Load global settings from config file
 DEFAULT_LANGUAGE = 'de'
 ADDITIONAL_VOCAB = '§ñéç'
 MIN_CONFIDENCE = 75
 MODEL_STORAGE_LOCATION = 'modelstorage'
+# Approximate memory (in bytes) for loaded clusters per process. Least recently used clusters are unloaded beyond that.
+MODEL_CACHE_SIZE = 512 * 1024 * 1024
+# Changes of a cluster are appended to a log that is folded into new model files once it exceeds this size (in bytes)
+MODEL_LOG_SIZE = 16 * 1024 * 1024
+# Progress of bulk training runs (listed documents per cluster and the finished clusters) per document type
+TRAINING_CHECKPOINT_LOCATION = 'trainingcheckpoints'
+# Number of pages (across documents) that are passed to the OCR predictor at once
+OCR_BATCH_SIZE = 16
+# Mayan document types, metadata types and tags are cached on disk for CATALOGUE_TTL seconds
+CATALOGUE_CACHE_LOCATION = 'cataloguecache'
+CATALOGUE_TTL = 24 * 60 * 60
+# Directory for downloaded and optimized pdfs (None uses the system temp directory)
+SPOOL_LOCATION = None
+# OCR results are cached per file checksum and recognition model (None disables the cache)
+OCR_CACHE_LOCATION = 'ocrcache'
+OCR_CACHE_SIZE = 2 * 1024 * 1024 * 1024
+# Clusters are only matched against a document when this share of the character trigrams of one of their groupby
+# values (or synonyms) appears on the document. At most CLUSTER_INDEX_MAX_CANDIDATES clusters are matched.
+CLUSTER_INDEX_MIN_SHARE = 0.5
+CLUSTER_INDEX_MAX_CANDIDATES = 25
 
 # Metadata Settings
 METADATA = {'receiptdate': {'type': 'date', 'format': '%Y-%m-%d', 'groupby': False}, 'issuer': {'type': 'string', 'groupby': True}, 'invoiceamount': {'type': 'money', 'groupby': False}, 'documentcontent': {'type': 'string', 'groupby': True}, 'invoicenumber': {'type': 'string', 'groupby': False}}
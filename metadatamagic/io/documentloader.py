@@ -1,17 +1,28 @@
 import io
+import itertools
 import logging
+import mmap
 import os
+import tempfile
+import threading
+from typing import Callable
 
 import numpy as np
 import pypdfium2 as pdfium
 
 from ..api import mayan
-from ..model import Document
+from ..api.catalogue import Catalogue
+from ..model import Document, PdfFile
+from .configloader import CATALOGUE_CACHE_LOCATION, CATALOGUE_TTL, SPOOL_LOCATION
 
-__all__ = ['load_document']
+__all__ = ['load_document', 'download_document', 'optimize_document', 'list_documents']
 
 _logger = logging.getLogger(__name__)
 
+_mayan = None
+_mayan_pid = None
+_mayan_lock = threading.Lock()
+
 
 def get_mayan_options() -> dict:
     _logger.info('Retrieve initial mayan configuration from environment')
@@ -23,16 +34,33 @@ def get_mayan_options() -> dict:
 
 
 def get_mayan() -> mayan.Mayan:
-    options = get_mayan_options()
-    m = mayan.Mayan(options['url'])
-    m.login(options['username'], options['password'])
-    _logger.info('Load meta informations from mayan')
-    m.load()
-    return m
+    # One authenticated client per process. Sessions must not be shared with forked children.
+    global _mayan, _mayan_pid
+    with _mayan_lock:
+        if _mayan is None or _mayan_pid != os.getpid():
+            options = get_mayan_options()
+            catalogue = Catalogue(options['url'], CATALOGUE_CACHE_LOCATION, CATALOGUE_TTL)
+            m = mayan.Mayan(options['url'], catalogue=catalogue)
+            m.login(options['username'], options['password'])
+            _logger.info('Load meta informations from mayan')
+            m.load()
+            _mayan = m
+            _mayan_pid = os.getpid()
+        return _mayan
+
+
+def load_document(document_id, load_pages: Callable[[Document], bool] = None):
+    document = download_document(document_id, load_pages=load_pages)
+    if document is not None:
+        optimize_document(document)
+    return document
 
 
-def load_document(document_id):
-    m = get_mayan()
+def download_document(document_id, m: mayan.Mayan = None, load_pages: Callable[[Document], bool] = None):
+    # load_pages may fill in the pages of the document (e.g. from cached OCR results) and return True, the pdf is
+    # not downloaded then
+    if m is None:
+        m = get_mayan()
 
     _logger.info('Loading document %s', document_id)
 
@@ -42,26 +70,134 @@ def load_document(document_id):
         _logger.error('Could not retrieve document')
         return None
 
-    # Load document metadata
-    document_metadata = {x['metadata_type']['name']: x for x in m.all(
-        m.ep('metadata', base=document['url']))}
-    
     document_type = document['document_type']['label']
-    document_metadata = {metadata_name: metadata_value['value'] for metadata_name,
-                         metadata_value in document_metadata.items()}
+    document_metadata = get_document_metadata(document, m)
+    result = Document(document_id, document_type, document_metadata, None, document['file_latest'].get('checksum'))
+    if load_pages is not None and load_pages(result):
+        return result
+
+    # Stream the document pdf to a spool file
+    pdf = create_spool_file()
+    try:
+        with open(pdf.path, 'wb') as f:
+            m.downloadfile(document['file_latest']['download_url'], f)
+    except Exception:
+        pdf.release()
+        raise
+    result.pdf = pdf
+    return result
+
+
+def get_document_metadata(document: dict, m: mayan.Mayan, parallel: bool = True) -> dict[str, str]:
+    document_metadata = {x['metadata_type']['name']: x for x in m.all(
+        m.ep('metadata', base=document['url']), parallel)}
+    return {metadata_name: metadata_value['value'] for metadata_name,
+            metadata_value in document_metadata.items()}
+
+
+def list_documents(mayan_document_type: str, m: mayan.Mayan = None, batch_size: int = 100):
+    # (document id, metadata) of all documents of a type. The listing is paged and the metadata of a batch of
+    # documents is requested concurrently.
+    if m is None:
+        m = get_mayan()
+    document_type = m.document_types[mayan_document_type]
+    documents = m.iterate(m.ep('documents', base=document_type['url']))
+    while True:
+        batch = list(itertools.islice(documents, batch_size))
+        if not batch:
+            break
+        metadatas = m.executor.map(lambda document: get_listed_metadata(document, m), batch)
+        for document, metadata in zip(batch, metadatas):
+            if metadata is not None:
+                yield document['id'], metadata
+
+
+def get_listed_metadata(document: dict, m: mayan.Mayan) -> dict[str, str]:
+    # Documents may be deleted while they are listed, they are skipped instead of ending the listing
+    try:
+        # Requests on the shared executor must not paginate in parallel themselves
+        return get_document_metadata(document, m, parallel=False)
+    except Exception as e:
+        _logger.warning('Could not retrieve the metadata of document {0}: {1}'.format(document['id'], e))
+        return None
 
-    # Load document pdf
-    with io.BytesIO(m.downloadfile(document['file_latest']['download_url'])) as buffer:
-        buffer.seek(0)
-        optimized_pdf = optimize_pdf_for_detection(buffer)
 
-    document = Document(document_id, document_type, document_metadata, optimized_pdf)
+def create_spool_file() -> PdfFile:
+    if SPOOL_LOCATION:
+        os.makedirs(SPOOL_LOCATION, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix='.pdf', dir=SPOOL_LOCATION)
+    os.close(fd)
+    return PdfFile(path)
+
+
+def optimize_document(document: Document):
+    # Documents whose pages are known already come without a pdf
+    if document.pdf is None:
+        return document
+    if not isinstance(document.pdf, PdfFile):
+        with io.BytesIO(document.pdf) as buffer:
+            buffer.seek(0)
+            document.pdf = optimize_pdf_for_detection(buffer)
+        return document
+    optimized = create_spool_file()
+    try:
+        # Empty files can not be memory mapped
+        if os.path.getsize(document.pdf.path) == 0:
+            raise ValueError('The pdf of document {0} is empty'.format(document.mayan_document_id))
+        with open(document.pdf.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            with MappedFile(mapped) as buffer, open(optimized.path, 'wb') as output:
+                optimize_pdf_for_detection(buffer, output)
+    except Exception:
+        # Callers drop documents that can not be optimized, so their downloads are released here
+        optimized.release()
+        document.release_pdf()
+        raise
+    document.pdf.release()
+    document.pdf = optimized
     return document
 
+
+class MappedFile(io.RawIOBase):
+
+    # Read only file object on top of a memory map. pdfium reads through readinto so pages are
+    # paged in from the file on demand instead of copying the whole pdf into memory.
+    def __init__(self, mapped: mmap.mmap) -> None:
+        self.mapped = mapped
+        self.view = memoryview(mapped)
+        self.offset = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.offset = offset
+        elif whence == io.SEEK_CUR:
+            self.offset += offset
+        else:
+            self.offset = len(self.mapped) + offset
+        return self.offset
+
+    def tell(self):
+        return self.offset
+
+    def readinto(self, buffer):
+        data = self.view[self.offset:self.offset + len(buffer)]
+        buffer[:len(data)] = data
+        self.offset += len(data)
+        return len(data)
+
+    def close(self):
+        self.view.release()
+        super().close()
+
 # TODO: Make this work with later versions of pypdfium2
 
 
-def optimize_pdf_for_detection(pdf):
+def optimize_pdf_for_detection(pdf, output=None):
     _logger.info('Optimizing document for text detection')
     pdf = pdfium.PdfDocument(pdf)
     fontpath = os.path.join('metadatamagic', 'dist', 'fonts', 'FreeMono.otf')
@@ -83,6 +219,11 @@ def optimize_pdf_for_detection(pdf):
             )
         page.generate_content()
 
+    if output is not None:
+        pdf.save(output, version=17)
+        pdf.close()
+        return output
+
     with io.BytesIO() as buffer:
         pdf.save(buffer, version=17)
         return buffer.getvalue()
@@ -0,0 +1,113 @@
+import argparse
+import logging
+import os
+
+from ..model import DocumentCluster, DocumentType
+from .configloader import MODEL_STORAGE_LOCATION
+from .modelio import (LEGACY_SUFFIX, convert_legacy_page_type, get_legacy_cluster_metadata, get_path,
+                      index_stored_cluster, keep_legacy_page_types, load_dictionary, load_document_type,
+                      load_legacy_object, load_synonyms, save_dictionary, save_document_type, save_page_types,
+                      save_synonyms)
+
+__all__ = ['migrate_model_storage']
+
+_logger = logging.getLogger(__name__)
+
+# Folders of legacy document type files (without extension)
+LEGACY_DOCUMENT_TYPE_FOLDERS = ('doctype',)
+# Page type folders are written under this suffix until the document types are migrated
+MIGRATION_SUFFIX = '.migrating'
+
+
+def get_legacy_files(location: str, folder: str) -> list[str]:
+    path = os.path.join(location, folder)
+    if not os.path.isdir(path):
+        return []
+    return sorted(name for name in os.listdir(path) if os.path.isfile(os.path.join(path, name))
+                  and not name.startswith('.') and not name.endswith(('.json', '.lock', LEGACY_SUFFIX)))
+
+
+def get_kept_page_types(location: str) -> list[str]:
+    # Legacy page type pickles that were moved aside for their page type folders
+    path = os.path.join(location, 'ptype')
+    if not os.path.isdir(path):
+        return []
+    names = sorted(name for name in os.listdir(path) if name.endswith(LEGACY_SUFFIX))
+    for name in names:
+        original = os.path.join(path, name[:-len(LEGACY_SUFFIX)])
+        if not os.path.exists(original):
+            # An earlier migration stopped before the folder was moved in place
+            os.replace(os.path.join(path, name), original)
+    return [name for name in names if os.path.isdir(os.path.join(path, name[:-len(LEGACY_SUFFIX)]))]
+
+
+def migrate_model_storage(location: str = MODEL_STORAGE_LOCATION, remove_legacy: bool = False) -> dict[str, int]:
+    # Converts all pickled models of a model storage to the current format. Returns the number of migrated files
+    # per folder.
+    migrated = {}
+    legacy_files = [get_path('ptype', name, '', location) for name in get_kept_page_types(location)]
+
+    # The metadata of old clusters is only stored in their legacy page types. Their folders are written under a
+    # temporary name and only take the place of the legacy files once the metadata is stored in the index.
+    recovered = {}
+    converted = []
+    names = get_legacy_files(location, 'ptype')
+    for cluster_id in names:
+        cluster = DocumentCluster(None, cluster_id, {})
+        legacy = load_legacy_object('ptype', cluster_id, location) or []
+        cluster.page_types = [convert_legacy_page_type(page_type, cluster, str(i)) for i, page_type in enumerate(legacy)]
+        mayan_document_type, metadata = get_legacy_cluster_metadata(legacy)
+        if metadata is not None:
+            recovered.setdefault(mayan_document_type, {})[cluster_id] = metadata
+        folder = get_path('ptype', cluster_id + MIGRATION_SUFFIX, '', location)
+        save_page_types(cluster, location, folder=folder)
+        converted.append((cluster_id, folder))
+    migrated['ptype'] = len(names)
+
+    for folder, load, save in (('dict', load_dictionary, save_dictionary), ('syn', load_synonyms, save_synonyms)):
+        names = get_legacy_files(location, folder)
+        for cluster_id in names:
+            cluster = DocumentCluster(None, cluster_id, {})
+            load(cluster, location)
+            save(cluster, location)
+            legacy_files.append(get_path(folder, cluster_id, '', location))
+        migrated[folder] = len(names)
+
+    document_types = set(recovered.keys())
+    for folder in LEGACY_DOCUMENT_TYPE_FOLDERS:
+        for name in get_legacy_files(location, folder):
+            document_types.add(name)
+            legacy_files.append(get_path(folder, name, '', location))
+    for name in sorted(document_types):
+        document_type = DocumentType(name)
+        load_document_type(document_type, location)
+        for cluster_id, metadata in recovered.get(name, {}).items():
+            if cluster_id not in document_type.cluster_index:
+                index_stored_cluster(document_type, cluster_id, metadata, location)
+        save_document_type(document_type, location)
+    migrated['index'] = len(document_types)
+
+    for cluster_id, folder in converted:
+        path = get_path('ptype', cluster_id, '', location)
+        keep_legacy_page_types(path)
+        os.replace(folder, path)
+        legacy_files.append(path + LEGACY_SUFFIX)
+
+    if remove_legacy:
+        for path in legacy_files:
+            if os.path.isfile(path):
+                os.remove(path)
+    _logger.info('Migrated model storage {0}: {1}'.format(location, migrated))
+    return migrated
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert pickled models to the current model format')
+    parser.add_argument('location', nargs='?', default=MODEL_STORAGE_LOCATION)
+    parser.add_argument('--remove-legacy', action='store_true', help='delete the pickled files after conversion')
+    args = parser.parse_args()
+    print(migrate_model_storage(args.location, args.remove_legacy))
+
+
+if __name__ == '__main__':
+    main()
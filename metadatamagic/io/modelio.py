@@ -1,82 +1,555 @@
+import json
 import logging
 import os
 import pickle
+import tempfile
+from contextlib import contextmanager
 from typing import Any
 
 import mgzip
+import numpy as np
 
-from ..io import MODEL_STORAGE_LOCATION
+try:
+    import fcntl
+except ImportError:
+    # Without advisory locks only one process may write a model storage
+    fcntl = None
 
-__all__ = ['load_document_type', 'save_document_type', 'load_document_cluster', 'save_document_cluster', 'save_dictionary', 'load_dictionary', 'save_synonyms', 'load_synonyms', 'save_page_types', 'load_page_types']
+from ..io import MODEL_LOG_SIZE, MODEL_STORAGE_LOCATION
+from ..model import BoxMap, ClusterIndex, DocumentCluster, PageType, SynonymIndex, Vocabulary
+
+__all__ = ['load_document_type', 'save_document_type', 'load_document_cluster', 'save_document_cluster', 'save_dictionary', 'load_dictionary', 'save_synonyms', 'load_synonyms', 'save_page_types', 'load_page_types', 'append_cluster_changes', 'compact_cluster', 'lock_cluster', 'write_atomic', 'FORMAT_VERSION']
 
 _logger = logging.getLogger(__name__)
 
-def save_object(obj: Any, folder: str, file_name: str):
-    try:
-        folder = os.path.join(MODEL_STORAGE_LOCATION, folder)
-        if not os.path.exists(folder):
-            os.makedirs(folder)
-        full_path = os.path.join(folder, file_name)
-        with mgzip.open(full_path, 'wb') as f:
-            pickle.dump(obj, f)
-    except Exception as e:
-        _logger.warning('Could not save object to file: {0}'.format(str(e)))
-
-def load_object(folder: str, file_name: str):
+# Version of the on-disk model format:
+#   index/<document type>.json        cluster ids and the cluster index of a document type
+#   dict/<cluster id>.json            words of the vocabulary ordered by id
+#   syn/<cluster id>.json             synonym -> metadata value
+#   ptype/<cluster id>/manifest.json  page type attributes and the number of words and map boxes per page type
+#   ptype/<cluster id>/*.npy          columns of all page types of the cluster (memory mapped when loaded)
+#   delta/<cluster id>/<generation>.log  json lines with the changes of the cluster since the model files of that
+#                                        generation were written (see append_cluster_changes)
+#   delta/<cluster id>/generation.json   generation that changes are currently appended to
+#   ptype/<cluster id>/statistics_*.npy  running statistics of the pages of all page types (see PageStatistics)
+# Model files are replaced atomically. Version 1 files have no generation and are read as generation 0. Page types of
+# version 1 and 2 files have no statistics, they are created from the template words and maps when needed.
+FORMAT_VERSION = 3
+
+# Globals that may be restored from legacy pickles (arrays, dates and prices of the legacy models). Classes of this
+# package are replaced with plain objects, everything else is refused.
+LEGACY_GLOBALS = {
+    'builtins': ('set', 'frozenset', 'bytearray', 'complex', 'slice', 'range', 'object', 'tuple', 'list', 'dict', 'str',
+                 'bytes', 'int', 'float', 'bool'),
+    'numpy': ('ndarray', 'dtype'),
+    'numpy.core.multiarray': ('_reconstruct', 'scalar'),
+    'numpy._core.multiarray': ('_reconstruct', 'scalar'),
+    'numpy.core.numeric': ('_frombuffer',),
+    'numpy._core.numeric': ('_frombuffer',),
+    'datetime': ('datetime', 'date', 'time', 'timedelta', 'timezone'),
+    'decimal': ('Decimal',),
+    'price_parser': ('Price',),
+    'price_parser.parser': ('Price',),
+    'collections': ('OrderedDict',),
+    'copyreg': ('_reconstructor',),
+    '_codecs': ('encode',)}
+# Suffix of legacy page type pickles that were moved aside for the page type folder of the same name
+LEGACY_SUFFIX = '.legacy'
+
+
+def get_path(folder: str, name: str, extension: str = '', location: str = None) -> str:
+    return os.path.join(location or MODEL_STORAGE_LOCATION, folder, name + extension)
+
+def write_atomic(path: str, write):
+    # Writes a temporary file next to the destination and renames it, so readers see either the old or the new file
+    folder = os.path.dirname(path)
+    os.makedirs(folder, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path), suffix='.tmp', dir=folder)
     try:
-        path = os.path.join(MODEL_STORAGE_LOCATION, folder, file_name)
-        if os.path.exists(path):
-            with mgzip.open(path, 'rb') as f:
-                obj = pickle.load(f)
-                return obj
-    except Exception as e:
-        _logger.warning('Could not load object from file: {0}'.format(str(e)))
-
-def save_dictionary(cluster):
-    save_object(cluster.dictionary, 'dict', cluster.cluster_id)
-
-def load_dictionary(cluster):
-    cluster.dictionary = load_object('dict', cluster.cluster_id)
-    if cluster.dictionary is None:
-        cluster.dictionary = {}
-        for metadata_name, metadata_value in cluster.metadata.items():
-            cluster.dictionary[metadata_name] = len(cluster.dictionary) + 1
-            cluster.dictionary[metadata_value] = len(cluster.dictionary) + 1
-
-def save_synonyms(cluster):
-    save_object(cluster.synonyms, 'syn', cluster.cluster_id)
-
-def load_synonyms(cluster):
-    cluster.synonyms = load_object('syn', cluster.cluster_id)
-    if cluster.synonyms is None:
-        cluster.synonyms = {}
-
-def save_page_types(cluster):
-    save_object(cluster.page_types, 'ptype', cluster.cluster_id)
-
-def load_page_types(cluster):
-    cluster.page_types = load_object('ptype', cluster.cluster_id)
-    if cluster.page_types is None:
-        cluster.page_types = []
-    
-def save_document_cluster(cluster):
-    save_dictionary(cluster)
-    save_synonyms(cluster)
-    save_page_types(cluster)
-
-def load_document_cluster(cluster, dictionary=True, synonyms=True, page_types=True):
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def save_json(obj: Any, folder: str, name: str, location: str = None):
+    data = json.dumps(dict(obj, version=FORMAT_VERSION), ensure_ascii=False).encode('utf-8')
+    write_atomic(get_path(folder, name, '.json', location), lambda f: f.write(data))
+
+def load_json(folder: str, name: str, location: str = None) -> dict:
+    path = get_path(folder, name, '.json', location)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        obj = json.load(f)
+    check_version(obj, path)
+    return obj
+
+def check_version(obj: dict, path: str):
+    if obj.get('version', 0) > FORMAT_VERSION:
+        raise ValueError('{0} has the unsupported format version {1}'.format(path, obj['version']))
+
+
+@contextmanager
+def lock_file(path: str, shared: bool = False):
+    # Advisory lock between processes, closing the file releases it. Only writers create lock files (and their
+    # folders) so that read only load paths leave the model store untouched. Without a lock file no writer has
+    # been there yet and readers go ahead without the shared lock.
+    if shared:
+        try:
+            f = open(path, 'r')
+        except FileNotFoundError:
+            yield
+            return
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        f = open(path, 'a')
+    with f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        yield
+
+def lock_cluster(cluster_id: str, location: str = None, shared: bool = False):
+    # Writers of a cluster hold the exclusive lock, readers the shared one
+    return lock_file(os.path.join(get_path('delta', cluster_id, '', location), 'lock'), shared)
+
+def get_generation(cluster_id: str, location: str = None) -> int:
+    stored = load_json('delta', os.path.join(cluster_id, 'generation'), location)
+    return stored['generation'] if stored is not None else 0
+
+def get_log_generations(cluster_id: str, location: str = None) -> list[int]:
+    folder = get_path('delta', cluster_id, '', location)
+    if not os.path.isdir(folder):
+        return []
+    return sorted(int(name[:-4]) for name in os.listdir(folder) if name.endswith('.log') and name[:-4].isdigit())
+
+def get_log_path(cluster_id: str, generation: int, location: str = None) -> str:
+    return os.path.join(get_path('delta', cluster_id, '', location), '{0}.log'.format(generation))
+
+def read_log(cluster_id: str, generation: int, location: str = None) -> list[dict]:
+    # Records of all logs from the given generation on. The last line of a log is incomplete when a writer crashed.
+    records = []
+    for log_generation in get_log_generations(cluster_id, location):
+        if log_generation < generation:
+            continue
+        path = get_log_path(cluster_id, log_generation, location)
+        with open(path, 'rb') as f:
+            lines = f.read().split(b'\n')
+        if lines[-1]:
+            _logger.warning('Ignoring the incomplete last record of {0}'.format(path))
+        for line in lines[:-1]:
+            if line:
+                records.append(json.loads(line))
+    return records
+
+def repair_log(path: str):
+    # Cuts off the incomplete last line of a crashed writer before new records are appended
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb+') as f:
+        data = f.read()
+        if data and not data.endswith(b'\n'):
+            _logger.warning('Removing the incomplete last record of {0}'.format(path))
+            f.truncate(data.rfind(b'\n') + 1)
+
+
+class LegacyObject:
+
+    # Stand-in for the classes of this package in legacy pickles. It keeps whatever state was pickled.
+    def __new__(cls, *args, **kwargs):
+        return object.__new__(cls)
+
+    def __setstate__(self, state):
+        # Slotted classes pickle their state as (__dict__, slots)
+        if isinstance(state, tuple) and len(state) == 2:
+            for part in state:
+                if part:
+                    self.__dict__.update(part)
+        elif isinstance(state, dict):
+            self.__dict__.update(state)
+
+
+class LegacyUnpickler(pickle.Unpickler):
+
+    _classes = {}
+
+    def find_class(self, module: str, name: str):
+        if module == 'metadatamagic' or module.startswith('metadatamagic.'):
+            if name not in self._classes:
+                self._classes[name] = type(name, (LegacyObject,), {})
+            return self._classes[name]
+        if name in LEGACY_GLOBALS.get(module, ()):
+            return super().find_class(module, name)
+        raise pickle.UnpicklingError('{0}.{1} is not allowed in model files'.format(module, name))
+
+def load_legacy_object(folder: str, name: str, location: str = None):
+    # Objects saved with mgzip and pickle before the model format was versioned
+    path = get_path(folder, name, '', location)
+    if not os.path.isfile(path):
+        return None
+    with mgzip.open(path, 'rb') as f:
+        return LegacyUnpickler(f).load()
+
+def get_legacy_box(word) -> list[float]:
+    position = getattr(word, 'position', None)
+    if position is None:
+        return [np.nan] * 4
+    return [position.left_top.x, position.left_top.y, position.right_bot.x, position.right_bot.y]
+
+def get_legacy_cluster_metadata(legacy_page_types) -> tuple[str, dict[str, str]]:
+    # Legacy page types pickled their whole cluster which is the only place the metadata of old clusters is stored.
+    # Returns the document type and the metadata of the cluster.
+    for page_type in legacy_page_types or []:
+        parent = getattr(page_type, 'parent_cluster', None)
+        document_type = getattr(parent, 'document_type', None)
+        if getattr(parent, 'metadata', None) and getattr(document_type, 'mayan_document_type', None) is not None:
+            return document_type.mayan_document_type, parent.metadata
+    return None, None
+
+def convert_legacy_page_type(legacy, cluster, page_type_id: str = None) -> PageType:
+    page_type = PageType(cluster, page_type_id)
+    page_type.number_of_pages = getattr(legacy, 'number_of_pages', 0)
+    if getattr(legacy, 'word_texts', None) is not None:
+        page_type.word_texts = np.array(list(legacy.word_texts), dtype=object)
+        page_type.word_boxes = np.asarray(legacy.word_boxes, dtype=np.float64).reshape(-1, 4)
+    elif getattr(legacy, 'words', None) is not None:
+        # Page types used to keep the template words including their whole document
+        page_type.word_texts = np.array([word.text for word in legacy.words], dtype=object)
+        page_type.word_boxes = np.array([get_legacy_box(word) for word in legacy.words], dtype=np.float64).reshape(-1, 4)
+    metadata_map = getattr(legacy, 'metadata_map', None)
+    if isinstance(metadata_map, np.ndarray):
+        page_type.metadata_map = BoxMap.from_dense(metadata_map)
+    elif metadata_map is not None:
+        page_type.metadata_map = BoxMap(metadata_map.shape, metadata_map.boxes, metadata_map.labels)
+    return page_type
+
+# Model files are snapshots of the components of a cluster at a generation. Changes since are replayed from the logs.
+def save_dictionary(cluster, location: str = None, generation: int = 0):
+    save_json({'words': cluster.dictionary.to_list(), 'generation': generation}, 'dict', cluster.cluster_id, location)
+
+def load_dictionary(cluster, location: str = None):
+    with lock_cluster(cluster.cluster_id, location, shared=True):
+        read_dictionary(cluster, location)
+
+def read_dictionary(cluster, location: str = None):
+    stored = load_json('dict', cluster.cluster_id, location)
+    generation = 0
+    if stored is not None:
+        dictionary = Vocabulary.from_list(stored['words'])
+        generation = stored.get('generation', 0)
+    else:
+        legacy = load_legacy_object('dict', cluster.cluster_id, location)
+        if legacy is not None:
+            dictionary = Vocabulary.from_dict(legacy)
+        else:
+            # The metadata names get the same (first) ids in every process, page maps use them as labels
+            dictionary = Vocabulary()
+            for metadata_name, metadata_value in cluster.metadata.items():
+                dictionary.add(metadata_name)
+                dictionary.add(metadata_value)
+    for record in read_log(cluster.cluster_id, generation, location):
+        if record['op'] == 'words':
+            for word in record['words']:
+                dictionary.add(word)
+    cluster.dictionary = dictionary
+    cluster.persisted_words = dictionary.next_id - 1
+
+def save_synonyms(cluster, location: str = None, generation: int = 0):
+    save_json({'synonyms': cluster.synonyms.to_dict(), 'generation': generation}, 'syn', cluster.cluster_id,
+              location)
+
+def load_synonyms(cluster, location: str = None):
+    with lock_cluster(cluster.cluster_id, location, shared=True):
+        read_synonyms(cluster, location)
+
+def read_synonyms(cluster, location: str = None):
+    stored = load_json('syn', cluster.cluster_id, location)
+    generation = 0
+    if stored is not None:
+        synonyms = stored['synonyms']
+        generation = stored.get('generation', 0)
+    else:
+        synonyms = load_legacy_object('syn', cluster.cluster_id, location)
+    index = SynonymIndex.from_dict(synonyms or {})
+    for record in read_log(cluster.cluster_id, generation, location):
+        if record['op'] == 'synonyms':
+            for synonym, canonical in record['synonyms']:
+                index[synonym] = canonical
+    index.changes.clear()
+    cluster.synonyms = index
+
+def get_column_path(folder: str, name: str, generation: int) -> str:
+    # Every generation has its own files, loaded page types may still map the files of an older one
+    return os.path.join(folder, name + ('.{0}'.format(generation) if generation else '') + '.npy')
+
+def keep_legacy_page_types(path: str):
+    # A legacy pickle at the place of a page type folder is moved aside instead of being replaced. It is the only
+    # place the metadata of old clusters is stored (see migration.migrate_model_storage).
+    if os.path.isfile(path):
+        os.replace(path, path + LEGACY_SUFFIX)
+
+def save_page_types(cluster, location: str = None, generation: int = 0, folder: str = None):
+    # The migration writes the folder under a temporary name first
+    if folder is None:
+        folder = get_path('ptype', cluster.cluster_id, '', location)
+        keep_legacy_page_types(folder)
+    manifest = []
+    texts, boxes, word_counts = [], [], []
+    map_boxes, map_labels, map_counts = [], [], []
+    statistics = {}
+    for page_type in cluster.page_types:
+        words = page_type.word_texts is not None
+        metadata_map = page_type.metadata_map
+        statistics_arrays = page_type.get_statistics_arrays()
+        manifest.append({'id': page_type.id, 'number_of_pages': page_type.number_of_pages, 'words': words,
+                         'map_shape': list(metadata_map.shape) if metadata_map is not None else None,
+                         'statistics': {name: len(array) for name, array in statistics_arrays.items()}})
+        for name, array in statistics_arrays.items():
+            statistics.setdefault(name, []).append(array)
+        word_counts.append(len(page_type.word_texts) if words else 0)
+        if words:
+            texts.extend(page_type.word_texts)
+            boxes.append(np.asarray(page_type.word_boxes, dtype=np.float64).reshape(-1, 4))
+        map_counts.append(len(metadata_map) if metadata_map is not None else 0)
+        if metadata_map is not None:
+            map_boxes.append(np.asarray(metadata_map.boxes, dtype=np.int32))
+            map_labels.append(np.asarray(metadata_map.labels, dtype=np.int32))
+    columns = {
+        'word_texts': np.array([str(text) for text in texts], dtype=str) if texts else np.zeros(0, dtype='U1'),
+        'word_boxes': np.concatenate(boxes) if boxes else np.zeros((0, 4), dtype=np.float64),
+        'word_counts': np.array(word_counts, dtype=np.int64),
+        'map_boxes': np.concatenate(map_boxes) if map_boxes else np.zeros((0, 4), dtype=np.int32),
+        'map_labels': np.concatenate(map_labels) if map_labels else np.zeros(0, dtype=np.int32),
+        'map_counts': np.array(map_counts, dtype=np.int64)}
+    # The statistics of the pages are only read when pages are added or removed
+    for name, arrays in statistics.items():
+        columns['statistics_' + name] = np.concatenate(arrays)
+    paths = set()
+    for name, column in columns.items():
+        path = get_column_path(folder, name, generation)
+        write_atomic(path, lambda f: np.save(f, column, allow_pickle=False))
+        paths.add(path)
+    # The manifest switches to the new files
+    manifest_data = json.dumps({'version': FORMAT_VERSION, 'generation': generation, 'page_types': manifest})
+    write_atomic(os.path.join(folder, 'manifest.json'), lambda f: f.write(manifest_data.encode('utf-8')))
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        if name.endswith('.npy') and path not in paths:
+            os.remove(path)
+
+def load_page_types(cluster, location: str = None, mmap: bool = True):
+    with lock_cluster(cluster.cluster_id, location, shared=True):
+        read_page_types(cluster, location, mmap)
+
+def read_page_types(cluster, location: str = None, mmap: bool = True):
+    folder = get_path('ptype', cluster.cluster_id, '', location)
+    manifest_path = os.path.join(folder, 'manifest.json')
+    generation = 0
+    if os.path.isdir(folder) and os.path.exists(manifest_path):
+        page_types, generation = read_page_type_files(cluster, folder, manifest_path, mmap)
+    else:
+        legacy = load_legacy_object('ptype', cluster.cluster_id, location)
+        page_types = [convert_legacy_page_type(page_type, cluster, str(i)) for i, page_type in enumerate(legacy or [])]
+    for page_type in page_types:
+        page_type.parent_cluster = cluster
+    page_type_ids = {page_type.id: page_type for page_type in page_types}
+    for record in read_log(cluster.cluster_id, generation, location):
+        if record['op'] in ('page', 'remove'):
+            page_type = page_type_ids.get(record['page_type'])
+            if page_type is None:
+                page_type = PageType(cluster, record['page_type'])
+                page_types.append(page_type)
+                page_type_ids[page_type.id] = page_type
+            page_type.apply_change(record)
+    # Page types of which all pages were removed
+    cluster.page_types = [page_type for page_type in page_types if page_type.number_of_pages > 0]
+
+def read_page_type_files(cluster, folder: str, manifest_path: str, mmap: bool) -> tuple[list[PageType], int]:
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    check_version(manifest, manifest_path)
+    generation = manifest.get('generation', 0)
+    columns = {name: np.load(get_column_path(folder, name, generation), mmap_mode='r' if mmap else None,
+                             allow_pickle=False)
+               for name in ('word_texts', 'word_boxes', 'word_counts', 'map_boxes', 'map_labels', 'map_counts')}
+    word_offsets = np.concatenate([[0], np.cumsum(columns['word_counts'])])
+    map_offsets = np.concatenate([[0], np.cumsum(columns['map_counts'])])
+    # Page types saved before version 3 have no statistics
+    statistics_offsets = {}
+    for attributes in manifest['page_types']:
+        for name, length in attributes.get('statistics', {}).items():
+            statistics_offsets.setdefault(name, [0]).append(statistics_offsets[name][-1] + length)
+    statistics = {name: np.load(get_column_path(folder, 'statistics_' + name, generation),
+                                mmap_mode='r' if mmap else None, allow_pickle=False)
+                  for name in statistics_offsets}
+    page_types = []
+    for i, attributes in enumerate(manifest['page_types']):
+        page_type = PageType(cluster, attributes.get('id', str(i)))
+        page_type.number_of_pages = attributes['number_of_pages']
+        if 'statistics' in attributes:
+            page_type.statistics = {name: column[statistics_offsets[name][i]:statistics_offsets[name][i + 1]]
+                                    for name, column in statistics.items()}
+        # Slices of memory mapped arrays are views into the mapped files
+        if attributes['words']:
+            page_type.word_texts = columns['word_texts'][word_offsets[i]:word_offsets[i + 1]]
+            page_type.word_boxes = columns['word_boxes'][word_offsets[i]:word_offsets[i + 1]]
+        if attributes['map_shape'] is not None:
+            page_type.metadata_map = BoxMap.from_arrays(tuple(attributes['map_shape']),
+                                                        columns['map_boxes'][map_offsets[i]:map_offsets[i + 1]],
+                                                        columns['map_labels'][map_offsets[i]:map_offsets[i + 1]])
+        page_types.append(page_type)
+    return page_types, generation
+
+def append_cluster_changes(cluster, location: str = None) -> int:
+    # Appends what changed in the loaded components since they were loaded or last appended to the log of the
+    # cluster, so saving costs the size of the changes instead of the size of the model. Returns the log size.
+    records = []
+    dictionary = cluster._dictionary
+    if dictionary is not None:
+        words = [word for word in dictionary.to_list()[cluster.persisted_words:] if word is not None]
+        if words:
+            records.append({'op': 'words', 'words': words})
+    synonyms = cluster._synonyms
+    synonym_changes = len(synonyms.changes) if synonyms is not None else 0
+    if synonym_changes:
+        records.append({'op': 'synonyms', 'synonyms': [list(change) for change in synonyms.changes]})
+    page_type_changes = []
+    removed_page_types = len(cluster.removed_page_types)
+    for page_type in (cluster._page_types or []) + cluster.removed_page_types:
+        page_type_changes.append((page_type, len(page_type.changes)))
+        for change in page_type.changes:
+            records.append(dict(change, page_type=page_type.id))
+    if not records:
+        return 0
+    data = ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records).encode('utf-8')
+    with lock_cluster(cluster.cluster_id, location):
+        path = get_log_path(cluster.cluster_id, get_generation(cluster.cluster_id, location), location)
+        repair_log(path)
+        with open(path, 'ab') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        size = os.path.getsize(path)
+    if dictionary is not None:
+        cluster.persisted_words = dictionary.next_id - 1
+    if synonym_changes:
+        del synonyms.changes[:synonym_changes]
+    for page_type, count in page_type_changes:
+        del page_type.changes[:count]
+    del cluster.removed_page_types[:removed_page_types]
+    return size
+
+def compact_cluster(cluster_id: str, metadata: dict[str, str], location: str = None):
+    # Folds the logs of a cluster into new model files. The cluster is rebuilt from the files (not from a loaded
+    # cluster) so that the changes other processes appended are kept.
+    with lock_cluster(cluster_id, location):
+        generation = get_generation(cluster_id, location)
+        compacted = DocumentCluster(None, cluster_id, metadata)
+        read_dictionary(compacted, location)
+        read_synonyms(compacted, location)
+        read_page_types(compacted, location, mmap=False)
+        # New changes go to the next log before the model files are replaced. Until then readers still replay the
+        # logs of the current generation on top of the old files.
+        save_json({'generation': generation + 1}, 'delta', os.path.join(cluster_id, 'generation'), location)
+        save_dictionary(compacted, location, generation + 1)
+        save_synonyms(compacted, location, generation + 1)
+        save_page_types(compacted, location, generation + 1)
+        for log_generation in get_log_generations(cluster_id, location):
+            if log_generation <= generation:
+                os.remove(get_log_path(cluster_id, log_generation, location))
+    _logger.debug('Compacted cluster {0} to generation {1}'.format(cluster_id, generation + 1))
+
+def save_document_cluster(cluster, location: str = None, compact: bool = None):
+    # Compacts when the log outgrows MODEL_LOG_SIZE unless compact says otherwise
+    size = append_cluster_changes(cluster, location)
+    if compact or (compact is None and size > MODEL_LOG_SIZE):
+        compact_cluster(cluster.cluster_id, cluster.metadata, location)
+
+def load_document_cluster(cluster, dictionary=True, synonyms=True, page_types=True, location: str = None):
     if dictionary:
-        load_dictionary(cluster)
+        load_dictionary(cluster, location)
     if synonyms:
-        load_synonyms(cluster)
+        load_synonyms(cluster, location)
     if page_types:
-        load_page_types(cluster)
+        load_page_types(cluster, location)
 
-def save_document_type(document_type):
-    keys = [key for key in document_type.cluster_map.keys()]
-    save_object(keys, 'doctype', document_type.mayan_document_type)
+# A document type is stored as a single index with the ids, metadata, groupby values and synonyms of its clusters
+def save_document_type(document_type, location: str = None):
+    # Other processes may have added clusters since the index was loaded, so it is merged with the stored one
+    with lock_document_type(document_type, location):
+        merge_document_type(document_type, location)
 
-def load_document_type(document_type):
-    keys = load_object('doctype', document_type.mayan_document_type)
+def lock_document_type(document_type, location: str = None):
+    return lock_file(get_path('index', document_type.mayan_document_type, '.lock', location))
+
+def merge_document_type(document_type, location: str = None):
+    # Must be called with the lock of the document type
+    stored = load_json('index', document_type.mayan_document_type, location)
+    clusters = dict.fromkeys(stored['clusters']) if stored is not None else {}
+    clusters.update(dict.fromkeys(document_type.cluster_map.keys()))
+    cluster_index = ClusterIndex.from_dict(stored['index']) if stored is not None else ClusterIndex()
+    cluster_index.update(document_type.cluster_index.to_dict())
+    save_json({'clusters': list(clusters), 'index': cluster_index.to_dict()}, 'index',
+              document_type.mayan_document_type, location)
+
+def load_document_type(document_type, location: str = None):
+    index = load_json('index', document_type.mayan_document_type, location)
+    if index is None:
+        index = load_legacy_document_type(document_type, location)
+    keys = index['clusters']
     if keys and len(keys) > 0:
-        document_type.cluster_map = dict.fromkeys(keys)
\ No newline at end of file
+        document_type.cluster_map = dict.fromkeys(keys)
+    document_type.cluster_index = ClusterIndex.from_dict(index['index'])
+    if any(key not in document_type.cluster_index for key in document_type.cluster_map.keys()):
+        index_legacy_clusters(document_type, location)
+    missing = [key for key in document_type.cluster_map.keys() if key not in document_type.cluster_index]
+    if len(missing) > 0:
+        _logger.warning('{0} clusters of document type {1} are not indexed and will not be matched'.format(
+            len(missing), document_type.mayan_document_type))
+
+def index_legacy_clusters(document_type, location: str = None):
+    # Clusters stored before the cluster index existed are indexed from the metadata in their legacy page types. The
+    # index is saved right away so the legacy files are read once instead of by every process that loads it.
+    try:
+        with lock_document_type(document_type, location):
+            stored = load_json('index', document_type.mayan_document_type, location)
+            if stored is not None:
+                # Another process may have indexed them in the meantime
+                document_type.cluster_index.update(stored['index'])
+            recovered = 0
+            for cluster_id in [key for key in document_type.cluster_map.keys()
+                               if key not in document_type.cluster_index]:
+                try:
+                    legacy = load_legacy_object('ptype', cluster_id, location)
+                except Exception as e:
+                    _logger.warning('Could not read the legacy page types of cluster {0}: {1}'.format(cluster_id, e))
+                    continue
+                mayan_document_type, metadata = get_legacy_cluster_metadata(legacy)
+                if metadata is not None and mayan_document_type == document_type.mayan_document_type:
+                    index_stored_cluster(document_type, cluster_id, metadata, location)
+                    recovered += 1
+            if recovered > 0:
+                merge_document_type(document_type, location)
+    except OSError as e:
+        # Read only model storages are indexed by migration.migrate_model_storage
+        _logger.warning('Could not index the legacy clusters of document type {0}: {1}'.format(
+            document_type.mayan_document_type, e))
+
+def index_stored_cluster(document_type, cluster_id: str, metadata: dict[str, str], location: str = None):
+    # Adds a stored cluster and the synonyms of its values to the cluster index of its document type
+    document_type.cluster_map.setdefault(cluster_id, None)
+    document_type.cluster_index.add_cluster(cluster_id, metadata)
+    cluster = DocumentCluster(None, cluster_id, metadata)
+    load_synonyms(cluster, location)
+    for synonym, value in cluster.synonyms.items():
+        document_type.cluster_index.add_synonym(cluster_id, value, synonym)
+
+def load_legacy_document_type(document_type, location: str = None) -> dict:
+    # Pickled cluster keys without a cluster index
+    keys = load_legacy_object('doctype', document_type.mayan_document_type, location)
+    return {'clusters': keys or [], 'index': {}}
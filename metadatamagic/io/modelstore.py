@@ -0,0 +1,155 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from ..model import DocumentCluster, DocumentType, PageStatistics
+from .configloader import MODEL_CACHE_SIZE
+from .modelio import (load_dictionary, load_document_type, load_page_types, load_synonyms, save_document_cluster,
+                      save_document_type)
+
+__all__ = ['ModelStore', 'get_model_store']
+
+_logger = logging.getLogger(__name__)
+
+_default_store = None
+_default_store_pid = None
+_default_store_lock = threading.Lock()
+
+# Rough per entry sizes of the python objects in dictionaries and synonym indexes
+DICTIONARY_ENTRY_SIZE = 160
+SYNONYM_ENTRY_SIZE = 320
+
+_LOADERS = {'dictionary': load_dictionary, 'synonyms': load_synonyms, 'page_types': load_page_types}
+
+
+def get_model_store():
+    # One store per process (forked workers start with an empty one)
+    global _default_store, _default_store_pid
+    with _default_store_lock:
+        if _default_store is None or _default_store_pid != os.getpid():
+            _default_store = ModelStore(MODEL_CACHE_SIZE)
+            _default_store_pid = os.getpid()
+        return _default_store
+
+
+def estimate_size(cluster: DocumentCluster) -> int:
+    size = 0
+    if cluster.is_loaded('dictionary'):
+        size += len(cluster._dictionary) * DICTIONARY_ENTRY_SIZE
+    if cluster.is_loaded('synonyms'):
+        size += len(cluster._synonyms) * SYNONYM_ENTRY_SIZE
+    if cluster.is_loaded('page_types'):
+        for page_type in cluster._page_types:
+            for value in page_type.__dict__.values():
+                if isinstance(value, np.ndarray):
+                    size += value.nbytes
+            # Without deriving the map (or loading the statistics) only for measuring them
+            if page_type._metadata_map is not None:
+                size += page_type._metadata_map.boxes.nbytes + page_type._metadata_map.labels.nbytes
+            if isinstance(page_type._statistics, PageStatistics):
+                size += page_type._statistics.nbytes
+    return size
+
+
+class ModelStore:
+
+    # Document types are loaded from their index only. Clusters are created on first access and their components
+    # (dictionary, synonyms, page types) are loaded separately when they are used. Loaded clusters are kept in a least
+    # recently used order and unloaded once their estimated size exceeds memory_budget. Changed clusters are never
+    # unloaded before they were saved.
+    def __init__(self, memory_budget: int = MODEL_CACHE_SIZE) -> None:
+        self.memory_budget = memory_budget
+        self._document_types = {}
+        # (document type, cluster id) -> (cluster, estimated size)
+        self._loaded = OrderedDict()
+        self._size = 0
+        self._lock = threading.RLock()
+
+    def get_document_type(self, mayan_document_type: str) -> DocumentType:
+        with self._lock:
+            document_type = self._document_types.get(mayan_document_type)
+            if document_type is None:
+                document_type = DocumentType(mayan_document_type, store=self)
+                load_document_type(document_type)
+                self._document_types[mayan_document_type] = document_type
+            return document_type
+
+    def get_cluster(self, mayan_document_type: str, cluster_id: str) -> DocumentCluster:
+        return self.get_document_type(mayan_document_type).get_cluster(cluster_id)
+
+    def load_component(self, cluster: DocumentCluster, name: str):
+        with self._lock:
+            if not cluster.is_loaded(name):
+                _LOADERS[name](cluster)
+            self._update(cluster)
+            self._evict()
+
+    def touch(self, cluster: DocumentCluster):
+        key = (cluster.document_type.mayan_document_type, cluster.cluster_id)
+        with self._lock:
+            if key in self._loaded:
+                self._loaded.move_to_end(key)
+
+    def save_cluster(self, cluster: DocumentCluster, compact: bool = None):
+        # Only the changes of the loaded components are appended (see modelio.save_document_cluster)
+        with self._lock:
+            save_document_cluster(cluster, compact=compact)
+            cluster.dirty = False
+            self._update(cluster)
+            self._evict()
+
+    def unload_cluster(self, cluster: DocumentCluster):
+        # Frees a cluster that is not needed anymore (it is loaded again on its next use)
+        key = (cluster.document_type.mayan_document_type, cluster.cluster_id)
+        with self._lock:
+            if cluster.dirty:
+                self.save_cluster(cluster)
+            entry = self._loaded.pop(key, None)
+            if entry is not None:
+                self._size -= entry[1]
+            cluster.unload()
+
+    def save_document_type(self, document_type: DocumentType):
+        with self._lock:
+            save_document_type(document_type)
+
+    def save(self):
+        with self._lock:
+            for cluster, _ in list(self._loaded.values()):
+                if cluster.dirty:
+                    try:
+                        self.save_cluster(cluster)
+                    except Exception as e:
+                        # The cluster stays dirty (and loaded) and is saved with the next attempt
+                        _logger.exception('Could not save cluster {0}: {1}'.format(cluster.cluster_id, e))
+            for document_type in self._document_types.values():
+                self.save_document_type(document_type)
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def _update(self, cluster: DocumentCluster):
+        key = (cluster.document_type.mayan_document_type, cluster.cluster_id)
+        previous = self._loaded.pop(key, None)
+        if previous is not None:
+            self._size -= previous[1]
+        size = estimate_size(cluster)
+        self._loaded[key] = (cluster, size)
+        self._size += size
+
+    def _evict(self):
+        # The most recently used cluster always stays loaded
+        for key in list(self._loaded.keys())[:-1]:
+            if self._size <= self.memory_budget:
+                break
+            cluster, size = self._loaded[key]
+            if cluster.dirty:
+                continue
+            _logger.debug('Unloading cluster %s of document type %s', key[1], key[0])
+            cluster.unload()
+            del self._loaded[key]
+            self._size -= size
@@ -0,0 +1,118 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from .configloader import OCR_CACHE_LOCATION, OCR_CACHE_SIZE
+
+__all__ = ['ResultStore', 'get_result_store']
+
+_logger = logging.getLogger(__name__)
+
+# Eviction frees the store down to this share of its maximum size so that it does not rescan with every new entry
+EVICTION_TARGET = 0.9
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+def get_result_store():
+    global _default_store
+    if OCR_CACHE_LOCATION is None:
+        return None
+    with _default_store_lock:
+        if _default_store is None:
+            _default_store = ResultStore(OCR_CACHE_LOCATION, OCR_CACHE_SIZE)
+        return _default_store
+
+
+class ResultStore:
+
+    # Content addressed store for OCR results. Entries are keyed by the checksum of the source file and the
+    # recognition model that produced them and evicted least recently used first once max_size bytes are exceeded.
+    def __init__(self, location: str, max_size: int) -> None:
+        self.location = location
+        self.max_size = max_size
+        self._size = None
+        self._lock = threading.Lock()
+
+    def get_path(self, checksum: str, model_name: str) -> str:
+        key = hashlib.sha1(str.encode('{0}:{1}'.format(checksum, model_name))).hexdigest()
+        return os.path.join(self.location, key[:2], key + '.json.gz')
+
+    def get(self, checksum: str, model_name: str) -> list[dict]:
+        path = self.get_path(checksum, model_name)
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                pages = json.load(f)
+            # The modification time doubles as last access time for the eviction
+            os.utime(path)
+            return pages
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            _logger.warning('Could not read OCR result {0}: {1}'.format(path, e))
+            return None
+
+    def put(self, checksum: str, model_name: str, pages: list[dict]):
+        path = self.get_path(checksum, model_name)
+        folder = os.path.dirname(path)
+        tmp_path = None
+        try:
+            os.makedirs(folder, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as raw, gzip.open(raw, 'wt', encoding='utf-8') as f:
+                json.dump(pages, f)
+            os.replace(tmp_path, path)
+            tmp_path = None
+            self._add_size(os.path.getsize(path))
+        except Exception as e:
+            _logger.warning('Could not store OCR result {0}: {1}'.format(path, e))
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def invalidate(self, checksum: str, model_name: str):
+        path = self.get_path(checksum, model_name)
+        if os.path.exists(path):
+            size = os.path.getsize(path)
+            os.remove(path)
+            self._add_size(-size)
+
+    def _entries(self) -> list[tuple[float, int, str]]:
+        entries = []
+        for root, _, files in os.walk(self.location):
+            for file in files:
+                if file.endswith('.json.gz'):
+                    path = os.path.join(root, file)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _add_size(self, size: int):
+        with self._lock:
+            if self._size is None:
+                self._size = sum(entry[1] for entry in self._entries())
+            else:
+                self._size += size
+            if self._size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        # Rescan because other processes may share the store
+        entries = sorted(self._entries())
+        self._size = sum(entry[1] for entry in entries)
+        target = self.max_size * EVICTION_TARGET
+        for _, size, path in entries:
+            if self._size <= target:
+                break
+            try:
+                os.remove(path)
+                self._size -= size
+            except FileNotFoundError:
+                pass
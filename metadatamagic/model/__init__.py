@@ -1,4 +1,9 @@
 """A package for the document model."""
 
 from .cluster import *
+from .clusterindex import *
 from .document import *
+from .geometry import *
+from .pagemap import *
+from .pagestatistics import *
+from .vocabulary import *
@@ -1,13 +1,21 @@
 import logging
 import hashlib
+import uuid
 import numpy as np
 
+from .clusterindex import ClusterIndex
 from .document import BoundingBox, Document, Page
+from .geometry import words_in_lines
+from .pagemap import BoxMap
+from .pagestatistics import PageStatistics
+from .vocabulary import SynonymIndex, Vocabulary
 
 CLUSTER_RESOLUTION = (round(3508/2), round(2480/2))
 PAGE_TYPE_MIN_FIT = 20
+# Share of the pages of a page type that a word has to appear on to be a template word
+PAGE_TYPE_TEMPLATE_SHARE = 1.0
 
-__all__ = ['DocumentCluster', 'DocumentType', 'create_page_map']
+__all__ = ['DocumentCluster', 'DocumentType', 'PageType', 'find_page_type']
 
 _logger = logging.getLogger(__name__)
 
@@ -27,47 +35,124 @@ def get_page_metadata(page: Page):
 def get_best_fit_page_type():
     pass
 
-def create_page_map(dictionary: dict, page: Page) -> np.array:
-    page_map = np.zeros(shape=CLUSTER_RESOLUTION, dtype=int)
-    for word in page.words:
-        top = round(word.position.left_top.y * CLUSTER_RESOLUTION[0])
-        bot = round(word.position.right_bot.y * CLUSTER_RESOLUTION[0])
-        left = round(word.position.left_top.x * CLUSTER_RESOLUTION[1])
-        right = round(word.position.right_bot.x * CLUSTER_RESOLUTION[1])
-        page_map[top: bot, left: right] = dictionary[word.text]
-    return page_map
+def to_map_coordinates(boxes: np.ndarray) -> np.ndarray:
+    # Page boxes (x0, y0, x1, y1) in the range 0..1 to map boxes (top, bot, left, right)
+    return np.round(boxes[:, [1, 3, 0, 2]] * np.array(CLUSTER_RESOLUTION)[[0, 0, 1, 1]]).astype(np.int64)
 
-# TODO: Make removal of pages possible...
+
+def get_page_key(page: Page) -> str:
+    # Identifies the page for removing it from its page type again (None for documents without an id)
+    document_id = getattr(page.parentdocument, 'mayan_document_id', None)
+    if document_id is None:
+        return None
+    return '{0}/{1}'.format(document_id, page.index)
+
+
+def find_page_type(page_types: list, page: Page):
+    if len(page_types) == 0:
+        return None
+    best_fit = 0
+    best_fit_page_type = None
+    for page_type in page_types:
+        fit = page_type.calculate_fit(page)
+        if fit > best_fit:
+            best_fit = fit
+            best_fit_page_type = page_type
+        min_fit = PAGE_TYPE_MIN_FIT
+        # When we already merged two pages we should come close to 100 in the following successions (OCR errors and the like )
+    if page_type.number_of_pages > 1:
+        min_fit = 95
+    if best_fit >= min_fit:
+        return best_fit_page_type
 
 
 class PageType:
 
-    def __init__(self, parent_cluster) -> None:
+    def __init__(self, parent_cluster, page_type_id: str = None) -> None:
         self.parent_cluster = parent_cluster
+        # Stable id of the page type for the change logs of the cluster
+        self.id = page_type_id or uuid.uuid4().hex
         self.number_of_pages = 0
-        self.words = None
-        self.metadata_map = None
-    
-    def remove_page(self, page: Page):
-        # TODO: Do stuff
-        pass
+        # Texts and boxes (x0, y0, x1, y1) of the template words and the metadata map. They are derived from the
+        # statistics of the pages when they are needed.
+        self._word_texts = None
+        self._word_boxes = None
+        self._metadata_map = None
+        self._derived = True
+        # PageStatistics, or the arrays of stored statistics until they are needed
+        self._statistics = None
+        # Pages added or removed since the page type was last persisted (see apply_change)
+        self.changes = []
+
+    def __getstate__(self):
+        # The cluster is set again when the page types are loaded (and is not needed when they are sent to workers).
+        # Workers only match and predict pages so the statistics stay here.
+        self.__derive()
+        state = self.__dict__.copy()
+        state['parent_cluster'] = None
+        state['_statistics'] = None
+        state['changes'] = []
+        return state
+
+    @property
+    def word_texts(self) -> np.ndarray:
+        self.__derive()
+        return self._word_texts
+
+    @word_texts.setter
+    def word_texts(self, word_texts: np.ndarray):
+        self._word_texts = word_texts
+
+    @property
+    def word_boxes(self) -> np.ndarray:
+        self.__derive()
+        return self._word_boxes
+
+    @word_boxes.setter
+    def word_boxes(self, word_boxes: np.ndarray):
+        self._word_boxes = word_boxes
+
+    @property
+    def metadata_map(self) -> BoxMap:
+        self.__derive()
+        return self._metadata_map
+
+    @metadata_map.setter
+    def metadata_map(self, metadata_map: BoxMap):
+        self._metadata_map = metadata_map
+
+    @property
+    def statistics(self) -> PageStatistics:
+        if self._statistics is None:
+            # Page types that were learned without statistics start from their template
+            self.__derive()
+            self._statistics = PageStatistics.from_template(self._word_texts, self._word_boxes, self._metadata_map,
+                                                            self.number_of_pages)
+        elif isinstance(self._statistics, dict):
+            self._statistics = PageStatistics.from_arrays(self._statistics)
+        return self._statistics
+
+    @statistics.setter
+    def statistics(self, statistics):
+        self._statistics = statistics
+
+    def get_statistics_arrays(self) -> dict[str, np.ndarray]:
+        # Stored statistics that were not needed are saved as they are
+        if isinstance(self._statistics, dict):
+            return self._statistics
+        return self.statistics.to_arrays()
+
+    def remove_page(self, page: Page) -> bool:
+        key = get_page_key(page)
+        if key is None or not self.statistics.remove_page(key):
+            return False
+        self.__update()
+        self.changes.append({'op': 'remove', 'page': key})
+        return True
 
     def add_page(self, page: Page):
-        self.remove_page(page)
-        if self.words is None:
-            self.words = page.words
-        else:
-            delete = []
-            for word in self.words:
-                overlap = False
-                for new_word in page.words:
-                    if word.text == new_word.text:
-                        if word.position.overlaps(new_word.position):
-                            overlap = True
-                            break
-                if not overlap:
-                    delete.append(word)
-            self.words = [word for word in self.words if word not in delete]
+        geometry = page.geometry
+        votes = []
         # TODO Return an easier to handle data structure and/or make an occurrence class in Metadata class
         metadatas = get_page_metadata(page)
         for metadata in metadatas:
@@ -78,57 +163,106 @@ class PageType:
                 self.parent_cluster.add_synonym(mayan_metadata_value, text)
             # TODO: Skip the location mapping for metadata that is part of the cluster id
             position = metadata[1][2]
-            # There could be collisions here as well (especially when metadata is split across lines). This might hurt more...
-            self.__map_metadata(metadata[0].metadata_name, position)
-        self.number_of_pages += 1
+            # Collisions (especially when metadata is split across lines) are decided by the votes of all pages
+            votes.append(self.__get_vote(metadata[0].metadata_name, position))
+        # Adding a page again replaces it
+        key = self.statistics.add_page(get_page_key(page), geometry.word_texts, geometry.word_boxes, votes)
+        self.__update()
+        self.changes.append({'op': 'page', 'page': key, 'texts': [str(text) for text in geometry.word_texts],
+                             'boxes': geometry.word_boxes.tolist(), 'paint': votes})
+
+    def apply_change(self, change: dict):
+        # Replays a change recorded by add_page or remove_page without the page itself
+        if change['op'] == 'remove':
+            self.statistics.remove_page(change['page'])
+        else:
+            self.statistics.add_page(change.get('page'), change['texts'], change['boxes'], change['paint'])
+        self.__update()
 
-    def __map_metadata(self, mayan_metadata_name: str, position: BoundingBox):
+    def __update(self):
+        self.number_of_pages = self.statistics.number_of_pages
+        self._derived = False
+
+    def __derive(self):
+        if not self._derived:
+            self._word_texts, self._word_boxes = self._statistics.template(PAGE_TYPE_TEMPLATE_SHARE)
+            self._metadata_map = self._statistics.metadata_map(CLUSTER_RESOLUTION)
+            self._derived = True
+
+    def __get_vote(self, mayan_metadata_name: str, position: BoundingBox) -> list[int]:
+        top = round(position.y0 * CLUSTER_RESOLUTION[0])
+        bot = round(position.y1 * CLUSTER_RESOLUTION[0])
+        left = round(position.x0 * CLUSTER_RESOLUTION[1])
+        right = round(position.x1 * CLUSTER_RESOLUTION[1])
+        return [top, bot, left, right, self.parent_cluster.dictionary[mayan_metadata_name]]
+
+    def locate_label(self, page: Page, label: int) -> list[tuple[int, float]]:
+        # Words of the page inside the area of a metadata label as (word index, covered fraction of the word)
         if self.metadata_map is None:
-            self.metadata_map = np.zeros(shape=CLUSTER_RESOLUTION, dtype=int)
-        top = round(position.left_top.y * CLUSTER_RESOLUTION[0])
-        bot = round(position.right_bot.y * CLUSTER_RESOLUTION[0])
-        left = round(position.left_top.x * CLUSTER_RESOLUTION[1])
-        right = round(position.right_bot.x * CLUSTER_RESOLUTION[1])
-        self.metadata_map[top: bot,
-                          left: right] = self.parent_cluster.dictionary[mayan_metadata_name]
+            return []
+        region, mask = self.metadata_map.mask(label)
+        if region is None:
+            return []
+        top, bot, left, right = region
+        height, width = CLUSTER_RESOLUTION
+        query = np.array([[left / width, top / height, right / width, bot / height]])
+        _, words = page.spatial_index.query_many(query)
+        candidates = []
+        for word, (word_top, word_bot, word_left, word_right) in zip(
+                words, to_map_coordinates(page.geometry.word_boxes[words])):
+            area = (word_bot - word_top) * (word_right - word_left)
+            if area <= 0:
+                continue
+            covered = np.count_nonzero(mask[max(word_top, top) - top: min(word_bot, bot) - top,
+                                            max(word_left, left) - left: min(word_right, right) - left])
+            if covered > 0:
+                candidates.append((int(word), covered / area))
+        return sorted(candidates, key=lambda candidate: candidate[1], reverse=True)
 
     def calculate_fit(self, page: Page):
-        if self.words is None or len(self.words) == 0:
+        if self.word_texts is None or len(self.word_texts) == 0:
             return 0
         else:
-            matches = 0
-            for new_word in page.words:
-                found_current = False
-                for block in page.blocks:
-                    if block.position.overlaps(new_word.position):
-                        for line in block.lines:
-                            if line.position.overlaps(new_word.position):
-                                for word in self.words:
-                                    if word.text == new_word.text:
-                                        if word.position.overlaps(new_word.position):
-                                            matches += 1
-                                            found_current = True
-                                            break
-                            if found_current:
-                                break
-                    if found_current:
-                        break
-            return round((matches / len(self.words)) * 100)
+            geometry = page.geometry
+            # A page word matches when it lies in a line of the page and overlaps a template word with the same text
+            index = page.spatial_index
+            _, page_index = index.query_many(self.word_boxes, self.word_texts)
+            matched = np.zeros(geometry.number_of_words, dtype=bool)
+            matched[page_index] = True
+            matches = int(np.count_nonzero(matched & words_in_lines(geometry, index)))
+            return round((matches / len(self.word_texts)) * 100)
 
 class DocumentType:
 
-    def __init__(self, mayan_document_type: str) -> None:
+    def __init__(self, mayan_document_type: str, store=None) -> None:
         self.mayan_document_type = mayan_document_type
+        # Clusters that have not been used yet are None
         self.cluster_map = {}
+        # Metadata values and synonyms of all clusters for finding candidate clusters of a document
+        self.cluster_index = ClusterIndex()
+        # Loads the components of the clusters on first access (see io.ModelStore)
+        self.store = store
     
     def get_document_cluster(self, metadata: dict[str, str]):
         cluster_id = get_cluster_id(self.mayan_document_type, metadata)
-        if cluster_id in self.cluster_map and self.cluster_map[cluster_id] is not None:
-            return self.cluster_map[cluster_id]
-        else:
+        cluster = self.get_cluster(cluster_id)
+        if cluster is None:
+            # Either a new cluster or a stored one that is not indexed
             cluster = DocumentCluster(self, cluster_id, metadata)
             self.cluster_map[cluster.cluster_id] = cluster
-            return cluster
+            self.cluster_index.add_cluster(cluster.cluster_id, metadata)
+        return cluster
+
+    def get_cluster(self, cluster_id: str):
+        # Clusters of loaded document types are only created when they are needed
+        cluster = self.cluster_map.get(cluster_id)
+        if cluster is None and cluster_id in self.cluster_index:
+            cluster = DocumentCluster(self, cluster_id, self.cluster_index.get_metadata(cluster_id))
+            self.cluster_map[cluster_id] = cluster
+        return cluster
+
+    def add_synonym(self, cluster, word: str, synonym: str):
+        self.cluster_index.add_synonym(cluster.cluster_id, word, synonym)
 
 class DocumentCluster:
 
@@ -136,37 +270,99 @@ class DocumentCluster:
         self.document_type = document_type
         self.cluster_id = cluster_id
         self.metadata = metadata
-        self.dictionary = None
-        self.synonyms = None
-        self.page_types = None
+        # Vocabulary (word <-> id) of all words seen in the cluster
+        self._dictionary = None
+        # SynonymIndex (synonym -> metadata value and back)
+        self._synonyms = None
+        self._page_types = None
+        # Changed since the cluster was last saved
+        self.dirty = False
+        # Number of words of the dictionary that are already persisted
+        self.persisted_words = 0
+        # Page types that lost all of their pages and still have changes that are not persisted
+        self.removed_page_types = []
+
+    # The components are loaded separately through the store of the document type when they are first needed
+    def _get_component(self, name: str):
+        value = getattr(self, '_' + name)
+        store = self.document_type.store if self.document_type is not None else None
+        if store is not None:
+            if value is None:
+                store.load_component(self, name)
+                value = getattr(self, '_' + name)
+            else:
+                store.touch(self)
+        return value
+
+    @property
+    def dictionary(self) -> Vocabulary:
+        return self._get_component('dictionary')
+
+    @dictionary.setter
+    def dictionary(self, dictionary: Vocabulary):
+        self._dictionary = dictionary
+
+    @property
+    def synonyms(self) -> SynonymIndex:
+        return self._get_component('synonyms')
+
+    @synonyms.setter
+    def synonyms(self, synonyms: SynonymIndex):
+        self._synonyms = synonyms
+
+    @property
+    def page_types(self) -> list[PageType]:
+        return self._get_component('page_types')
+
+    @page_types.setter
+    def page_types(self, page_types: list[PageType]):
+        self._page_types = page_types
+
+    def is_loaded(self, name: str) -> bool:
+        return getattr(self, '_' + name) is not None
+
+    def unload(self):
+        self._dictionary = None
+        self._synonyms = None
+        self._page_types = None
 
     def add_document(self, document: Document):
+        self.dirty = True
+        # Learning a document again replaces its pages (which may have been matched to other page types)
+        self.remove_document(document)
         self.__update_dictionary(document)
         self.__update_page_types(document)
 
+    def remove_document(self, document: Document) -> int:
+        # Un-learns the pages of a document (e.g. one that was put into the wrong cluster). Words and synonyms stay.
+        # Returns the number of removed pages.
+        removed = 0
+        for page in document.pages:
+            for page_type in self.page_types:
+                if page_type.remove_page(page):
+                    removed += 1
+                    break
+        if removed > 0:
+            self.dirty = True
+            self.removed_page_types.extend(page_type for page_type in self.page_types if page_type.number_of_pages == 0)
+            self.page_types[:] = [page_type for page_type in self.page_types if page_type.number_of_pages > 0]
+        return removed
+
     def add_synonym(self, word: str, synonym: str):
+        self.dirty = True
         self.synonyms[synonym] = word
-        self.document_type
+        self.document_type.add_synonym(self, word, synonym)
 
     def __update_dictionary(self, document: Document):
         for word in document.words:
-            if word.text not in self.dictionary:
-                self.dictionary[word.text] = len(self.dictionary) + 1
+            self.dictionary.add(word.text)
+
+    def get_metadata_candidates(self, metadata_name: str) -> list[str]:
+        value = self.metadata[metadata_name]
+        return self.synonyms.synonyms_of(value) + [value]
     
     def get_page_type_for_document_page(self, page: Page) -> PageType:
-        best_fit = 0
-        best_fit_page_type = None
-        for page_type in self.page_types:
-            fit = page_type.calculate_fit(page)
-            if fit > best_fit:
-                best_fit = fit
-                best_fit_page_type = page_type
-            min_fit = PAGE_TYPE_MIN_FIT
-            # When we already merged two pages we should come close to 100 in the following successions (OCR errors and the like )
-        if page_type.number_of_pages > 1:
-            min_fit = 95
-        if best_fit >= min_fit:
-            return best_fit_page_type
+        return find_page_type(self.page_types, page)
 
     def __update_page_types(self, document: Document):
         for page in document.pages:
@@ -0,0 +1,123 @@
+import logging
+import re
+
+__all__ = ['ClusterIndex', 'get_trigrams']
+
+_logger = logging.getLogger(__name__)
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def get_trigrams(text: str) -> set[str]:
+    # Character trigrams of the normalized text. The padding also indexes the start and end of words.
+    text = ' ' + _WHITESPACE.sub(' ', text.lower()).strip() + ' '
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class ClusterIndex:
+
+    # Inverted index (character trigram -> strings) over the metadata values and synonyms of all clusters of a
+    # document type. It is used to find the few clusters whose values can appear on a document at all before the
+    # (expensive) fuzzy matching runs.
+    def __init__(self) -> None:
+        # cluster id -> metadata of the cluster
+        self._metadata = {}
+        # cluster id -> metadata name -> strings (dict used as ordered set)
+        self._strings = {}
+        # string id -> (cluster id, metadata name, number of trigrams)
+        self._entries = []
+        self._entry_ids = {}
+        # trigram -> string ids
+        self._postings = {}
+
+    @classmethod
+    def from_dict(cls, clusters: dict):
+        index = cls()
+        index.update(clusters)
+        return index
+
+    def update(self, clusters: dict):
+        # Adds the clusters of a to_dict result (metadata of known clusters is replaced, strings are added)
+        for cluster_id, cluster in clusters.items():
+            self.add_cluster(cluster_id, cluster['metadata'])
+            for metadata_name, strings in cluster['strings'].items():
+                for string in strings:
+                    self.add_string(cluster_id, metadata_name, string)
+
+    def to_dict(self) -> dict:
+        return {cluster_id: {'metadata': dict(metadata),
+                             'strings': {name: list(strings) for name, strings in self._strings[cluster_id].items()}}
+                for cluster_id, metadata in self._metadata.items()}
+
+    def __contains__(self, cluster_id: str) -> bool:
+        return cluster_id in self._metadata
+
+    def __len__(self) -> int:
+        return len(self._metadata)
+
+    def get_metadata(self, cluster_id: str) -> dict[str, str]:
+        return self._metadata.get(cluster_id)
+
+    def get_strings(self, cluster_id: str, metadata_names: list[str]) -> dict[str, list[str]]:
+        strings = self._strings.get(cluster_id, {})
+        return {name: list(strings[name]) for name in metadata_names if name in strings}
+
+    def add_cluster(self, cluster_id: str, metadata: dict[str, str]):
+        self._metadata[cluster_id] = dict(metadata)
+        self._strings.setdefault(cluster_id, {})
+        for metadata_name, metadata_value in metadata.items():
+            self.add_string(cluster_id, metadata_name, metadata_value)
+
+    def add_synonym(self, cluster_id: str, value: str, synonym: str):
+        # Synonyms are indexed for every metadata of the cluster that has the synonymous value
+        for metadata_name, metadata_value in self._metadata.get(cluster_id, {}).items():
+            if metadata_value == value:
+                self.add_string(cluster_id, metadata_name, synonym)
+
+    def add_string(self, cluster_id: str, metadata_name: str, string: str):
+        if not isinstance(string, str):
+            return
+        strings = self._strings.setdefault(cluster_id, {}).setdefault(metadata_name, {})
+        if string in strings:
+            return
+        strings[string] = None
+        trigrams = get_trigrams(string)
+        key = (cluster_id, metadata_name, frozenset(trigrams))
+        if key in self._entry_ids:
+            # Strings that only differ in case or whitespace share their entry
+            return
+        entry_id = len(self._entries)
+        self._entry_ids[key] = entry_id
+        self._entries.append((cluster_id, metadata_name, len(trigrams)))
+        for trigram in trigrams:
+            self._postings.setdefault(trigram, []).append(entry_id)
+
+    def find_candidates(self, texts: list[str], metadata_names: list[str], min_share: float,
+                        max_candidates: int = None) -> list[str]:
+        # Clusters with at least one string of the given metadata of which min_share of the trigrams appear in the
+        # texts, ordered by the mean best share over the metadata
+        document_trigrams = set()
+        for text in texts:
+            document_trigrams.update(get_trigrams(text))
+        hits = {}
+        for trigram in document_trigrams:
+            for entry_id in self._postings.get(trigram, ()):
+                hits[entry_id] = hits.get(entry_id, 0) + 1
+        names = set(metadata_names)
+        best_shares = {}
+        for entry_id, count in hits.items():
+            cluster_id, metadata_name, number_of_trigrams = self._entries[entry_id]
+            if metadata_name not in names:
+                continue
+            shares = best_shares.setdefault(cluster_id, {})
+            shares[metadata_name] = max(shares.get(metadata_name, 0), count / number_of_trigrams)
+        candidates = []
+        for cluster_id, shares in best_shares.items():
+            if max(shares.values()) >= min_share:
+                indexed_names = [name for name in self._strings[cluster_id] if name in names]
+                candidates.append((sum(shares.values()) / len(indexed_names), cluster_id))
+        candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+        if max_candidates is not None:
+            candidates = candidates[:max_candidates]
+        _logger.debug('Found %s candidate clusters out of %s', len(candidates), len(self._metadata))
+        return [cluster_id for _, cluster_id in candidates]
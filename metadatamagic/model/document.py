@@ -1,30 +1,63 @@
 import logging
+import os
 from datetime import datetime
 from typing import Any
 from price_parser import Price
 
-__all__ = ['Document', 'Page', 'Block', 'Line', 'Word', 'Metadata', 'DateMetadata', 'MoneyMetadata', 'BoundingBox', 'Point']
+from .geometry import PageGeometry, SpatialIndex
+
+__all__ = ['Document', 'PdfFile', 'Page', 'Block', 'Line', 'Word', 'Metadata', 'DateMetadata', 'MoneyMetadata', 'MetadataCandidate', 'BoundingBox', 'Point']
 
 _logger = logging.getLogger(__name__)
 
 
 class Point:
 
+    __slots__ = ('x', 'y')
+
     def __init__(self, x, y) -> None:
         self.x = x
         self.y = y
     
     def is_inside_box(self, box):
-        return (box.left_top.x <= self.x <= box.right_bot.x and box.left_top.y <= self.y <= box.right_bot.y)
+        return (box.x0 <= self.x <= box.x1 and box.y0 <= self.y <= box.y1)
 
 
 class BoundingBox:
 
+    __slots__ = ('x0', 'y0', 'x1', 'y1')
+
     def __init__(self, position) -> None:
-        self.left_top = Point(position[0][0], position[0][1])
-        self.left_bot = Point(position[0][0], position[1][1])
-        self.right_top = Point(position[1][0], position[0][1])
-        self.right_bot = Point(position[1][0], position[1][1])
+        self.x0 = position[0][0]
+        self.y0 = position[0][1]
+        self.x1 = position[1][0]
+        self.y1 = position[1][1]
+
+    @classmethod
+    def from_coordinates(cls, coordinates: tuple):
+        box = cls.__new__(cls)
+        box.x0, box.y0, box.x1, box.y1 = coordinates
+        return box
+
+    @property
+    def left_top(self) -> Point:
+        return Point(self.x0, self.y0)
+
+    @property
+    def left_bot(self) -> Point:
+        return Point(self.x0, self.y1)
+
+    @property
+    def right_top(self) -> Point:
+        return Point(self.x1, self.y0)
+
+    @property
+    def right_bot(self) -> Point:
+        return Point(self.x1, self.y1)
+
+    @property
+    def coordinates(self) -> tuple:
+        return (self.x0, self.y0, self.x1, self.y1)
     
     def __iter__(self):
         yield self.left_top
@@ -33,56 +66,61 @@ class BoundingBox:
         yield self.left_bot
     
     def overlaps(self, box) -> bool:
-        for corner in self:
-            if corner.is_inside_box(box):
-                return True
-        for corner in box:
-            if corner.is_inside_box(self):
-                return True
-        return False
+        # A corner of one box lies inside the other box. The corners are all combinations of the x and y
+        # coordinates so this is the same as one x and one y coordinate lying inside the other box.
+        return ((box.x0 <= self.x0 <= box.x1 or box.x0 <= self.x1 <= box.x1)
+                and (box.y0 <= self.y0 <= box.y1 or box.y0 <= self.y1 <= box.y1)) or \
+            ((self.x0 <= box.x0 <= self.x1 or self.x0 <= box.x1 <= self.x1)
+             and (self.y0 <= box.y0 <= self.y1 or self.y0 <= box.y1 <= self.y1))
+
+
+class PdfFile:
+
+    # A pdf that lives in a (spool) file on disk instead of memory. Only the path is pickled so it can be handed
+    # to worker processes cheaply.
+    def __init__(self, path: str, delete: bool = True) -> None:
+        self.path = path
+        # Remove the file on release (spooled downloads and intermediate results)
+        self.delete = delete
+
+    def __fspath__(self):
+        return self.path
+
+    def read(self) -> bytes:
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def release(self):
+        if self.delete and self.path and os.path.exists(self.path):
+            os.remove(self.path)
+        self.path = None
+
 
 class Document:
 
-    def __init__(self, mayan_document_id, mayan_document_type, mayan_metadata, pdf) -> None:
+    def __init__(self, mayan_document_id, mayan_document_type, mayan_metadata, pdf, checksum: str = None) -> None:
         self.mayan_document_id = mayan_document_id
         self.mayan_document_type = mayan_document_type
         self.mayan_metadata = mayan_metadata
+        # Either the pdf bytes or a file backed PdfFile
         self.pdf = pdf
+        # Checksum of the source file in Mayan
+        self.checksum = checksum
         self.pages = []
         self.blocks = []
         self.lines = []
         self.words = []
         self.metadata = []
 
+    def release_pdf(self):
+        if isinstance(self.pdf, PdfFile):
+            self.pdf.release()
+        self.pdf = None
+
 
 class PageElement():
 
-    def __init__(self, parent, position=None, dimensions=None) -> None:
-        if isinstance(self, Page):
-            self.parentdocument = parent
-            # (height, width)
-            self.dimensions = dimensions
-            self.blocks = []
-            self.lines = []
-            self.words = []
-            return
-        if isinstance(self, Block):
-            self.parentpage = parent
-            self.parentdocument = self.parentpage.parentdocument
-            self.lines = []
-            self.words = []
-        if isinstance(self, Line):
-            self.parentblock = parent
-            self.parentpage = self.parentblock.parentpage
-            self.parentdocument = self.parentpage.parentdocument
-            self.words = []
-        if isinstance(self, Word):
-            self.parentline = parent
-            self.parentblock = self.parentline.parentblock
-            self.parentpage = self.parentblock.parentpage
-            self.parentdocument = self.parentpage.parentdocument
-        if position:
-            self.position = BoundingBox(position)
+    __slots__ = ()
 
     def get_parent(self):
         if isinstance(self, Page):
@@ -120,38 +158,145 @@ class PageElement():
     def set_position(self, position: tuple):
         if not isinstance(self, Page):
             if position:
-                self.position = BoundingBox(position)
+                self.position = position
 
 
 class Page(PageElement):
 
+    __slots__ = ('index', 'language', 'parentdocument', 'dimensions', 'blocks', 'lines', 'words', 'metadata',
+                 'geometry', '_spatial_index')
+
     def __init__(self, index, language, parentdocument: Document, dimensions: tuple) -> None:
-        super().__init__(parentdocument, dimensions=dimensions)
         self.index = index
         self.language = language
         self.parentdocument = parentdocument
+        # (height, width)
         self.dimensions = dimensions
         self.blocks = []
+        self.lines = []
+        self.words = []
         self.metadata = []
+        # Boxes and texts of all blocks, lines and words of the page
+        self.geometry = PageGeometry()
+        self._spatial_index = None
+
+    def __getstate__(self):
+        # The spatial index is derived from the geometry and rebuilt on demand
+        return {slot: getattr(self, slot) for slot in Page.__slots__ if slot != '_spatial_index'}
+
+    def __setstate__(self, state):
+        for slot, value in state.items():
+            setattr(self, slot, value)
+        self._spatial_index = None
+
+    @property
+    def spatial_index(self) -> SpatialIndex:
+        if self._spatial_index is None:
+            self.build_index()
+        return self._spatial_index
+
+    def build_index(self) -> SpatialIndex:
+        self._spatial_index = SpatialIndex.from_geometry(self.geometry)
+        return self._spatial_index
+
+    def add_word(self, word):
+        self._spatial_index = None
+        super().add_word(word)
+
+    def get_word(self, index: int):
+        # Word for an index into the page geometry (words are normally added in geometry order)
+        if index < len(self.words) and self.words[index].index == index:
+            return self.words[index]
+        return next(word for word in self.words if word.index == index)
 
 
 class Block(PageElement):
 
+    __slots__ = ('parentpage', 'index', 'lines', 'words')
+
     def __init__(self, parentpage: Page, position: tuple) -> None:
-        super().__init__(parentpage, position=position)
+        self.parentpage = parentpage
+        self.index = parentpage.geometry.add_block(position)
+        self.lines = []
+        self.words = []
+
+    @property
+    def parentdocument(self) -> Document:
+        return self.parentpage.parentdocument
+
+    @property
+    def position(self) -> BoundingBox:
+        return get_bounding_box(self.parentpage.geometry.block_box(self.index))
+
+    @position.setter
+    def position(self, position):
+        self.parentpage.geometry.set_block_box(self.index, position)
 
 
 class Line(PageElement):
 
+    __slots__ = ('parentblock', 'index', 'words')
+
     def __init__(self, parentblock: Block, position: tuple) -> None:
-        super().__init__(parentblock, position=position)
+        self.parentblock = parentblock
+        self.index = parentblock.parentpage.geometry.add_line(parentblock.index, position)
+        self.words = []
+
+    @property
+    def parentpage(self) -> Page:
+        return self.parentblock.parentpage
+
+    @property
+    def parentdocument(self) -> Document:
+        return self.parentblock.parentpage.parentdocument
+
+    @property
+    def position(self) -> BoundingBox:
+        return get_bounding_box(self.parentblock.parentpage.geometry.line_box(self.index))
+
+    @position.setter
+    def position(self, position):
+        self.parentblock.parentpage.geometry.set_line_box(self.index, position)
 
 
 class Word(PageElement):
 
+    __slots__ = ('parentline', 'index')
+
     def __init__(self, text: str, parentline: Line, position: tuple) -> None:
-        super().__init__(parentline, position=position)
-        self.text = text
+        self.parentline = parentline
+        self.index = parentline.parentpage.geometry.add_word(parentline.index, text, position)
+
+    @property
+    def parentblock(self) -> Block:
+        return self.parentline.parentblock
+
+    @property
+    def parentpage(self) -> Page:
+        return self.parentline.parentblock.parentpage
+
+    @property
+    def parentdocument(self) -> Document:
+        return self.parentline.parentblock.parentpage.parentdocument
+
+    @property
+    def text(self) -> str:
+        return self.parentline.parentblock.parentpage.geometry.word_text(self.index)
+
+    @property
+    def position(self) -> BoundingBox:
+        return get_bounding_box(self.parentline.parentblock.parentpage.geometry.word_box(self.index))
+
+    @position.setter
+    def position(self, position):
+        self.parentline.parentblock.parentpage.geometry.set_word_box(self.index, position)
+
+
+def get_bounding_box(coordinates: tuple) -> BoundingBox:
+    # Missing positions are stored as NaN
+    if coordinates[0] != coordinates[0]:
+        return None
+    return BoundingBox.from_coordinates(coordinates)
 
 
 class Metadata():
@@ -175,3 +320,20 @@ class MoneyMetadata(Metadata):
 
     def __init__(self, metadata_name: str, metadata_type: str, metadata_value: Price) -> None:
         super().__init__(metadata_name, metadata_type, metadata_value)
+
+
+class MetadataCandidate():
+
+    def __init__(self, metadata_name: str, page: Page, words: list[Word], score: float) -> None:
+        self.metadata_name = metadata_name
+        self.page = page
+        self.words = words
+        # Fraction of the words that lies inside the learned metadata location (0..1)
+        self.score = score
+
+    @property
+    def text(self) -> str:
+        return ' '.join(word.text for word in self.words)
+
+    def __repr__(self):
+        return '{0}: {1} (page {2}, score {3:.2f})'.format(self.metadata_name, self.text, self.page.index, self.score)
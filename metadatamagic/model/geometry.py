@@ -0,0 +1,309 @@
+import logging
+from array import array
+
+import numpy as np
+
+__all__ = ['PageGeometry', 'SpatialIndex', 'boxes_overlap', 'overlap_matrix', 'overlapping_text_pairs']
+
+_logger = logging.getLogger(__name__)
+
+_MISSING = (float('nan'),) * 4
+MAX_GRID_SIZE = 64
+
+
+def get_coordinates(position) -> tuple:
+    if not position:
+        return _MISSING
+    if hasattr(position, 'x0'):
+        return (position.x0, position.y0, position.x1, position.y1)
+    return (position[0][0], position[0][1], position[1][0], position[1][1])
+
+
+class PageGeometry:
+
+    # Columnar storage of all block, line and word boxes of a page. Boxes are stored as (x0, y0, x1, y1) and
+    # word texts are interned in a per page text table. Block, Line and Word objects are views on these columns.
+    __slots__ = ('texts', '_text_ids', '_block_boxes', '_line_boxes', '_line_blocks', '_word_boxes', '_word_lines',
+                 '_word_texts', '_arrays')
+
+    def __init__(self) -> None:
+        self.texts = []
+        self._text_ids = {}
+        self._block_boxes = array('d')
+        self._line_boxes = array('d')
+        self._line_blocks = array('i')
+        self._word_boxes = array('d')
+        self._word_lines = array('i')
+        self._word_texts = array('i')
+        self._arrays = {}
+
+    def __getstate__(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__ if slot not in ('_text_ids', '_arrays')}
+
+    def __setstate__(self, state):
+        for slot, value in state.items():
+            setattr(self, slot, value)
+        self._text_ids = {text: text_id for text_id, text in enumerate(self.texts)}
+        self._arrays = {}
+
+    @property
+    def number_of_words(self) -> int:
+        return len(self._word_texts)
+
+    def intern(self, text: str) -> int:
+        text_id = self._text_ids.get(text)
+        if text_id is None:
+            text_id = len(self.texts)
+            self.texts.append(text)
+            self._text_ids[text] = text_id
+        return text_id
+
+    def add_block(self, position) -> int:
+        self._block_boxes.extend(get_coordinates(position))
+        self._arrays.clear()
+        return len(self._block_boxes) // 4 - 1
+
+    def add_line(self, block: int, position) -> int:
+        self._line_boxes.extend(get_coordinates(position))
+        self._line_blocks.append(block)
+        self._arrays.clear()
+        return len(self._line_blocks) - 1
+
+    def add_word(self, line: int, text: str, position) -> int:
+        self._word_boxes.extend(get_coordinates(position))
+        self._word_lines.append(line)
+        self._word_texts.append(self.intern(text))
+        self._arrays.clear()
+        return len(self._word_texts) - 1
+
+    def get_box(self, boxes: array, index: int) -> tuple:
+        start = index * 4
+        return (boxes[start], boxes[start + 1], boxes[start + 2], boxes[start + 3])
+
+    def set_box(self, boxes: array, index: int, position):
+        boxes[index * 4: index * 4 + 4] = array('d', get_coordinates(position))
+        self._arrays.clear()
+
+    def block_box(self, index: int) -> tuple:
+        return self.get_box(self._block_boxes, index)
+
+    def line_box(self, index: int) -> tuple:
+        return self.get_box(self._line_boxes, index)
+
+    def word_box(self, index: int) -> tuple:
+        return self.get_box(self._word_boxes, index)
+
+    def set_block_box(self, index: int, position):
+        self.set_box(self._block_boxes, index, position)
+
+    def set_line_box(self, index: int, position):
+        self.set_box(self._line_boxes, index, position)
+
+    def set_word_box(self, index: int, position):
+        self.set_box(self._word_boxes, index, position)
+
+    def word_text(self, index: int) -> str:
+        return self.texts[self._word_texts[index]]
+
+    def line_block(self, index: int) -> int:
+        return self._line_blocks[index]
+
+    def word_line(self, index: int) -> int:
+        return self._word_lines[index]
+
+    def _array(self, name: str, column: array, dtype, shape=None) -> np.ndarray:
+        result = self._arrays.get(name)
+        if result is None:
+            result = np.array(column, dtype=dtype)
+            if shape:
+                result = result.reshape(shape)
+            # Arrays are shared views of the page, they must not be modified by callers
+            result.flags.writeable = False
+            self._arrays[name] = result
+        return result
+
+    @property
+    def block_boxes(self) -> np.ndarray:
+        return self._array('block_boxes', self._block_boxes, np.float64, (-1, 4))
+
+    @property
+    def line_boxes(self) -> np.ndarray:
+        return self._array('line_boxes', self._line_boxes, np.float64, (-1, 4))
+
+    @property
+    def line_blocks(self) -> np.ndarray:
+        return self._array('line_blocks', self._line_blocks, np.int32)
+
+    @property
+    def word_boxes(self) -> np.ndarray:
+        return self._array('word_boxes', self._word_boxes, np.float64, (-1, 4))
+
+    @property
+    def word_lines(self) -> np.ndarray:
+        return self._array('word_lines', self._word_lines, np.int32)
+
+    @property
+    def word_blocks(self) -> np.ndarray:
+        result = self._arrays.get('word_blocks')
+        if result is None:
+            result = self.line_blocks[self.word_lines]
+            self._arrays['word_blocks'] = result
+        return result
+
+    @property
+    def word_text_ids(self) -> np.ndarray:
+        return self._array('word_text_ids', self._word_texts, np.int32)
+
+    @property
+    def word_texts(self) -> np.ndarray:
+        result = self._arrays.get('word_texts')
+        if result is None:
+            result = np.array(self.texts, dtype=object)[self.word_text_ids]
+            self._arrays['word_texts'] = result
+        return result
+
+
+def _inside(value: np.ndarray, low: np.ndarray, high: np.ndarray) -> np.ndarray:
+    return (low <= value) & (value <= high)
+
+
+def boxes_overlap(boxes_a: np.ndarray, boxes_b: np.ndarray) -> np.ndarray:
+    # Vectorised BoundingBox.overlaps on the last axis (x0, y0, x1, y1). Broadcasts like any NumPy operation.
+    ax0, ay0, ax1, ay1 = boxes_a[..., 0], boxes_a[..., 1], boxes_a[..., 2], boxes_a[..., 3]
+    bx0, by0, bx1, by1 = boxes_b[..., 0], boxes_b[..., 1], boxes_b[..., 2], boxes_b[..., 3]
+    a_in_b = ((_inside(ax0, bx0, bx1) | _inside(ax1, bx0, bx1))
+              & (_inside(ay0, by0, by1) | _inside(ay1, by0, by1)))
+    b_in_a = ((_inside(bx0, ax0, ax1) | _inside(bx1, ax0, ax1))
+              & (_inside(by0, ay0, ay1) | _inside(by1, ay0, ay1)))
+    return a_in_b | b_in_a
+
+
+def overlap_matrix(boxes_a: np.ndarray, boxes_b: np.ndarray) -> np.ndarray:
+    return boxes_overlap(boxes_a[:, None, :], boxes_b[None, :, :])
+
+
+def join_sorted(sorted_keys: np.ndarray, query_keys: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # All pairs (i, j) with query_keys[i] == sorted_keys[j] without building the full cross product
+    left = np.searchsorted(sorted_keys, query_keys, side='left')
+    counts = np.searchsorted(sorted_keys, query_keys, side='right') - left
+    return expand_ranges(left, counts)
+
+
+def expand_ranges(starts: np.ndarray, counts: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # Pairs (i, starts[i] + k) for every k < counts[i]
+    owner = np.repeat(np.arange(len(starts)), counts)
+    offsets = np.cumsum(counts) - counts
+    return owner, starts[owner] + np.arange(len(owner)) - offsets[owner]
+
+
+def same_text_pairs(texts_a: np.ndarray, texts_b: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # All index pairs (i, j) with texts_a[i] == texts_b[j]
+    if len(texts_a) == 0 or len(texts_b) == 0:
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+    _, inverse = np.unique(np.concatenate([texts_a, texts_b]), return_inverse=True)
+    inverse = inverse.reshape(-1)
+    ids_a = inverse[:len(texts_a)]
+    ids_b = inverse[len(texts_a):]
+    order = np.argsort(ids_b, kind='stable')
+    index_a, position = join_sorted(ids_b[order], ids_a)
+    return index_a, order[position]
+
+
+def overlapping_text_pairs(boxes_a: np.ndarray, texts_a: np.ndarray,
+                           boxes_b: np.ndarray, texts_b: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # All index pairs of words with the same text whose boxes overlap
+    index_a, index_b = same_text_pairs(texts_a, texts_b)
+    mask = boxes_overlap(boxes_a[index_a], boxes_b[index_b])
+    return index_a[mask], index_b[mask]
+
+
+def words_in_lines(geometry: PageGeometry, index=None) -> np.ndarray:
+    # Words that are overlapped by a line whose block overlaps them as well
+    if index is None:
+        index = SpatialIndex.from_geometry(geometry)
+    lines, words = index.query_many(geometry.line_boxes)
+    blocks = geometry.block_boxes[geometry.line_blocks[lines]]
+    result = np.zeros(geometry.number_of_words, dtype=bool)
+    result[words[boxes_overlap(blocks, geometry.word_boxes[words])]] = True
+    return result
+
+
+def get_grid_size(number_of_boxes: int) -> int:
+    # About one word per cell on average
+    return int(min(MAX_GRID_SIZE, max(1, np.sqrt(number_of_boxes))))
+
+
+class SpatialIndex:
+
+    # Uniform grid over the page coordinates (0..1). Every box is registered in all cells it touches, once sorted
+    # by cell and once by (text, cell), so range queries with or without a text filter are binary searches.
+    __slots__ = ('boxes', 'text_ids', 'lookup', 'grid_size', 'cell_keys', 'cell_items', 'text_keys', 'text_items')
+
+    def __init__(self, boxes: np.ndarray, text_ids: np.ndarray = None, lookup: dict = None,
+                 grid_size: int = None) -> None:
+        self.boxes = boxes
+        self.text_ids = text_ids
+        # text -> text id
+        self.lookup = lookup
+        self.grid_size = grid_size or get_grid_size(len(boxes))
+        valid = np.flatnonzero(~np.isnan(boxes).any(axis=1))
+        items, cells = self.cells(boxes[valid])
+        items = valid[items]
+        order = np.argsort(cells, kind='stable')
+        self.cell_keys = cells[order]
+        self.cell_items = items[order]
+        if text_ids is not None:
+            keys = text_ids[items].astype(np.int64) * self.grid_size ** 2 + cells
+            order = np.argsort(keys, kind='stable')
+            self.text_keys = keys[order]
+            self.text_items = items[order]
+        else:
+            self.text_keys = None
+            self.text_items = None
+
+    @classmethod
+    def from_geometry(cls, geometry: PageGeometry, grid_size: int = None):
+        return cls(geometry.word_boxes, geometry.word_text_ids, geometry._text_ids, grid_size)
+
+    def cells(self, boxes: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        # (box index, cell) for every grid cell touched by a box
+        limit = self.grid_size - 1
+        scaled = np.clip(np.floor(boxes * self.grid_size), 0, limit).astype(np.int64)
+        x0, y0 = np.minimum(scaled[:, 0], scaled[:, 2]), np.minimum(scaled[:, 1], scaled[:, 3])
+        widths = np.abs(scaled[:, 2] - scaled[:, 0]) + 1
+        heights = np.abs(scaled[:, 3] - scaled[:, 1]) + 1
+        owner, local = expand_ranges(np.zeros(len(boxes), dtype=np.int64), widths * heights)
+        cells = (y0[owner] + local // widths[owner]) * self.grid_size + x0[owner] + local % widths[owner]
+        return owner, cells
+
+    def query_many(self, boxes: np.ndarray, texts=None) -> tuple[np.ndarray, np.ndarray]:
+        # All pairs (query, item) of overlapping boxes (BoundingBox.overlaps semantics), optionally restricted to
+        # items whose text equals the text of the query. Pairs are sorted by query and item.
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        if len(self.boxes) == 0 or len(boxes) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        valid = np.flatnonzero(~np.isnan(boxes).any(axis=1))
+        if texts is not None:
+            query_text_ids = np.array([self.lookup.get(text, -1) for text in texts], dtype=np.int64)
+            valid = valid[query_text_ids[valid] >= 0]
+        queries, cells = self.cells(boxes[valid])
+        queries = valid[queries]
+        if texts is None:
+            matches, position = join_sorted(self.cell_keys, cells)
+            items = self.cell_items[position]
+        else:
+            keys = query_text_ids[queries] * self.grid_size ** 2 + cells
+            matches, position = join_sorted(self.text_keys, keys)
+            items = self.text_items[position]
+        queries = queries[matches]
+        # Boxes spanning several cells are found once per shared cell
+        pairs = np.unique(queries * len(self.boxes) + items)
+        queries, items = pairs // len(self.boxes), pairs % len(self.boxes)
+        mask = boxes_overlap(boxes[queries], self.boxes[items])
+        return queries[mask], items[mask]
+
+    def query(self, box, text: str = None) -> np.ndarray:
+        if hasattr(box, 'x0'):
+            box = (box.x0, box.y0, box.x1, box.y1)
+        _, items = self.query_many(np.array([box], dtype=np.float64), None if text is None else [text])
+        return items
@@ -0,0 +1,162 @@
+import logging
+
+import numpy as np
+
+__all__ = ['BoxMap']
+
+_logger = logging.getLogger(__name__)
+
+
+def split_intervals(starts: np.ndarray, ends: np.ndarray) -> list[np.ndarray]:
+    # Indices of the groups of overlapping half open intervals
+    order = np.argsort(starts, kind='stable')
+    reach = np.maximum.accumulate(ends[order])
+    return np.split(order, np.flatnonzero(starts[order][1:] >= reach[:-1]) + 1)
+
+def group_boxes(boxes: np.ndarray) -> list[np.ndarray]:
+    # Groups of boxes (top, bot, left, right) that overlap on the y axis and then on the x axis within each band.
+    # Boxes of different groups never overlap.
+    groups = []
+    for band in split_intervals(boxes[:, 0], boxes[:, 1]):
+        for group in split_intervals(boxes[band, 2], boxes[band, 3]):
+            groups.append(np.sort(band[group]))
+    return groups
+
+def get_runs(dense: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # One box per run of equal labels in a row, runs with the same columns in consecutive rows are merged
+    padded = np.pad(dense, ((0, 0), (1, 1)))
+    rows, columns = np.nonzero(padded[:, 1:] != padded[:, :-1])
+    same_row = rows[:-1] == rows[1:]
+    rows, starts, ends = rows[:-1][same_row], columns[:-1][same_row], columns[1:][same_row]
+    labels = dense[rows, starts]
+    runs = labels != 0
+    rows, starts, ends, labels = rows[runs], starts[runs], ends[runs], labels[runs]
+    order = np.lexsort((rows, labels, ends, starts))
+    rows, starts, ends, labels = rows[order], starts[order], ends[order], labels[order]
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = ((rows[1:] != rows[:-1] + 1) | (starts[1:] != starts[:-1]) | (ends[1:] != ends[:-1])
+                 | (labels[1:] != labels[:-1]))
+    heads = np.flatnonzero(first)
+    bots = np.append(rows[heads[1:] - 1], rows[-1:]) + 1 if len(heads) > 0 else rows[heads]
+    return np.stack([rows[heads], bots, starts[heads], ends[heads]], axis=1), labels[heads]
+
+
+class BoxMap:
+
+    # Label map stored as the list of painted boxes (top, bot, left, right) instead of a dense raster. Boxes are
+    # painted in order so later boxes overwrite earlier ones, exactly like assigning slices of a dense array.
+    __slots__ = ('shape', 'boxes', 'labels')
+
+    def __init__(self, shape: tuple[int, int], boxes: np.ndarray = None, labels: np.ndarray = None) -> None:
+        self.shape = tuple(shape)
+        self.boxes = np.zeros((0, 4), dtype=self.coordinate_dtype)
+        self.labels = np.zeros(0, dtype=np.int32)
+        if boxes is not None and len(boxes) > 0:
+            self.paint_many(boxes, labels)
+
+    @property
+    def coordinate_dtype(self):
+        return np.int16 if max(self.shape) < np.iinfo(np.int16).max else np.int32
+
+    def __len__(self):
+        return len(self.labels)
+
+    def paint(self, top: int, bot: int, left: int, right: int, label: int):
+        self.paint_many(np.array([[top, bot, left, right]]), np.array([label]))
+
+    def paint_many(self, boxes: np.ndarray, labels: np.ndarray):
+        boxes = np.asarray(boxes).reshape(-1, 4)
+        labels = np.asarray(labels).reshape(-1)
+        # Clip like slicing a dense array and drop boxes that would not paint a single cell
+        boxes = np.stack([np.clip(boxes[:, 0], 0, self.shape[0]), np.clip(boxes[:, 1], 0, self.shape[0]),
+                          np.clip(boxes[:, 2], 0, self.shape[1]), np.clip(boxes[:, 3], 0, self.shape[1])], axis=1)
+        keep = (boxes[:, 0] < boxes[:, 1]) & (boxes[:, 2] < boxes[:, 3])
+        self.boxes = np.concatenate([self.boxes, boxes[keep].astype(self.coordinate_dtype)])
+        self.labels = np.concatenate([self.labels, labels[keep].astype(np.int32)])
+
+    def window(self, top: int, bot: int, left: int, right: int) -> np.ndarray:
+        # Dense raster of a part of the map
+        result = np.zeros((bot - top, right - left), dtype=np.int32)
+        boxes = self.boxes
+        hits = np.flatnonzero((boxes[:, 0] < bot) & (boxes[:, 1] > top) & (boxes[:, 2] < right) & (boxes[:, 3] > left))
+        for i in hits:
+            box_top, box_bot, box_left, box_right = (int(value) for value in boxes[i])
+            result[max(box_top, top) - top: min(box_bot, bot) - top,
+                   max(box_left, left) - left: min(box_right, right) - left] = self.labels[i]
+        return result
+
+    def to_dense(self) -> np.ndarray:
+        return self.window(0, self.shape[0], 0, self.shape[1])
+
+    def label_boxes(self, label: int) -> np.ndarray:
+        # Painted boxes of a label (parts of them may be overwritten by later boxes)
+        return self.boxes[self.labels == label]
+
+    def region(self, label: int) -> tuple[int, int, int, int]:
+        boxes = self.label_boxes(label)
+        if len(boxes) == 0:
+            return None
+        return (int(boxes[:, 0].min()), int(boxes[:, 1].max()), int(boxes[:, 2].min()), int(boxes[:, 3].max()))
+
+    def mask(self, label: int) -> tuple[tuple[int, int, int, int], np.ndarray]:
+        # Cells of the label within its bounding region
+        region = self.region(label)
+        if region is None:
+            return None, None
+        return region, self.window(*region) == label
+
+    def labels_present(self) -> np.ndarray:
+        # Labels (without the background 0) that are still visible on the map
+        present = []
+        for label in np.unique(self.labels):
+            _, mask = self.mask(label)
+            if mask.any():
+                present.append(label)
+        return np.array(present, dtype=np.int32)
+
+    @classmethod
+    def from_arrays(cls, shape: tuple[int, int], boxes: np.ndarray, labels: np.ndarray):
+        # Uses the (already clipped) arrays as they are, e.g. memory mapped ones
+        box_map = cls(shape)
+        box_map.boxes = boxes
+        box_map.labels = labels
+        return box_map
+
+    @classmethod
+    def from_dense(cls, dense: np.ndarray):
+        boxes, labels = get_runs(dense)
+        return cls(dense.shape, boxes, labels)
+
+    @classmethod
+    def from_votes(cls, shape: tuple[int, int], boxes: np.ndarray, labels: np.ndarray, weights: np.ndarray = None):
+        # Every cell gets the label with the most (weighted) votes of the boxes covering it. Ties go to the label of
+        # the latest box. The boxes do not overlap, so the result is the same in any painting order.
+        box_map = cls(shape)
+        boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+        labels = np.asarray(labels, dtype=np.int64).reshape(-1)
+        weights = np.ones(len(labels), dtype=np.int64) if weights is None else np.asarray(weights, dtype=np.int64)
+        boxes = np.stack([np.clip(boxes[:, 0], 0, shape[0]), np.clip(boxes[:, 1], 0, shape[0]),
+                          np.clip(boxes[:, 2], 0, shape[1]), np.clip(boxes[:, 3], 0, shape[1])], axis=1)
+        keep = (boxes[:, 0] < boxes[:, 1]) & (boxes[:, 2] < boxes[:, 3])
+        boxes, labels, weights = boxes[keep], labels[keep], weights[keep]
+        if len(boxes) == 0:
+            return box_map
+        result_boxes, result_labels = [], []
+        for group in group_boxes(boxes):
+            top, bot = boxes[group, 0].min(), boxes[group, 1].max()
+            left, right = boxes[group, 2].min(), boxes[group, 3].max()
+            group_labels, label_index = np.unique(labels[group], return_inverse=True)
+            votes = np.zeros((len(group_labels), bot - top, right - left), dtype=np.int64)
+            latest = np.zeros(votes.shape, dtype=np.int64)
+            for order, (i, box) in enumerate(zip(label_index, boxes[group] - [top, top, left, left]), start=1):
+                votes[i, box[0]:box[1], box[2]:box[3]] += weights[group[order - 1]]
+                latest[i, box[0]:box[1], box[2]:box[3]] = order
+            # Votes first and the latest box second
+            score = votes * (len(group) + 1) + latest
+            winner = score.argmax(axis=0)
+            dense = np.where(votes.max(axis=0) > 0, group_labels[winner], 0)
+            runs, run_labels = get_runs(dense)
+            result_boxes.append(runs + [top, top, left, left])
+            result_labels.append(run_labels)
+        box_map.paint_many(np.concatenate(result_boxes), np.concatenate(result_labels))
+        return box_map
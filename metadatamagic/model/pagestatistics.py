@@ -0,0 +1,181 @@
+import logging
+import sys
+import uuid
+
+import numpy as np
+
+from .geometry import boxes_overlap
+from .pagemap import BoxMap
+
+__all__ = ['PageStatistics']
+
+_logger = logging.getLogger(__name__)
+
+
+class PageStatistics:
+
+    # Running statistics of the pages of a page type. Every word that appeared on a page is a candidate template word
+    # with the number of pages that have a word with the same text at an overlapping position (hits). The pages keep
+    # the candidates they hit and the metadata boxes they voted for, so they can be removed again.
+    def __init__(self) -> None:
+        self.texts = []
+        self._boxes = np.zeros((0, 4), dtype=np.float64)
+        self._hits = np.zeros(0, dtype=np.int64)
+        # page key -> (candidate ids, votes (top, bot, left, right, label))
+        self.pages = {}
+        # Pages learned before the statistics were kept and their votes (which can not be removed)
+        self.base_pages = 0
+        self.base_votes = np.zeros((0, 5), dtype=np.int32)
+        # text -> candidate ids, built on demand
+        self._candidates = None
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    @property
+    def boxes(self) -> np.ndarray:
+        return self._boxes[:len(self.texts)]
+
+    @property
+    def hits(self) -> np.ndarray:
+        return self._hits[:len(self.texts)]
+
+    @property
+    def number_of_pages(self) -> int:
+        return self.base_pages + len(self.pages)
+
+    @property
+    def nbytes(self) -> int:
+        # Rough memory use, texts are counted with the size of a short string
+        size = self._boxes.nbytes + self._hits.nbytes + self.base_votes.nbytes + len(self.texts) * 64
+        for hits, votes in self.pages.values():
+            size += hits.nbytes + votes.nbytes
+        return size
+
+    def add_page(self, key: str, texts, boxes: np.ndarray, votes: list) -> str:
+        # Costs O(words of the page) (plus the candidates sharing their texts). A page that is added again replaces
+        # its previous statistics. Returns the key of the page.
+        if key is None:
+            key = uuid.uuid4().hex
+        self.remove_page(key)
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        candidates = self.__get_candidates()
+        words, items = [], []
+        for i, text in enumerate(texts):
+            for item in candidates.get(text, ()):
+                words.append(i)
+                items.append(item)
+        matched = np.zeros(len(boxes), dtype=bool)
+        hit = np.zeros(0, dtype=np.int64)
+        if len(words) > 0:
+            words, items = np.array(words, dtype=np.int64), np.array(items, dtype=np.int64)
+            overlap = boxes_overlap(boxes[words], self.boxes[items])
+            matched[words[overlap]] = True
+            hit = np.unique(items[overlap])
+        # Words without a matching candidate become candidates themselves
+        new = np.flatnonzero(~matched)
+        start = len(self.texts)
+        self.__reserve(start + len(new))
+        self._boxes[start:start + len(new)] = boxes[new]
+        self._hits[start:start + len(new)] = 1
+        self._hits[hit] += 1
+        for offset, i in enumerate(new):
+            text = sys.intern(str(texts[i]))
+            self.texts.append(text)
+            candidates.setdefault(text, []).append(start + offset)
+        self.pages[key] = (np.concatenate([hit, np.arange(start, start + len(new))]).astype(np.int32),
+                           np.asarray(votes, dtype=np.int32).reshape(-1, 5))
+        return key
+
+    def remove_page(self, key: str) -> bool:
+        page = self.pages.pop(key, None)
+        if page is None:
+            return False
+        # Candidates without hits are kept, a later page may hit them again
+        self._hits[page[0]] -= 1
+        return True
+
+    def template(self, share: float) -> tuple[np.ndarray, np.ndarray]:
+        # Texts and boxes of the candidates that appear on at least the given share of the pages
+        number_of_pages = self.number_of_pages
+        if number_of_pages == 0:
+            return None, None
+        keep = np.flatnonzero(self.hits >= share * number_of_pages)
+        return np.array(self.texts, dtype=object)[keep], self.boxes[keep]
+
+    def metadata_map(self, shape: tuple[int, int]) -> BoxMap:
+        votes = [self.base_votes] + [page[1] for page in self.pages.values()]
+        weights = [np.full(len(self.base_votes), max(self.base_pages, 1), dtype=np.int64)] + \
+            [np.ones(len(page[1]), dtype=np.int64) for page in self.pages.values()]
+        votes = np.concatenate(votes)
+        if len(votes) == 0:
+            return None
+        return BoxMap.from_votes(shape, votes[:, :4], votes[:, 4], np.concatenate(weights))
+
+    @classmethod
+    def from_template(cls, word_texts: np.ndarray, word_boxes: np.ndarray, metadata_map: BoxMap,
+                      number_of_pages: int):
+        # Statistics of a page type that was learned without them. Its template words are hit by all of its pages
+        # and every cell of its map counts as a vote of all of its pages.
+        statistics = cls()
+        statistics.base_pages = number_of_pages
+        if word_texts is not None:
+            statistics.texts = [sys.intern(str(text)) for text in word_texts]
+            statistics._boxes = np.array(word_boxes, dtype=np.float64).reshape(-1, 4)
+            statistics._hits = np.full(len(statistics.texts), number_of_pages, dtype=np.int64)
+        if metadata_map is not None and len(metadata_map) > 0:
+            # Painted boxes may overlap, the runs of the dense map do not
+            runs = BoxMap.from_dense(metadata_map.to_dense())
+            boxes, labels = runs.boxes.astype(np.int32), runs.labels
+            statistics.base_votes = np.concatenate([boxes, labels[:, np.newaxis]], axis=1).astype(np.int32)
+        return statistics
+
+    def to_arrays(self) -> dict[str, np.ndarray]:
+        keys = list(self.pages.keys())
+        return {
+            'texts': np.array(self.texts, dtype=str) if self.texts else np.zeros(0, dtype='U1'),
+            'boxes': self.boxes,
+            'hits': self.hits,
+            'base_pages': np.array([self.base_pages], dtype=np.int64),
+            'base_votes': self.base_votes,
+            'page_keys': np.array(keys, dtype=str) if keys else np.zeros(0, dtype='U1'),
+            'page_hit_counts': np.array([len(self.pages[key][0]) for key in keys], dtype=np.int64),
+            'page_hits': np.concatenate([self.pages[key][0] for key in keys]) if keys else np.zeros(0, np.int32),
+            'page_vote_counts': np.array([len(self.pages[key][1]) for key in keys], dtype=np.int64),
+            'page_votes': np.concatenate([self.pages[key][1] for key in keys]) if keys else np.zeros((0, 5), np.int32)}
+
+    @classmethod
+    def from_arrays(cls, arrays: dict[str, np.ndarray]):
+        # Copies the (possibly memory mapped) arrays since the statistics are changed in place
+        statistics = cls()
+        statistics.texts = [sys.intern(str(text)) for text in arrays['texts']]
+        statistics._boxes = np.array(arrays['boxes'], dtype=np.float64).reshape(-1, 4)
+        statistics._hits = np.array(arrays['hits'], dtype=np.int64)
+        statistics.base_pages = int(arrays['base_pages'][0])
+        statistics.base_votes = np.array(arrays['base_votes'], dtype=np.int32).reshape(-1, 5)
+        hit_offsets = np.concatenate([[0], np.cumsum(arrays['page_hit_counts'])])
+        vote_offsets = np.concatenate([[0], np.cumsum(arrays['page_vote_counts'])])
+        page_votes = np.array(arrays['page_votes'], dtype=np.int32).reshape(-1, 5)
+        for i, key in enumerate(arrays['page_keys']):
+            statistics.pages[str(key)] = (np.array(arrays['page_hits'][hit_offsets[i]:hit_offsets[i + 1]],
+                                                   dtype=np.int32),
+                                          page_votes[vote_offsets[i]:vote_offsets[i + 1]])
+        return statistics
+
+    def __get_candidates(self) -> dict[str, list[int]]:
+        if self._candidates is None:
+            self._candidates = {}
+            for i, text in enumerate(self.texts):
+                self._candidates.setdefault(text, []).append(i)
+        return self._candidates
+
+    def __reserve(self, size: int):
+        # Candidate arrays grow geometrically so adding a page does not copy all candidates
+        if size <= len(self._hits):
+            return
+        capacity = max(size, 2 * len(self._hits), 64)
+        boxes = np.zeros((capacity, 4), dtype=np.float64)
+        hits = np.zeros(capacity, dtype=np.int64)
+        boxes[:len(self.texts)] = self.boxes
+        hits[:len(self.texts)] = self.hits
+        self._boxes, self._hits = boxes, hits
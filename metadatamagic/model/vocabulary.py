@@ -0,0 +1,141 @@
+import logging
+import sys
+
+__all__ = ['Vocabulary', 'SynonymIndex']
+
+_logger = logging.getLogger(__name__)
+
+
+class Vocabulary:
+
+    # Bidirectional word <-> id mapping of a cluster. Ids start at 1 because 0 is the background of page maps.
+    __slots__ = ('_ids', '_words')
+
+    def __init__(self, words: list[str] = None) -> None:
+        self._ids = {}
+        # Word of every id (index = id - 1)
+        self._words = []
+        for word in words or []:
+            self.add(word)
+
+    @classmethod
+    def from_dict(cls, dictionary: dict):
+        # Keep the ids of existing dictionaries, page maps refer to them
+        vocabulary = cls()
+        size = max(dictionary.values(), default=0)
+        vocabulary._words = [None] * size
+        collisions = []
+        for word, word_id in sorted(dictionary.items(), key=lambda item: item[1]):
+            if vocabulary._words[word_id - 1] is None:
+                word = sys.intern(word)
+                vocabulary._words[word_id - 1] = word
+                vocabulary._ids[word] = word_id
+            else:
+                collisions.append(word)
+        for word in collisions:
+            _logger.warning('Word {0} shares its id with another word and gets a new id'.format(word))
+            vocabulary.add(word)
+        return vocabulary
+
+    def to_dict(self) -> dict:
+        return dict(self._ids)
+
+    @classmethod
+    def from_list(cls, words: list[str]):
+        # Word of every id (index = id - 1), None for unused ids
+        vocabulary = cls()
+        vocabulary._words = [None if word is None else sys.intern(word) for word in words]
+        vocabulary._ids = {word: word_id for word_id, word in enumerate(vocabulary._words, start=1) if word is not None}
+        return vocabulary
+
+    def to_list(self) -> list[str]:
+        return list(self._words)
+
+    def __getitem__(self, word: str) -> int:
+        return self._ids[word]
+
+    def __contains__(self, word: str) -> bool:
+        return word in self._ids
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def get(self, word: str, default=None):
+        return self._ids.get(word, default)
+
+    def items(self):
+        return self._ids.items()
+
+    @property
+    def next_id(self) -> int:
+        return len(self._words) + 1
+
+    def add(self, word: str) -> int:
+        word_id = self._ids.get(word)
+        if word_id is None:
+            word = sys.intern(word)
+            word_id = self.next_id
+            self._words.append(word)
+            self._ids[word] = word_id
+        return word_id
+
+    def word(self, word_id: int) -> str:
+        if 0 < word_id <= len(self._words):
+            return self._words[word_id - 1]
+        return None
+
+
+class SynonymIndex:
+
+    # synonym -> canonical value plus the reverse index canonical value -> synonyms
+    __slots__ = ('_canonical', '_synonyms', 'changes')
+
+    def __init__(self) -> None:
+        self._canonical = {}
+        self._synonyms = {}
+        # (synonym, canonical value) pairs set since the index was last persisted
+        self.changes = []
+
+    @classmethod
+    def from_dict(cls, synonyms: dict):
+        index = cls()
+        for synonym, canonical in synonyms.items():
+            index[synonym] = canonical
+        index.changes.clear()
+        return index
+
+    def to_dict(self) -> dict:
+        return dict(self._canonical)
+
+    def __setitem__(self, synonym: str, canonical: str):
+        previous = self._canonical.get(synonym)
+        if previous is not None:
+            self._synonyms[previous].pop(synonym, None)
+        self._canonical[synonym] = canonical
+        # Dicts keep insertion order (and are used as ordered sets here)
+        self._synonyms.setdefault(canonical, {})[synonym] = None
+        self.changes.append((synonym, canonical))
+
+    def __getitem__(self, synonym: str) -> str:
+        return self._canonical[synonym]
+
+    def __contains__(self, synonym: str) -> bool:
+        return synonym in self._canonical
+
+    def __len__(self) -> int:
+        return len(self._canonical)
+
+    def __iter__(self):
+        return iter(self._canonical)
+
+    def get(self, synonym: str, default=None):
+        return self._canonical.get(synonym, default)
+
+    def items(self):
+        return self._canonical.items()
+
+    def synonyms_of(self, canonical: str) -> list[str]:
+        return list(self._synonyms.get(canonical, ()))
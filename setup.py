@@ -25,6 +25,10 @@ setup(
         'price-parser',
         'Babel',
         'thefuzz[speedup]',
+        'rapidfuzz',
         'mgzip'
-    ]
+    ],
+    extras_require={
+        'async': ['aiohttp']
+    }
 )
\ No newline at end of file